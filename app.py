@@ -1,17 +1,33 @@
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, render_template, request, jsonify, session, Response, send_file, abort, g
 import os
 import speech_recognition as sr
-import pyttsx3
-import google.generativeai as genai
 from dotenv import load_dotenv
-from pydub import AudioSegment
 import subprocess
 import requests
 import json
+import re
 import time
 import hashlib
-import datetime
-from utils import generate_cache_key, is_similar_query
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from utils import generate_cache_key
+from cache import ResponseCache
+from cache_store import SQLiteCacheStore
+from http_client import PooledHTTPClient
+from tts import TTSPipeline, TTSWorker, AudioCache
+from model_router import ModelRouter, ModelCallError, RateLimitError, AllModelsFailedError, is_rate_limit
+from rate_limit import RateLimiters, parse_rate_limits
+from single_flight import SingleFlight
+from gemini_batch import PromptBatcher
+from audio import AudioDecoderPool, AudioDecodeError, DecoderBusyError, PYAV_AVAILABLE, pyav
+from asr import BatchingRecognizer, LazyRecognizer, create_recognizer
+from voice_stream import AudioStreamManager, STREAM_SAMPLE_RATE, STREAM_SAMPLE_WIDTH
+from conversation_store import ConversationStore
+from conversation_context import ConversationContext, Prompt, build_summary_prompt, contents_text, depends_on_context, user_content
+from pipeline import Pipeline, PipelineMetrics, RequestContext, Stage
+from cache_warming import CacheWarmer, read_query_log, rank_queries
+from startup import LazyBackend, Prewarmer, process_uptime
 
 # 載入環境變數
 load_dotenv()
@@ -19,8 +35,23 @@ load_dotenv()
 # 獲取 API KEY
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 
-# 設定 Gemini API
-genai.configure(api_key=GEMINI_API_KEY)
+# Gemini SDK 只有最後備用的模型使用，匯入需要將近一秒，第一次使用 (或預熱) 時才匯入並設定
+def init_gemini_sdk():
+    import google.generativeai as genai
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai
+
+gemini_sdk = LazyBackend("Gemini SDK", init_gemini_sdk)
+
+# Gemini REST API 的位址 (可指向本地的測試伺服器)
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com")
+
+# 共享的 HTTP 連線池，避免每次請求都重新建立 TCP/TLS 連線
+gemini_http = PooledHTTPClient(
+    pool_size=int(os.environ.get("GEMINI_POOL_SIZE", 20)),
+    connect_timeout=float(os.environ.get("GEMINI_CONNECT_TIMEOUT", 3.05)),
+    read_timeout=float(os.environ.get("GEMINI_READ_TIMEOUT", 10))
+)
 
 # 定義可用模型及其備用模型
 PRIMARY_MODEL = 'gemini-2.0-flash'  # 直接使用 REST API 的模型，作為主要模型
@@ -30,17 +61,47 @@ REST_API_MODEL = 'gemini-1.0-pro'  # 最後備用選項
 # 由於我們將使用 gemini-2.0-flash 作為主要模型，直接通過 REST API 調用，不需要創建 SDK 模型實例
 print(f"使用主要模型: {PRIMARY_MODEL} (通過 REST API 調用)")
 
-# 備用情況下使用的 SDK 模型實例
-try:
-    backup_model = genai.GenerativeModel(BACKUP_MODEL)
-    print(f"備用模型準備就緒: {BACKUP_MODEL}")
-    backup_chat = backup_model.start_chat(history=[])
-except Exception as e:
-    print(f"無法初始化備用模型，錯誤: {e}")
+# 備用情況下使用的 SDK 模型實例 (每個請求帶入自己對話的上下文，不共用同一個 chat)
+# 第一次使用時才建立；初始化失敗時呼叫會以 ModelCallError 失敗並交給其他模型，稍後再重試
+backup_model = LazyBackend(f"備用模型 {BACKUP_MODEL}", lambda: gemini_sdk.get().GenerativeModel(BACKUP_MODEL))
+
+# 各模型的用戶端配額 (每分鐘請求數:每分鐘 token 數)，超過時在本地排隊而不是收到 429
+# 預設為免費方案的限制，可用 GEMINI_RATE_LIMITS 覆寫，例如 "gemini-2.0-flash=2000:4000000"，設為空字串則不限制
+DEFAULT_RATE_LIMITS = f"{PRIMARY_MODEL}=15:1000000,{BACKUP_MODEL}=2:32000,{REST_API_MODEL}=15:32000"
+rate_limiters = RateLimiters(
+    parse_rate_limits(os.environ.get("GEMINI_RATE_LIMITS", DEFAULT_RATE_LIMITS)),
+    max_wait=float(os.environ.get("RATE_LIMIT_MAX_WAIT", 5))  # 預計排隊超過此秒數時改用其他模型
+)
+
+# 同時進行的相同或相似查詢只呼叫一次模型，共用同一個結果
+request_coalescer = SingleFlight()
 
-# 簡單的響應緩存系統
-response_cache = {}
+# 帶索引的響應緩存系統
 CACHE_EXPIRY = 60 * 60  # 一小時的緩存過期時間
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 10000))  # 最多緩存的查詢數量
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", 64 * 1024 * 1024))  # 緩存內容總大小上限
+# 設定 CACHE_DB_PATH 時使用 SQLite 共享緩存，讓多個 worker 進程共用並在重啟後保留
+CACHE_DB_PATH = os.environ.get("CACHE_DB_PATH")
+cache_store = SQLiteCacheStore(CACHE_DB_PATH, CACHE_EXPIRY) if CACHE_DB_PATH else None
+# 語意緩存：設定 SEMANTIC_CACHE_BACKEND (sentence-transformers / hashing) 時，相似查詢也找不到的查詢
+# 再以句向量的餘弦相似度查找改寫過的問題 (例如 "明天天氣如何" 與 "明天會下雨嗎")
+SEMANTIC_CACHE_BACKEND = os.environ.get("SEMANTIC_CACHE_BACKEND")
+semantic_tier = None
+if SEMANTIC_CACHE_BACKEND:
+    # 只在啟用時匯入 (需要 numpy)
+    from semantic_cache import SemanticTier, create_embedder, SEMANTIC_THRESHOLD
+    semantic_tier = SemanticTier(
+        create_embedder(SEMANTIC_CACHE_BACKEND, os.environ.get("SEMANTIC_CACHE_MODEL")),
+        threshold=float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", SEMANTIC_THRESHOLD))
+    )
+    print(f"語意緩存後端: {SEMANTIC_CACHE_BACKEND} (閾值 {semantic_tier.threshold})")
+response_cache = ResponseCache(
+    CACHE_EXPIRY,
+    max_entries=CACHE_MAX_ENTRIES,
+    max_bytes=CACHE_MAX_BYTES,
+    store=cache_store,
+    semantic=semantic_tier
+)
 
 # 語音設置
 voice_settings = {
@@ -49,101 +110,454 @@ voice_settings = {
     'pitch': 1.0
 }
 
-# TTS 引擎管理
-engine = None
-
-# 創建一個更安全的函數來獲取和重置 TTS 引擎
-def get_tts_engine():
-    global engine
-    try:
-        # 如果引擎已存在，先嘗試停止它
-        if engine:
-            try:
-                engine.stop()
-            except:
-                pass
-    except:
-        pass
-        
-    # 創建新的引擎實例
-    try:
-        engine = pyttsx3.init()
-        engine.setProperty('volume', voice_settings['volume'])
-        engine.setProperty('rate', voice_settings['rate'] * 200)  # 基準速率為 200
-        return engine
-    except Exception as e:
-        print(f"創建 TTS 引擎時出錯: {e}")
-        return None
-
-# 使用 REST API 方式呼叫 Gemini (主要和備用方法)
-def call_gemini_api(text, model_name=PRIMARY_MODEL):
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={GEMINI_API_KEY}"
+# 組成 Gemini REST API 的請求 (同步與非同步版本共用)
+# history 為先前對話的 contents (多輪上下文)
+def gemini_request(text, model_name, stream=False, history=None):
+    method = "streamGenerateContent?alt=sse&" if stream else "generateContent?"
+    url = f"{GEMINI_API_BASE}/v1beta/models/{model_name}:{method}key={GEMINI_API_KEY}"
     headers = {'Content-Type': 'application/json'}
     data = {
-        "contents": [{
-            "parts": [{"text": text}]
-        }]
+        "contents": list(history or []) + [user_content(text)]
     }
+    return url, headers, data
+
+# 解析 generateContent 的響應，requests 與 httpx 的響應物件皆可
+# 失敗時拋出 ModelCallError (配額限制為 RateLimitError)，錯誤訊息不會被當成回應緩存
+def parse_gemini_response(response):
+    print(f"REST API 響應狀態碼: {response.status_code}")
     
-    print(f"調用 REST API: {model_name}")
+    if response.status_code == 200:
+        response_json = response.json()
+        # 解析返回的 JSON 結果
+        try:
+            generated_text = response_json['candidates'][0]['content']['parts'][0]['text']
+            return generated_text
+        except (KeyError, IndexError) as e:
+            print(f"解析 API 響應時出錯: {e}")
+            print(f"API 響應: {response_json}")
+            raise ModelCallError(f"處理請求時出現問題: {e}") from e
+    elif response.status_code == 429:
+        # 如果是配額限制，拋出異常以觸發備用邏輯
+        raise RateLimitError(f"API 配額限制: {response.status_code}")
+    else:
+        print(f"API 調用失敗: 狀態碼 {response.status_code}")
+        print(f"響應: {response.text}")
+        raise ModelCallError(f"API 調用失敗: {response.status_code} {response.text}")
+
+# 解析 SSE 串流中的一行 (格式為 "data: {json}")，返回其中的文字片段
+def parse_sse_line(line):
+    if not line or not line.startswith('data:'):
+        return []
     try:
-        response = requests.post(url, headers=headers, json=data, timeout=10)
-        print(f"REST API 響應狀態碼: {response.status_code}")
-        
-        if response.status_code == 200:
-            response_json = response.json()
-            # 解析返回的 JSON 結果
-            try:
-                generated_text = response_json['candidates'][0]['content']['parts'][0]['text']
-                return generated_text
-            except (KeyError, IndexError) as e:
-                print(f"解析 API 響應時出錯: {e}")
-                print(f"API 響應: {response_json}")
-                return f"處理請求時出現問題: {e}"
-        elif response.status_code == 429:
-            # 如果是配額限制，拋出異常以觸發備用邏輯
-            raise Exception(f"API 配額限制: {response.status_code}")
-        else:
-            print(f"API 調用失敗: 狀態碼 {response.status_code}")
-            print(f"響應: {response.text}")
-            return f"API 調用失敗: {response.text}"
-    except requests.exceptions.RequestException as e:
-        print(f"REST API 請求異常: {e}")
-        return f"REST API 請求失敗: {e}"
+        chunk = json.loads(line[len('data:'):].strip())
+        parts = chunk['candidates'][0]['content']['parts']
+    except (ValueError, KeyError, IndexError) as e:
+        print(f"解析串流響應時出錯: {e}")
+        return []
+    return [part['text'] for part in parts if part.get('text')]
+
+# 使用 REST API 方式呼叫 Gemini (主要和備用方法)
+def call_gemini_api(text, model_name=PRIMARY_MODEL, history=None):
+    url, headers, data = gemini_request(text, model_name, history=history)
+    
+    with rate_limiters.limit(model_name, contents_text(data["contents"])) as usage:
+        print(f"調用 REST API: {model_name}")
+        try:
+            response = gemini_http.post(url, headers=headers, json=data)
+        except requests.exceptions.RequestException as e:
+            print(f"REST API 請求異常: {e}")
+            raise ModelCallError(f"REST API 請求失敗: {e}") from e
+        response_text = parse_gemini_response(response)
+        usage.add(response_text)
+        return response_text
         
+# 使用 REST API 串流方式呼叫 Gemini，逐段產生文字
+def stream_gemini_api(text, model_name=PRIMARY_MODEL, history=None):
+    url, headers, data = gemini_request(text, model_name, stream=True, history=history)
+    
+    with rate_limiters.limit(model_name, contents_text(data["contents"])) as usage:
+        print(f"串流調用 REST API: {model_name}")
+        try:
+            with gemini_http.stream(url, headers=headers, json=data) as response:
+                print(f"REST API 響應狀態碼: {response.status_code}")
+                if response.status_code == 429:
+                    # 如果是配額限制，拋出異常以觸發備用邏輯
+                    raise RateLimitError(f"API 配額限制: {response.status_code}")
+                if response.status_code != 200:
+                    print(f"API 調用失敗: 狀態碼 {response.status_code}")
+                    raise ModelCallError(f"API 調用失敗: {response.status_code} {response.text}")
+                
+                for line in response.iter_lines(decode_unicode=True):
+                    for text_part in parse_sse_line(line):
+                        usage.add(text_part)
+                        yield text_part
+        except requests.exceptions.RequestException as e:
+            print(f"REST API 串流請求異常: {e}")
+            raise ModelCallError(f"REST API 請求失敗: {e}") from e
+
 # 使用 SDK 方式呼叫 Gemini (最後備用)
-def call_gemini_sdk(text):
+def call_gemini_sdk(text, history=None):
+    contents = list(history or []) + [user_content(text)]
     try:
-        response = backup_chat.send_message(text)
-        return response.text
+        with rate_limiters.limit(BACKUP_MODEL, contents_text(contents)) as usage:
+            response = backup_model.get().generate_content(contents)
+            usage.add(response.text)
+            return response.text
+    except ModelCallError:
+        raise
     except Exception as e:
         print(f"SDK API 調用失敗: {e}")
-        return f"SDK API 調用失敗: {e}"
+        error_class = RateLimitError if is_rate_limit(e) else ModelCallError
+        raise error_class(f"SDK API 調用失敗: {e}") from e
+
+# REST API 模型的批次處理 (預設關閉)：負載高時把數毫秒內到達的請求合併送出
+# - fanout: 每個問題各自呼叫，但同時進行的呼叫數量不超過連線池大小，其餘請求在佇列中合併成更大的批次
+# 不把多個使用者的問題合併成同一個請求：問題之間可以互相注入或讀取其他使用者的回答，
+# 回應拆分錯誤時也會把回答交給錯誤的使用者
+GEMINI_BATCH_MODE = os.environ.get("GEMINI_BATCH_MODE", "off")
+GEMINI_BATCH_SIZE = int(os.environ.get("GEMINI_BATCH_SIZE", 8))
+gemini_fanout_executor = ThreadPoolExecutor(max_workers=gemini_http.pool_size, thread_name_prefix="gemini-fanout")
+
+def fanout_gemini(prompts, model_name):
+    futures = [gemini_fanout_executor.submit(call_gemini_api, prompt, model_name) for prompt in prompts]
+    return [future.exception() or future.result() for future in futures]
+
+# 各模型的批次佇列含有背景執行緒，由 create_app 建立 (init_gemini_batchers)
+gemini_batchers = {}
+
+def init_gemini_batchers():
+    if GEMINI_BATCH_MODE == 'packed':
+        print("GEMINI_BATCH_MODE=packed 已移除 (會混合不同使用者的問題)，改用 fanout")
+    elif GEMINI_BATCH_MODE != 'fanout':
+        return
+    # 同時送出的批次數量：每批最多佔 GEMINI_BATCH_SIZE 條連線
+    default_batch_workers = max(1, gemini_http.pool_size // GEMINI_BATCH_SIZE)
+    for batch_model in (PRIMARY_MODEL, REST_API_MODEL):
+        gemini_batchers[batch_model] = PromptBatcher(
+            lambda prompts, model_name=batch_model: fanout_gemini(prompts, model_name),
+            max_batch=GEMINI_BATCH_SIZE,
+            max_wait=float(os.environ.get("GEMINI_BATCH_MAX_WAIT_MS", 5)) / 1000,
+            workers=int(os.environ.get("GEMINI_BATCH_WORKERS", default_batch_workers)),
+            name=batch_model
+        )
+    print(f"Gemini 請求批次處理: fanout，每批最多 {GEMINI_BATCH_SIZE} 個")
+
+# 呼叫 REST API 模型，啟用批次處理時先放入該模型的批次佇列 (帶有上下文的請求無法合併，直接呼叫)
+def call_gemini_batched(text, model_name=PRIMARY_MODEL, history=None):
+    batcher = gemini_batchers.get(model_name)
+    if batcher is None or history:
+        return call_gemini_api(text, model_name, history=history)
+    return batcher.call(text)
+
+# 模型備援策略：主要模型 -> 備用 REST API 模型 -> SDK，請求為 Prompt (問題與對話上下文)
+# 某個模型超過對沖延遲仍未回應時同時呼叫下一個模型，先成功者勝出；
+# 回應 429 的模型在冷卻時間內直接跳過
+MODEL_HEDGE_DELAY = os.environ.get("MODEL_HEDGE_DELAY")  # 固定的對沖延遲秒數，未設定時使用各模型近期延遲的 p95
+model_router = ModelRouter(
+    [
+        (PRIMARY_MODEL, lambda prompt: call_gemini_batched(prompt.text, PRIMARY_MODEL, prompt.history)),
+        (REST_API_MODEL, lambda prompt: call_gemini_batched(prompt.text, REST_API_MODEL, prompt.history)),
+        (BACKUP_MODEL, lambda prompt: call_gemini_sdk(prompt.text, prompt.history)),
+    ],
+    hedge_delay=float(MODEL_HEDGE_DELAY) if MODEL_HEDGE_DELAY else None,
+    default_hedge_delay=float(os.environ.get("MODEL_DEFAULT_HEDGE_DELAY", 2.0)),
+    cooldown=float(os.environ.get("MODEL_COOLDOWN", 60))
+)
+
+# 未命中緩存時呼叫模型，並在結束同時查詢的合併之前存入緩存
+def fetch_response(user_query):
+    model_name, response_text = model_router.route(Prompt(user_query, []))
+    response_cache.put(user_query, response_text)
+    print(f"使用模型 {model_name} 的回應，存入緩存: {generate_cache_key(user_query)}")
+    return model_name, response_text
+
+# 逐句語音合成管線：回應切分為句子後依序合成，前端可在第一句完成時就開始播放
+# 所有合成工作都交給同一個長期運行的 TTS 執行緒，引擎只初始化一次
+# 合成結果依 (文字, 語音設置) 的雜湊值緩存在磁碟上，重複的句子只需查找檔案
+# 含有背景執行緒與磁碟上的檔案，由 create_app 建立 (init_tts)
+tts_worker = None
+tts_audio_cache = None
+tts_pipeline = None
+
+def init_tts():
+    global tts_worker, tts_audio_cache, tts_pipeline
+    tts_worker = TTSWorker()
+    tts_audio_cache = AudioCache(
+        os.environ.get("TTS_CACHE_DIR", os.path.join("static", "tts")),
+        max_bytes=int(os.environ.get("TTS_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+        max_age=int(os.environ.get("TTS_CACHE_MAX_AGE", 7 * 24 * 60 * 60))  # 一週未使用的語音檔案會被刪除
+    )
+    tts_pipeline = TTSPipeline(
+        tts_worker,
+        tts_audio_cache,
+        max_chars=int(os.environ.get("TTS_MAX_SEGMENT_CHARS", 120))
+    )
+
+# 常駐的音頻解碼池，預設與 CPU 核心數相同的執行緒數，佇列已滿時拒絕新的請求
+audio_decoder = AudioDecoderPool(
+    workers=int(os.environ.get("AUDIO_DECODE_WORKERS", os.cpu_count() or 2)),
+    max_queue=int(os.environ.get("AUDIO_DECODE_QUEUE", 32))
+)
+
+# 語音識別後端：google (線上) / vosk / faster-whisper (離線，模型在第一次識別或預熱時載入一次)
+ASR_BACKEND = os.environ.get("ASR_BACKEND", "google")
+ASR_WORKERS = int(os.environ.get("ASR_WORKERS", 8 if ASR_BACKEND == 'google' else 2))
+# 含有背景執行緒，由 create_app 建立 (init_speech_recognizer)
+speech_recognizer = None
+
+def init_speech_recognizer():
+    global speech_recognizer
+    speech_recognizer = BatchingRecognizer(
+        LazyRecognizer(ASR_BACKEND, lambda: create_recognizer(
+            ASR_BACKEND,
+            language=os.environ.get("ASR_LANGUAGE", "zh-TW"),
+            model_path=os.environ.get("ASR_MODEL_PATH"),
+            model_size=os.environ.get("ASR_MODEL_SIZE", "small"),
+            num_workers=ASR_WORKERS
+        )),
+        workers=ASR_WORKERS,
+        # 只有支援批次推論的後端 (faster-whisper) 會合併同時到達的音頻；線上識別以網路延遲為主，不需要合併請求
+        max_batch=1 if ASR_BACKEND == 'google' else int(os.environ.get("ASR_MAX_BATCH", 8))
+    )
+    print(f"語音識別後端: {ASR_BACKEND}")
+
+# 請求處理管線：各路由共用同一組步驟，每個步驟記錄耗時與計數，由 /metrics 輸出
+# 設定 SERVER_TIMING=1 時在響應中加上 Server-Timing 標頭，可在瀏覽器開發者工具中看到各步驟的耗時
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "0") == "1"
+# 多輪上下文的使用方式：always (預設，每個問題都帶入上下文，多輪對話中不使用緩存) /
+# follow-up (只有含指涉用語的追問帶入上下文，其他問題照常使用緩存)
+CONTEXT_MODE = os.environ.get("CONTEXT_MODE", "always")
+pipeline_metrics = PipelineMetrics(window=int(os.environ.get("METRICS_WINDOW", 1024)))
+
+# 在解碼池中直接解碼上傳的音頻，WAV/PCM 不需轉碼
+def decode_stage(ctx):
+    ctx.audio = audio_decoder.decode(ctx.audio, ctx.mimetype)
+
+# 交給共用的語音識別後端
+def asr_stage(ctx):
+    ctx.text = speech_recognizer.recognize(ctx.audio)
+
+# 多輪對話中每個問題都帶入預算內的上下文 (含摘要)，這些回應取決於上下文，不使用共用的緩存與查詢合併
+# CONTEXT_MODE=follow-up 時只有含指涉用語的追問帶入上下文，其他問題照常使用緩存
+# (代價是沒有指涉用語卻需要先前對話的問題，回答不參考先前的對話)
+def context_stage(ctx):
+    if CONTEXT_MODE == 'always' or depends_on_context(ctx.text):
+        ctx.history = conversation_context.build(ctx.session_id)
+
+# 檢查緩存中是否有相同或相似的查詢 (過期項目由緩存自行清理)
+def cache_stage(ctx):
+    if ctx.history:
+        ctx.cache = 'bypass'
+        return
+    cached_response = response_cache.get(ctx.text)
+    if cached_response is None:
+        ctx.cache = 'miss'
+        return
+    print(f"使用緩存的回應: {generate_cache_key(ctx.text)}")
+    ctx.cache = 'hit'
+    ctx.answer(cached_response)
+
+# 未命中緩存時交給模型備援策略 (緩存命中時略過)；相似的查詢正在進行時等待它的結果
+def llm_stage(ctx):
+    try:
+        if ctx.history:
+            model_name, response_text = model_router.route(Prompt(ctx.text, ctx.history))
+        else:
+            model_name, response_text = request_coalescer.do(ctx.text, fetch_response)
+    except ModelCallError as e:
+        # 錯誤訊息不存入緩存
+        ctx.model_failed = True
+        ctx.answer(f"很抱歉，所有 AI 服務方式都失敗。請稍後再試。錯誤詳情：{e}")
+        return
+    ctx.answer(response_text, model_name, model_router.fallback_depth(model_name))
+
+# 將回應逐句轉換為語音
+def tts_stage(ctx):
+    ctx.tts_job = tts_pipeline.speak(ctx.response_text, voice_settings)
+
+def history_stage(ctx):
+    add_to_chat_history(ctx.text, ctx.response_text, session_id=ctx.session_id)
+
+# 各個步驟只建立一次，非同步模式為需要等待的步驟加上協程函式 (Stage.arun) 後共用同一組管線
+pipeline_stages = {
+    'decode': Stage('decode', decode_stage),
+    'asr': Stage('asr', asr_stage),
+    'context': Stage('context', context_stage),
+    'cache': Stage('cache', cache_stage),
+    'llm': Stage('llm', llm_stage, skip=lambda ctx: ctx.cache == 'hit'),
+    'tts': Stage('tts', tts_stage),
+    'history': Stage('history', history_stage),
+}
+
+def build_pipeline(*names):
+    return Pipeline([pipeline_stages[name] for name in names], pipeline_metrics)
+
+answer_pipeline = build_pipeline('context', 'cache', 'llm')
+text_pipeline = build_pipeline('context', 'cache', 'llm', 'tts', 'history')
+audio_pipeline = build_pipeline('decode', 'asr', 'context', 'cache', 'llm', 'tts', 'history')
+# 串流錄音送來的已是原始 PCM，不需解碼
+voice_stream_pipeline = build_pipeline('asr', 'context', 'cache', 'llm', 'tts', 'history')
+
+# 各元件目前的狀態，輸出 /metrics 時讀取
+pipeline_metrics.register_gauge('response_cache_entries', "回應緩存的項目數", lambda: len(response_cache))
+pipeline_metrics.register_gauge(
+    'response_cache_warmed_hits_total', "由預熱的記錄提供的緩存命中數",
+    lambda: response_cache.warmed_hits, metric_type='counter'
+)
+pipeline_metrics.register_gauge(
+    'response_cache_semantic_hits_total', "由語意查找 (句向量的餘弦相似度) 命中的緩存數",
+    lambda: response_cache.semantic_hits, metric_type='counter'
+)
+pipeline_metrics.register_gauge('asr_queue_depth', "等待語音識別的請求數", lambda: speech_recognizer.stats()['queue_depth'])
+pipeline_metrics.register_gauge('coalescing_in_flight', "正在進行且可被合併的模型請求數", lambda: request_coalescer.stats()['in_flight'])
+pipeline_metrics.register_gauge(
+    'model_breaker_open', "模型的熔斷器是否開啟 (冷卻中)",
+    lambda: [({'model': name}, int(breaker.state == 'open')) for name, breaker in model_router.breakers.items()]
+)
+
+# 取得查詢的回應 (不合成語音、不寫入聊天歷史)
+def get_response(user_query, session_id=None):
+    return answer_pipeline.run(RequestContext('get_response', text=user_query, session_id=session_id)).response_text
+
+# 串流語音識別：偵測到說話結束時立即識別去除靜音的音頻並產生回應，聊天歷史在背景寫入
+def recognize_speech(pcm, session_id=None):
+    if pcm is None:
+        return None
+    ctx = RequestContext(
+        'audio_stream', audio=sr.AudioData(pcm, STREAM_SAMPLE_RATE, STREAM_SAMPLE_WIDTH), session_id=session_id
+    )
+    voice_stream_pipeline.run(ctx)
+    return {
+        "input_text": ctx.text,
+        "response_text": ctx.response_text,
+        "audio_segments": ctx.tts_job.segment_urls()
+    }
+
+audio_streams = AudioStreamManager(
+    recognize_speech,
+    workers=int(os.environ.get("AUDIO_STREAM_WORKERS", 4)),
+    max_stream_seconds=float(os.environ.get("AUDIO_STREAM_MAX_SECONDS", 60)),
+    vad_options={'silence_ms': int(os.environ.get("VAD_SILENCE_MS", 700))}
+)
+
+# 將資料格式化為一個 SSE 事件
+def sse_event(payload):
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "my_secret_key_for_session")
 
-# 聊天歷史記錄
-def get_chat_history():
-    if 'chat_history' not in session:
-        session['chat_history'] = []
-    return session['chat_history']
-
-def add_to_chat_history(user_message, system_response):
-    history = get_chat_history()
-    history.append({
-        'user': user_message,
-        'system': system_response,
-        'timestamp': datetime.datetime.now().isoformat()
-    })
-    session['chat_history'] = history
-    # 只保留最近的 50 條消息
-    if len(history) > 50:
-        session['chat_history'] = history[-50:]
+# 聊天歷史保存在服務器端的 SQLite，cookie 中只保存 session ID
+CHAT_HISTORY_PAGE_SIZE = int(os.environ.get("CHAT_HISTORY_PAGE_SIZE", 20))  # 首頁與每次載入較早記錄的輪數
+# 資料庫與上下文 (含摘要的執行緒池) 由 create_app 建立 (init_conversations)
+conversation_store = None
+conversation_context = None
+
+# 取得目前對話的 session ID，第一次使用時建立
+# (store 為 session 物件，預設使用 Flask 的 session，非同步模式傳入 Quart 的 session)
+def get_session_id(store=None):
+    store = session if store is None else store
+    session_id = store.get('sid')
+    if session_id is None:
+        session_id = store['sid'] = secrets.token_urlsafe(16)
+    # 舊版把聊天歷史存在 cookie 中，轉存到服務器端後從 cookie 移除
+    legacy_history = store.pop('chat_history', None)
+    if legacy_history:
+        for turn in legacy_history:
+            conversation_store.append(session_id, turn['user'], turn['system'])
+    return session_id
+
+# 把移出上下文的較早對話濃縮成摘要 (在背景執行，同樣經過模型備援策略)
+def summarize_conversation(previous_summary, turns, max_chars):
+    _, summary = model_router.route(Prompt(build_summary_prompt(previous_summary, turns, max_chars), []))
+    return summary.strip()
+
+# 每個對話的多輪上下文，總長度不超過 CONTEXT_TOKEN_BUDGET (設為 0 則每個問題獨立回答)
+# 放不下的較早對話併入摘要 (CONTEXT_SUMMARY=0 時直接截斷)
+def init_conversations():
+    global conversation_store, conversation_context
+    conversation_store = ConversationStore(
+        os.environ.get("CONVERSATION_DB_PATH", "conversations.db"),
+        max_turns=int(os.environ.get("CONVERSATION_MAX_TURNS", 500)),
+        ttl=float(os.environ.get("CONVERSATION_TTL_DAYS", 30)) * 24 * 60 * 60
+    )
+    conversation_context = ConversationContext(
+        conversation_store,
+        token_budget=int(os.environ.get("CONTEXT_TOKEN_BUDGET", 2000)),
+        max_turns=int(os.environ.get("CONTEXT_MAX_TURNS", 20)),
+        summarize=summarize_conversation if os.environ.get("CONTEXT_SUMMARY", "1") != "0" else None,
+        # 摘要時壓縮到預算的這個比例，之後幾輪不需再摘要
+        compact_to=float(os.environ.get("CONTEXT_COMPACT_TO", 0.5))
+    )
+
+# 緩存預熱：啟動時依歷史查詢記錄 (CACHE_WARM_LOG，以逗號分隔，例如聊天歷史的 conversations.db) 排序熱門問題，
+# 在背景預先取得回應並標記為預熱，/cache_stats 的 warmed_hits 表示預熱帶來的命中
+# 預取受每分鐘次數 (CACHE_WARM_RPM) 與總次數 (CACHE_WARM_BUDGET) 限制，主要模型的配額餘量
+# 低於 CACHE_WARM_HEADROOM 或冷卻中時暫停，讓即時請求優先
+CACHE_WARM_LOG = os.environ.get("CACHE_WARM_LOG", "")
+CACHE_WARM_HEADROOM = float(os.environ.get("CACHE_WARM_HEADROOM", 0.5))
+
+# 預先取得一個問題的回應；同時有相似的即時請求時共用同一次呼叫
+def prefetch_response(query):
+    def fetch(q):
+        model_name, response_text = model_router.route(Prompt(q, []))
+        response_cache.put(q, response_text, warmed=True)
+        return model_name, response_text
+    return request_coalescer.do(query, fetch)
+
+def cache_warming_ready():
+    if model_router.breakers[PRIMARY_MODEL].state != 'closed':
+        return False
+    limiter = rate_limiters.get(PRIMARY_MODEL)
+    return limiter is None or limiter.headroom() >= CACHE_WARM_HEADROOM
+
+cache_warmer = None
+
+# 讀取查詢記錄並在背景開始預熱 (由 create_app 呼叫)
+def start_cache_warmer():
+    global cache_warmer
+    if not CACHE_WARM_LOG:
+        return
+    try:
+        warm_queries = []
+        for log_path in filter(None, (part.strip() for part in CACHE_WARM_LOG.split(','))):
+            warm_queries.extend(read_query_log(log_path, limit=int(os.environ.get("CACHE_WARM_LOG_LIMIT", 10000))))
+        cache_warmer = CacheWarmer(
+            response_cache,
+            prefetch_response,
+            rank_queries(
+                warm_queries,
+                top=int(os.environ.get("CACHE_WARM_TOP", 100)),
+                min_count=int(os.environ.get("CACHE_WARM_MIN_COUNT", 2))
+            ),
+            rate=float(os.environ.get("CACHE_WARM_RPM", 6)),
+            budget=int(os.environ.get("CACHE_WARM_BUDGET", 50)),
+            ready=cache_warming_ready
+        ).start()
+        print(f"開始預熱緩存: {len(cache_warmer.queries)} 個熱門問題")
+    except OSError as e:
+        print(f"無法讀取查詢記錄，不預熱緩存: {e}")
+
+# 讀取一頁聊天歷史，返回 (依時間排序的記錄, 更早一頁的游標)，沒有更早的記錄時游標為 None
+def get_chat_history(store=None, before=None, limit=CHAT_HISTORY_PAGE_SIZE):
+    return conversation_store.history(get_session_id(store), before=before, limit=limit)
+
+# 串流回應在響應標頭送出後才完成，需事先取得 session_id 傳入
+def add_to_chat_history(user_message, system_response, store=None, session_id=None):
+    conversation_store.append(session_id or get_session_id(store), user_message, system_response)
 
 @app.route('/')
 def index():
-    return render_template('index.html', chat_history=get_chat_history())
+    chat_history, history_before = get_chat_history()
+    return render_template('index.html', chat_history=chat_history, history_before=history_before)
+
+# 分頁載入較早的聊天歷史，before 為上一頁返回的游標
+@app.route('/chat_history')
+def chat_history_page():
+    before = request.args.get('before', type=int)
+    limit = min(request.args.get('limit', CHAT_HISTORY_PAGE_SIZE, type=int), 100)
+    turns, next_before = get_chat_history(before=before, limit=limit)
+    return jsonify({"turns": turns, "before": next_before})
 
 @app.route('/update_voice_settings', methods=['POST'])
 def update_voice_settings():
@@ -165,207 +579,413 @@ def update_voice_settings():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/cache_stats')
+def cache_stats():
+    stats = response_cache.stats()
+    stats['audio'] = tts_audio_cache.stats()
+    if cache_warmer is not None:
+        stats['warming'] = cache_warmer.stats()
+    return jsonify(stats)
+
+@app.route('/model_stats')
+def model_stats():
+    stats = model_router.stats()
+    stats['rate_limits'] = rate_limiters.stats()
+    stats['coalescing'] = request_coalescer.stats()
+    stats['batching'] = {model: batcher.stats() for model, batcher in gemini_batchers.items()}
+    stats['context'] = conversation_context.stats()
+    return jsonify(stats)
+
+@app.route('/pipeline_stats')
+def pipeline_stats():
+    return jsonify({
+        'stages': pipeline_metrics.stage_stats(),
+        'cache_hit_ratio': pipeline_metrics.cache_hit_ratio()
+    })
+
+# Prometheus 格式的統計
+@app.route('/metrics')
+def metrics():
+    return Response(pipeline_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# 在響應中加上這個請求經過的各步驟耗時
+@app.after_request
+def add_server_timing(response):
+    ctx = g.get('pipeline_context')
+    if SERVER_TIMING and ctx is not None:
+        response.headers['Server-Timing'] = ctx.server_timing()
+    return response
+
+@app.route('/decoder_stats')
+def decoder_stats():
+    return jsonify(audio_decoder.stats())
+
+@app.route('/asr_stats')
+def asr_stats():
+    return jsonify(speech_recognizer.stats())
+
+@app.route('/startup_stats')
+def startup_stats():
+    return jsonify(get_startup_stats())
+
 @app.route('/process_audio', methods=['POST'])
 def process_audio():
     if 'audio' not in request.files:
         return jsonify({"error": "No audio file provided"}), 400
     
     audio_file = request.files['audio']
+    ctx = g.pipeline_context = RequestContext(
+        'process_audio', audio=audio_file.read(), mimetype=audio_file.mimetype, session_id=get_session_id()
+    )
     
     try:
-        # 保存音頻文件到臨時位置
-        temp_webm_path = "temp_audio.webm"
-        temp_wav_path = "temp_audio.wav"
-        audio_file.save(temp_webm_path)
-        
-        # 使用 ffmpeg 將 webm 轉換為 wav (通過 pydub)
+        # 解碼 -> 語音識別 -> 緩存 / Gemini -> 逐句語音合成 -> 聊天歷史
         try:
-            sound = AudioSegment.from_file(temp_webm_path, format="webm")
-            sound.export(temp_wav_path, format="wav")
-        except Exception as e:
+            audio_pipeline.run(ctx)
+        except DecoderBusyError as e:
+            return jsonify({"error": str(e)}), 503
+        except AudioDecodeError as e:
             print(f"音頻轉換錯誤: {e}")
             return jsonify({"error": f"音頻格式轉換失敗: {str(e)}"}), 500
         
-        # 使用 speech_recognition 進行語音識別
-        recognizer = sr.Recognizer()
-        
-        # 使用轉換後的 WAV 文件
-        with sr.AudioFile(temp_wav_path) as source:
-            audio_data = recognizer.record(source)
-            text = recognizer.recognize_google(
-                audio_data, 
-                language='zh-TW'
-            )
-        
-        # 檢查緩存
-        cache_key = generate_cache_key(text)
-        current_time = time.time()
-        cache_hit = False
-        
-        # 檢查緩存中是否有匹配的查詢
-        for key, cache_data in list(response_cache.items()):
-            cache_time, cache_query, cache_response = cache_data
-            
-            # 檢查緩存是否過期
-            if current_time - cache_time > CACHE_EXPIRY:
-                del response_cache[key]
-                continue
-                
-            # 檢查查詢是否相似
-            if is_similar_query(text, cache_query):
-                print(f"語音查詢使用緩存的回應: {cache_key}")
-                response_text = cache_response
-                cache_hit = True
-                break
-                
-        # 如果沒有命中緩存，使用 API
-        if not cache_hit:
-            try:
-                # 直接使用主要模型的 REST API 調用
-                response_text = call_gemini_api(text, PRIMARY_MODEL)
-                
-                # 將回應存入緩存
-                response_cache[cache_key] = (current_time, text, response_text)
-                print(f"語音查詢將回應存入緩存: {cache_key}")
-            except Exception as e:
-                error_str = str(e)
-                if "429" in error_str or "quota" in error_str.lower():
-                    print(f"主要模型 API 配額限制，嘗試備用模型: {e}")
-                    try:
-                        # 嘗試使用備用模型的 REST API
-                        response_text = call_gemini_api(text, REST_API_MODEL)
-                        print(f"成功使用備用 REST API 模型: {REST_API_MODEL}")
-                    except Exception as backup_e:
-                        # 如果 REST API 備用模型也失敗，使用 SDK 調用
-                        print(f"備用 REST API 也失敗，嘗試 SDK 調用: {backup_e}")
-                        try:
-                            response_text = call_gemini_sdk(text)
-                            print("成功使用 SDK API 調用")
-                        except Exception as sdk_e:
-                            response_text = f"很抱歉，所有 AI 服務方式都失敗。請稍後再試。錯誤詳情：{sdk_e}"
-                else:
-                    response_text = f"處理您的請求時發生錯誤：{e}"
-                    
-                # 即使使用備用模型也將有效結果存入緩存
-                if not response_text.startswith("很抱歉"):
-                    response_cache[cache_key] = (current_time, text, response_text)
-        
-        # 將回應轉換為語音 (創建新的引擎實例)
-        voice_file_path = "static/response.mp3"
-        try:
-            tts = get_tts_engine()
-            if tts:
-                tts.save_to_file(response_text, voice_file_path)
-                tts.runAndWait()
-                # 使用完畢後釋放引擎
-                del tts
-                engine = None
-        except Exception as tts_error:
-            print(f"語音合成失敗: {tts_error}")
-        
-        # 清理臨時文件
-        if os.path.exists(temp_webm_path):
-            os.remove(temp_webm_path)
-        if os.path.exists(temp_wav_path):
-            os.remove(temp_wav_path)
-        
-        # 添加到聊天歷史
-        add_to_chat_history(text, response_text)
-        
         return jsonify({
-            "input_text": text,
-            "response_text": response_text,
-            "audio_url": voice_file_path
+            "input_text": ctx.text,
+            "response_text": ctx.response_text,
+            "audio_segments": ctx.tts_job.segment_urls()
         })
     
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/audio_stream', methods=['POST'])
+def audio_stream_start():
+    stream = audio_streams.create(get_session_id())
+    return jsonify({"stream_id": stream.id, "sample_rate": STREAM_SAMPLE_RATE})
+
+@app.route('/audio_stream/<stream_id>', methods=['POST'])
+def audio_stream_feed(stream_id):
+    # 請求內容為 16 kHz 單聲道 16 位元的原始 PCM
+    stream = audio_streams.get(stream_id)
+    if stream is None:
+        return jsonify({"error": "錄音串流不存在或已過期"}), 404
+    speech_ended = audio_streams.feed(stream, request.get_data())
+    return jsonify({
+        "speech_started": stream.vad.speech_started,
+        "speech_ended": speech_ended
+    })
+
+@app.route('/audio_stream/<stream_id>/end', methods=['POST'])
+def audio_stream_end(stream_id):
+    stream = audio_streams.get(stream_id)
+    if stream is None:
+        return jsonify({"error": "錄音串流不存在或已過期"}), 404
+    audio_streams.finish(stream)
+    return jsonify({"speech_started": stream.vad.speech_started, "speech_ended": True})
+
+@app.route('/audio_stream/<stream_id>/result')
+def audio_stream_result(stream_id):
+    stream = audio_streams.pop(stream_id)
+    if stream is None:
+        return jsonify({"error": "錄音串流不存在或已過期"}), 404
+    if stream.future is None:
+        audio_streams.finish(stream)
+    
+    try:
+        result = stream.future.result(timeout=60)
+    except FutureTimeoutError:
+        return jsonify({"error": "語音識別逾時"}), 504
+    except sr.UnknownValueError:
+        return jsonify({"error": "無法識別語音內容"}), 422
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    if result is None:
+        return jsonify({"error": "未偵測到語音"}), 422
+    
+    # 聊天歷史已在識別完成時寫入
+    return jsonify(result)
+
 @app.route('/text_input', methods=['POST'])
 def text_input():
     data = request.json
     if not data or 'text' not in data:
         return jsonify({"error": "No text provided"}), 400
     
+    ctx = g.pipeline_context = RequestContext('text_input', text=data['text'], session_id=get_session_id())
     try:
-        # 檢查緩存
-        user_query = data['text']
-        cache_key = generate_cache_key(user_query)
-        current_time = time.time()
-        cache_hit = False
-        
-        # 檢查緩存中是否有匹配的查詢
-        for key, cache_data in list(response_cache.items()):
-            cache_time, cache_query, cache_response = cache_data
-            
-            # 檢查緩存是否過期
-            if current_time - cache_time > CACHE_EXPIRY:
-                del response_cache[key]
-                continue
-                
-            # 檢查查詢是否相似
-            if is_similar_query(user_query, cache_query):
-                print(f"使用緩存的回應: {cache_key}")
-                response_text = cache_response
-                cache_hit = True
-                break
-        
-        # 如果沒有命中緩存，使用 API
-        if not cache_hit:
-            try:
-                # 直接使用主要模型的 REST API 調用
-                response_text = call_gemini_api(user_query, PRIMARY_MODEL)
-                
-                # 將回應存入緩存
-                response_cache[cache_key] = (current_time, user_query, response_text)
-                print(f"將回應存入緩存: {cache_key}")
-            except Exception as e:
-                error_str = str(e)
-                if "429" in error_str or "quota" in error_str.lower():
-                    print(f"主要模型 API 配額限制，嘗試備用模型: {e}")
-                    try:
-                        # 嘗試使用備用模型的 REST API
-                        response_text = call_gemini_api(user_query, REST_API_MODEL)
-                        print(f"成功使用備用 REST API 模型: {REST_API_MODEL}")
-                    except Exception as backup_e:
-                        # 如果 REST API 備用模型也失敗，使用 SDK 調用
-                        print(f"備用 REST API 也失敗，嘗試 SDK 調用: {backup_e}")
-                        try:
-                            response_text = call_gemini_sdk(user_query)
-                            print("成功使用 SDK API 調用")
-                        except Exception as sdk_e:
-                            response_text = f"很抱歉，所有 AI 服務方式都失敗。請稍後再試。錯誤詳情：{sdk_e}"
-                else:
-                    response_text = f"處理您的請求時發生錯誤：{e}"
-                    
-                # 即使使用備用模型也將有效結果存入緩存
-                if not response_text.startswith("很抱歉"):
-                    response_cache[cache_key] = (current_time, user_query, response_text)
-        
-        # 將回應轉換為語音 (創建新的引擎實例)
-        voice_file_path = "static/response.mp3"
-        try:
-            tts = get_tts_engine()
-            if tts:
-                tts.save_to_file(response_text, voice_file_path)
-                tts.runAndWait()
-                # 使用完畢後釋放引擎
-                del tts
-                engine = None
-        except Exception as tts_error:
-            print(f"語音合成失敗: {tts_error}")
-        
-        # 添加到聊天歷史
-        add_to_chat_history(user_query, response_text)
+        # 緩存 / Gemini -> 逐句語音合成 -> 聊天歷史
+        text_pipeline.run(ctx)
         
         return jsonify({
-            "response_text": response_text,
-            "audio_url": voice_file_path
+            "response_text": ctx.response_text,
+            "audio_segments": ctx.tts_job.segment_urls()
         })
     
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# 串流回應的步驟，同步 (本模組) 與非同步 (async_app.py) 的 /text_input_stream 共用同一份邏輯：
+# 產生 ('event', SSE 事件) 交給瀏覽器；需要等待的操作以 (操作名稱, 參數...) 交給呼叫端，
+# 由 run_stream_steps (同步) 或 async_app.arun_stream_steps (非同步) 執行後把結果或異常送回
+# 操作: stage (執行管線步驟)、flight (等待相似查詢的結果)、stream (開始串流呼叫主要模型)、
+# next (串流的下一段文字，結束時為 None)、fallback (改用備用模型)、cache_put (存入緩存)
+def stream_steps(ctx):
+    tts_job = None
+    tts_seconds = 0.0
+
+    def speak(text=None):
+        # 文字片段與其中已結束的句子的語音，text 為 None 時合成最後一段未以標點結尾的文字
+        nonlocal tts_seconds
+        events = [] if text is None else [sse_event({"type": "delta", "text": text})]
+        started = time.perf_counter()
+        indices = tts_job.finish() if text is None else tts_job.add_text(text)
+        tts_seconds += time.perf_counter() - started
+        return events + [sse_event({"type": "audio", "url": tts_job.segment_url(index)}) for index in indices]
+
+    try:
+        # 每收到完整的句子就送出語音合成，讓語音與文字一起串流
+        tts_job = tts_pipeline.create_job(voice_settings)
+        # 與其他路由共用上下文與緩存步驟
+        for name in ('context', 'cache'):
+            with ctx.trace.span(name):
+                yield ('stage', name, ctx)
+
+        if ctx.cache == 'hit':
+            # 緩存命中時一次送出完整回應
+            for event in speak(ctx.response_text):
+                yield ('event', event)
+        else:
+            # 串流的模型耗時包括逐段轉送給瀏覽器的時間
+            llm_started = time.perf_counter()
+            response_text, result = yield from _stream_llm_steps(ctx, speak)
+            ctx.trace.add('llm', time.perf_counter() - llm_started)
+            if result is not None:
+                ctx.answer(response_text, result[0], model_router.fallback_depth(result[0]))
+            else:
+                ctx.model_failed = True
+                ctx.answer(response_text)
+
+        for event in speak():
+            yield ('event', event)
+        ctx.trace.add('tts', tts_seconds)
+
+        # 聊天歷史在服務器端，串流完成後仍可寫入
+        with ctx.trace.span('history'):
+            yield ('stage', 'history', ctx)
+        yield ('event', sse_event({
+            "type": "done",
+            "response_text": ctx.response_text,
+            "audio_segments": tts_job.segment_urls()
+        }))
+    except Exception as e:
+        ctx.failed_stage = 'stream'
+        yield ('event', sse_event({"type": "error", "error": str(e)}))
+    finally:
+        pipeline_metrics.record(ctx)
+
+def _stream_llm_steps(ctx, speak):
+    # 返回 (回應文字, (模型, 回應) 或失敗時的 None)
+    history = ctx.history
+    # 相似的查詢正在進行中時，等待它的完整回應，不重複呼叫模型
+    flight, leader = (None, True) if history else request_coalescer.begin(ctx.text)
+    if not leader:
+        try:
+            result = yield ('flight', flight.future)
+            response_text = result[1]
+        except ModelCallError as e:
+            result, response_text = None, f"很抱歉，所有 AI 服務方式都失敗。請稍後再試。錯誤詳情：{e}"
+        for event in speak(response_text):
+            yield ('event', event)
+        return response_text, result
+
+    result = None
+    error = None
+    try:
+        parts = []
+        # 主要模型在冷卻中時直接使用備用模型
+        if model_router.breakers[PRIMARY_MODEL].allow():
+            finished = False
+            try:
+                # 邊接收 Gemini 的串流回應邊轉送給瀏覽器
+                chunks = yield ('stream', ctx.text, history)
+                while True:
+                    chunk = yield ('next', chunks)
+                    if chunk is None:
+                        break
+                    parts.append(chunk)
+                    for event in speak(chunk):
+                        yield ('event', event)
+                model_router.record(PRIMARY_MODEL)
+                finished = True
+            except ModelCallError as e:
+                model_router.record(PRIMARY_MODEL, error=e)
+                finished = True
+                error = e
+            finally:
+                # 客戶端中途斷線 (GeneratorExit / CancelledError) 時沒有得到結果，
+                # 釋放半開狀態的試探名額，否則熔斷器會一直拒絕主要模型
+                if not finished:
+                    model_router.breakers[PRIMARY_MODEL].release()
+
+        if parts:
+            response_text = ''.join(parts)
+            # 串流中斷時保留已收到的部分，但不存入緩存
+            if error is None:
+                if not history:
+                    yield ('cache_put', ctx.text, response_text)
+                result = (PRIMARY_MODEL, response_text)
+            else:
+                print(f"串流回應中斷: {error}")
+        else:
+            print(f"主要模型無法使用，改用備用模型: {error or '冷卻中'}")
+            try:
+                result = yield ('fallback', Prompt(ctx.text, history))
+                response_text = result[1]
+                if not history:
+                    yield ('cache_put', ctx.text, response_text)
+                print(f"成功使用備用模型: {result[0]}")
+            except AllModelsFailedError as e:
+                error = e
+                response_text = f"很抱歉，所有 AI 服務方式都失敗。請稍後再試。錯誤詳情：{e}"
+            for event in speak(response_text):
+                yield ('event', event)
+    finally:
+        # 只把完整的回應交給等待中的相似查詢；失敗或中斷 (包括客戶端斷線) 時讓它們收到錯誤
+        if flight is not None and result is not None:
+            request_coalescer.end(flight, result)
+        elif flight is not None:
+            request_coalescer.end(flight, error=error or ModelCallError("串流回應中斷"))
+    return response_text, result
+
+# stream_steps 要求的操作在同步模式下的實作
+STREAM_OPERATIONS = {
+    'stage': lambda name, ctx: pipeline_stages[name].run(ctx),
+    'flight': lambda future: future.result(),
+    'stream': lambda text, history: stream_gemini_api(text, PRIMARY_MODEL, history),
+    'next': lambda chunks: next(chunks, None),
+    'fallback': lambda prompt: model_router.route(prompt, exclude=(PRIMARY_MODEL,)),
+    'cache_put': lambda query, response_text: response_cache.put(query, response_text),
+}
+
+def run_stream_steps(steps):
+    """
+    以同步的方式執行 stream_steps 要求的操作，產生 SSE 事件
+    客戶端斷線時關閉本生成器，steps 也隨之關閉 (釋放熔斷器的試探名額、結束查詢合併)
+    """
+    value, error = None, None
+    try:
+        while True:
+            try:
+                operation = steps.send(value) if error is None else steps.throw(error)
+            except StopIteration:
+                return
+            value, error = None, None
+            if operation[0] == 'event':
+                yield operation[1]
+                continue
+            try:
+                value = STREAM_OPERATIONS[operation[0]](*operation[1:])
+            except Exception as e:
+                error = e
+    finally:
+        steps.close()
+
+@app.route('/text_input_stream', methods=['POST'])
+def text_input_stream():
+    data = request.json
+    if not data or 'text' not in data:
+        return jsonify({"error": "No text provided"}), 400
+    
+    # 串流開始後無法再修改 cookie，先確定 session ID
+    session_id = get_session_id()
+    # 響應標頭在串流開始時就已送出，這裡的耗時只記錄在 /metrics，不加上 Server-Timing
+    ctx = RequestContext('text_input_stream', text=data['text'], session_id=session_id)
+    return Response(run_stream_steps(stream_steps(ctx)), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/tts/<digest>.mp3')
+def tts_audio(digest):
+    if not re.fullmatch(r'[0-9a-f]{64}', digest):
+        abort(404)
+    # 語音尚未合成完成時等待，前端可以提前請求下一段
+    try:
+        path = tts_pipeline.wait_audio(digest, timeout=30)
+    except FutureTimeoutError:
+        abort(504)
+    if path is None:
+        abort(404)
+    # 檔名由內容決定，同一個網址的內容永遠不變，可以長期緩存
+    response = send_file(os.path.abspath(path), mimetype='audio/mpeg', max_age=365 * 24 * 60 * 60)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+# 延遲初始化的重量級後端，第一次使用時才載入；設定 PREWARM=1 時在應用就緒後立即於背景預先載入，
+# 讓第一個請求不必等待 (可再加入其他需要預熱的 LazyBackend)
+PREWARM = os.environ.get("PREWARM", "0") == "1"
+# (語音識別與語音合成的後端在 create_app 建立元件時加入)
+lazy_backends = {
+    'gemini_sdk': gemini_sdk,
+    'backup_model': backup_model,
+}
+if PYAV_AVAILABLE:
+    lazy_backends['pyav'] = pyav
+if semantic_tier is not None and isinstance(getattr(semantic_tier.embedder, 'model', None), LazyBackend):
+    lazy_backends['embedding_model'] = semantic_tier.embedder.model
+prewarmer = None
+app_ready_seconds = None
+_create_lock = threading.Lock()
+
+pipeline_metrics.register_gauge('startup_seconds', "進程啟動到應用就緒的秒數", lambda: app_ready_seconds or 0)
+pipeline_metrics.register_gauge(
+    'backend_ready', "延遲初始化的後端是否已載入",
+    lambda: [({'backend': name}, int(backend.ready)) for name, backend in lazy_backends.items()]
+)
+
+# 啟動時間 (自進程啟動起的秒數) 與各後端的初始化狀態
+def get_startup_stats():
+    return {
+        'ready_seconds': app_ready_seconds,
+        'uptime_seconds': process_uptime(),
+        'prewarm': {
+            'running': prewarmer.running,
+            'finished_seconds': prewarmer.finished_at
+        } if prewarmer is not None else None,
+        'backends': {name: backend.stats() for name, backend in lazy_backends.items()}
+    }
+
+def create_app(prewarm=None):
+    """
+    應用工廠：建立含有背景執行緒或資料庫連線的元件 (語音合成、語音識別、對話記錄、批次佇列)，
+    啟動背景工作 (緩存預熱、後端預先初始化) 並返回 Flask 應用，重複呼叫時只建立一次
+    匯入本模組只建立輕量的物件，重量級的後端在第一次使用或預熱時才初始化
+    prewarm 為 None 時依環境變數 PREWARM 決定；部署時使用 gunicorn 'app:create_app()'
+    (直接使用 app:app 時由第一個請求呼叫)
+    (使用 --preload 時本函式在主進程執行，各元件的執行緒與 SQLite 連線在 worker 第一次使用時才建立)
+    """
+    global prewarmer, app_ready_seconds
+    with _create_lock:
+        if app_ready_seconds is None:
+            init_gemini_batchers()
+            init_tts()
+            init_speech_recognizer()
+            init_conversations()
+            lazy_backends['asr'] = speech_recognizer.backend.backend
+            lazy_backends['tts'] = tts_worker
+            start_cache_warmer()
+            if PREWARM if prewarm is None else prewarm:
+                prewarmer = Prewarmer(lazy_backends.values()).start()
+            app_ready_seconds = process_uptime()
+            print(f"應用就緒: 進程啟動後 {app_ready_seconds:.2f} 秒")
+    return app
+
+# 直接使用模組層級的 app 時 (flask --app app run、gunicorn app:app) 沒有呼叫 create_app，
+# 在第一個請求時建立元件
+@app.before_request
+def ensure_app_created():
+    if app_ready_seconds is None:
+        create_app()
+
 if __name__ == '__main__':
     os.makedirs("static", exist_ok=True)
-    app.run(debug=True)
+    create_app().run(debug=True)
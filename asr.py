@@ -0,0 +1,314 @@
+import importlib.util
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import speech_recognition as sr
+
+from audio import TARGET_SAMPLE_RATE, TARGET_SAMPLE_WIDTH
+from startup import LazyBackend
+from utils import PerProcess, percentile
+
+# 離線模型的套件 (以及 faster-whisper 需要的 numpy) 匯入很慢，這裡只檢查是否安裝，
+# 在 LazyRecognizer 第一次建立後端 (或預熱) 時才匯入
+VOSK_AVAILABLE = importlib.util.find_spec('vosk') is not None
+FASTER_WHISPER_AVAILABLE = importlib.util.find_spec('faster_whisper') is not None
+
+
+class SpeechRecognizer:
+    """
+    語音識別後端的共同介面
+    recognize 接收 sr.AudioData 並返回識別出的文字，聽不出任何內容時拋出 sr.UnknownValueError；
+    recognize_batch 一次處理多段音頻，返回與輸入順序相同的列表，每一項是文字或該段的異常；
+    預設只是逐段呼叫 recognize，真正以一次推論處理整批音頻的後端覆寫它並設定 batched_inference = True
+    """
+    name = None
+    batched_inference = False
+
+    def recognize(self, audio_data):
+        raise NotImplementedError
+
+    def recognize_batch(self, audios):
+        results = []
+        for audio_data in audios:
+            try:
+                results.append(self.recognize(audio_data))
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+class GoogleRecognizer(SpeechRecognizer):
+    """
+    Google 線上語音識別 (原本的做法)，每次識別都需要一次網路往返
+    """
+    name = 'google'
+
+    def __init__(self, language='zh-TW'):
+        self.language = language
+
+    def recognize(self, audio_data):
+        return sr.Recognizer().recognize_google(audio_data, language=self.language)
+
+
+def _pcm16(audio_data):
+    return audio_data.get_raw_data(convert_rate=TARGET_SAMPLE_RATE, convert_width=TARGET_SAMPLE_WIDTH)
+
+
+class VoskRecognizer(SpeechRecognizer):
+    """
+    Vosk 離線語音識別
+    模型只在建立時載入一次並由所有請求共用，每段音頻建立各自的 KaldiRecognizer
+    """
+    name = 'vosk'
+
+    def __init__(self, model_path):
+        if not VOSK_AVAILABLE:
+            raise RuntimeError("使用 Vosk 需要先安裝 vosk: pip install vosk")
+        import vosk
+        vosk.SetLogLevel(-1)
+        self._vosk = vosk
+        self._model = vosk.Model(model_path)
+
+    def recognize(self, audio_data):
+        recognizer = self._vosk.KaldiRecognizer(self._model, TARGET_SAMPLE_RATE)
+        recognizer.AcceptWaveform(_pcm16(audio_data))
+        text = json.loads(recognizer.FinalResult()).get('text', '')
+        # 中文模型以空格分隔每個詞
+        text = text.replace(' ', '')
+        if not text:
+            raise sr.UnknownValueError()
+        return text
+
+
+class FasterWhisperRecognizer(SpeechRecognizer):
+    """
+    faster-whisper 離線語音識別 (CTranslate2，CPU 上預設使用 int8 量化)
+    模型只載入一次；num_workers 大於 1 時允許多個執行緒同時使用同一個模型
+    同時到達的短音頻 (不超過 30 秒的一句話) 以一次編碼與解碼處理 (batched_inference)
+    """
+    name = 'faster-whisper'
+    batched_inference = True
+    # Whisper 的輸入固定為 30 秒，較短的音頻補零後可以疊成一批
+    CHUNK_SECONDS = 30
+    MAX_LENGTH = 448
+
+    def __init__(self, model_size='small', language='zh', compute_type='int8', cpu_threads=0, num_workers=1,
+                 beam_size=1, initial_prompt="以下是繁體中文的句子。"):
+        if not FASTER_WHISPER_AVAILABLE:
+            raise RuntimeError("使用 faster-whisper 需要先安裝 faster-whisper: pip install faster-whisper")
+        from faster_whisper import WhisperModel
+        from faster_whisper.tokenizer import Tokenizer
+        import numpy as np
+        self._np = np
+        self.language = language
+        self.beam_size = beam_size
+        # Whisper 常輸出簡體中文，以繁體的提示詞引導輸出繁體
+        self.initial_prompt = initial_prompt
+        self._model = WhisperModel(model_size, device='cpu', compute_type=compute_type,
+                                   cpu_threads=cpu_threads, num_workers=num_workers)
+        # 批次解碼的提示：與 transcribe 相同，提示詞放在 <|startofprev|> 之後，不輸出時間戳記
+        self._tokenizer = Tokenizer(self._model.hf_tokenizer, self._model.model.is_multilingual,
+                                    task='transcribe', language=language)
+        prompt = []
+        if initial_prompt:
+            prompt = [self._tokenizer.sot_prev] + self._tokenizer.encode(" " + initial_prompt.strip())
+        self._batch_prompt = prompt + list(self._tokenizer.sot_sequence) + [self._tokenizer.no_timestamps]
+
+    def _samples(self, audio_data):
+        np = self._np
+        return np.frombuffer(_pcm16(audio_data), dtype=np.int16).astype(np.float32) / 32768.0
+
+    def recognize(self, audio_data):
+        return self._transcribe(self._samples(audio_data))
+
+    def _transcribe(self, samples):
+        segments, _ = self._model.transcribe(
+            samples,
+            language=self.language,
+            beam_size=self.beam_size,
+            initial_prompt=self.initial_prompt,
+            condition_on_previous_text=False
+        )
+        text = ''.join(segment.text for segment in segments).strip()
+        if not text:
+            raise sr.UnknownValueError()
+        return text
+
+    def recognize_batch(self, audios):
+        """
+        各段音頻補零到 30 秒後疊成 (段數, 梅爾頻帶, 幀數) 的特徵，以一次編碼器推論與一次批次解碼處理；
+        超過 30 秒的音頻需要切分，仍以 transcribe 逐段識別
+        """
+        np = self._np
+        chunk = self.CHUNK_SECONDS * TARGET_SAMPLE_RATE
+        results = [None] * len(audios)
+        short = []
+        for index, audio_data in enumerate(audios):
+            samples = self._samples(audio_data)
+            if len(samples) <= chunk:
+                short.append((index, np.pad(samples, (0, chunk - len(samples)))))
+                continue
+            try:
+                results[index] = self._transcribe(samples)
+            except Exception as e:
+                results[index] = e
+        if short:
+            extractor = self._model.feature_extractor
+            frames = chunk // extractor.hop_length
+            features = np.stack([extractor(samples)[:, :frames] for _, samples in short])
+            outputs = self._model.model.generate(
+                self._model.encode(features),
+                [self._batch_prompt] * len(short),
+                beam_size=self.beam_size,
+                max_length=self.MAX_LENGTH
+            )
+            for (index, _), output in zip(short, outputs):
+                text = self._tokenizer.decode(output.sequences_ids[0]).strip()
+                results[index] = text if text else sr.UnknownValueError()
+        return results
+
+
+class LazyRecognizer(SpeechRecognizer):
+    """
+    第一次識別 (或預熱) 時才由 factory 建立實際的後端，離線模型的載入不延遲服務啟動
+    """
+    def __init__(self, name, factory):
+        self.name = name
+        self.backend = LazyBackend(f"語音識別後端 {name}", factory)
+
+    def recognize(self, audio_data):
+        return self.backend.get().recognize(audio_data)
+
+    def recognize_batch(self, audios):
+        return self.backend.get().recognize_batch(audios)
+
+    @property
+    def batched_inference(self):
+        # 後端載入之前無法得知，先逐段處理
+        return self.backend.ready and self.backend.get().batched_inference
+
+
+def create_recognizer(backend='google', language='zh-TW', model_path=None, model_size='small', num_workers=1):
+    """
+    依名稱建立語音識別後端：google / vosk / faster-whisper
+    """
+    if backend == 'google':
+        return GoogleRecognizer(language=language)
+    if backend == 'vosk':
+        if not model_path:
+            raise ValueError("使用 Vosk 需要設定模型路徑 (ASR_MODEL_PATH)")
+        return VoskRecognizer(model_path)
+    if backend in ('faster-whisper', 'whisper'):
+        return FasterWhisperRecognizer(model_path or model_size, language=language.split('-')[0],
+                                       num_workers=num_workers)
+    raise ValueError(f"未知的語音識別後端: {backend}")
+
+
+class BatchingRecognizer(PerProcess):
+    """
+    共用一個識別後端並合併同時到達的語音
+    請求放入佇列後由固定數量的執行緒處理，同時使用模型的執行緒不會超過 workers 個
+    - 後端支援批次推論 (batched_inference) 時，每個執行緒取出第一段音頻後最多再等待 max_wait 秒，
+      收集其他同時到達的音頻 (最多 max_batch 段)，以一次 recognize_batch 處理
+    - 其他後端的 recognize_batch 只是逐段識別，合併只會讓先完成的音頻等待整批結束，
+      因此每次只取一段，識別完成後立即返回結果
+    執行緒在第一次識別時才啟動 (見 PerProcess)
+    """
+    def __init__(self, backend, workers=1, max_batch=8, max_wait=0.01, latency_window=200):
+        PerProcess.__init__(self)
+        self.backend = backend
+        self.workers = workers
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=latency_window)
+        self.recognized = 0
+        self.failed = 0
+        self.batches = 0
+        self._threads = []
+
+    def _start_process(self, forked):
+        self._queue = queue.Queue()
+        self._threads = [
+            threading.Thread(target=self._run, args=(self._queue,), name=f"asr-worker-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+        return self._queue
+
+    @property
+    def name(self):
+        return self.backend.name
+
+    def submit(self, audio_data):
+        future = Future()
+        self._per_process().put((audio_data, future, time.perf_counter()))
+        return future
+
+    def recognize(self, audio_data, timeout=None):
+        """
+        識別一段音頻，會阻塞直到完成
+        """
+        return self.submit(audio_data).result(timeout=timeout)
+
+    def _collect(self, jobs, max_batch):
+        batch = [jobs.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(jobs.get(timeout=remaining) if remaining > 0 else jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, jobs):
+        while True:
+            batched = self.backend.batched_inference
+            batch = [item for item in self._collect(jobs, self.max_batch if batched else 1)
+                     if item[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                if batched:
+                    results = self.backend.recognize_batch([audio_data for audio_data, _, _ in batch])
+                else:
+                    results = [self.backend.recognize(batch[0][0])]
+            except Exception as e:
+                results = [e] * len(batch)
+            now = time.perf_counter()
+            with self._lock:
+                self.batches += 1
+                for (_, future, submitted_at), result in zip(batch, results):
+                    self._latencies.append(now - submitted_at)
+                    if isinstance(result, Exception):
+                        self.failed += 1
+                    else:
+                        self.recognized += 1
+            for (_, future, _), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            processed = self.recognized + self.failed
+            return {
+                'backend': self.backend.name,
+                'workers': self.workers,
+                'queue_depth': self._queue.qsize(),
+                'recognized': self.recognized,
+                'failed': self.failed,
+                'batches': self.batches,
+                'avg_batch_size': processed / self.batches if self.batches else 0.0,
+                'latency_ms_p50': percentile(latencies, 0.5) * 1000,
+                'latency_ms_p95': percentile(latencies, 0.95) * 1000,
+            }
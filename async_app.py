@@ -0,0 +1,434 @@
+"""
+非同步 (ASGI) 服務模式
+與 app.py 提供相同的路由，但以 Quart 在 asyncio 事件迴圈上處理請求：
+- 呼叫 Gemini 使用 httpx.AsyncClient，等待回應時不佔用執行緒
+- 音頻解碼、語音識別與語音合成原本就在各自的執行緒池中執行，這裡直接 await 它們的 Future
+- 其他 CPU 密集的步驟 (例如 VAD) 交給執行緒池
+因此同時進行中的對話數量不再受限於 Web 伺服器的執行緒數量
+
+緩存、語音合成管線、解碼池等元件與 app.py 共用同一份設定 (環境變數)
+
+用法 (需要 pip install quart httpx hypercorn):
+    hypercorn 'async_app:create_app()' --bind 127.0.0.1:5000
+"""
+import asyncio
+import os
+import re
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import requests
+import speech_recognition as sr
+from quart import Quart, render_template, request, jsonify, session, Response, send_file, abort, g
+
+from app import (
+    PRIMARY_MODEL, REST_API_MODEL, BACKUP_MODEL, STREAM_SAMPLE_RATE,
+    gemini_request, parse_gemini_response, parse_sse_line,
+    get_chat_history, get_session_id, CHAT_HISTORY_PAGE_SIZE,
+    response_cache, voice_settings, audio_decoder, audio_streams, model_router,
+    rate_limiters, request_coalescer, gemini_batchers,
+    SERVER_TIMING, pipeline_metrics, pipeline_stages, answer_pipeline, text_pipeline, audio_pipeline, stream_steps
+)
+from audio import AudioDecodeError, DecoderBusyError
+from conversation_context import Prompt, contents_text, user_content
+from http_client import AsyncPooledHTTPClient
+from model_router import ModelCallError, RateLimitError, is_rate_limit
+from pipeline import RequestContext
+from utils import generate_cache_key
+# 含有背景執行緒的元件由 create_app 建立，使用時透過模組讀取
+import app as sync_app
+
+# 非同步模式下等待 Gemini 不佔用執行緒，連線池可以設得比同步模式大
+async_gemini_http = AsyncPooledHTTPClient(
+    pool_size=int(os.environ.get("ASYNC_GEMINI_POOL_SIZE", 200)),
+    connect_timeout=float(os.environ.get("GEMINI_CONNECT_TIMEOUT", 3.05)),
+    read_timeout=float(os.environ.get("GEMINI_READ_TIMEOUT", 10))
+)
+
+# 使用 REST API 方式呼叫 Gemini
+async def call_gemini_api(text, model_name=PRIMARY_MODEL, history=None):
+    url, headers, data = gemini_request(text, model_name, history=history)
+
+    async with rate_limiters.alimit(model_name, contents_text(data["contents"])) as usage:
+        print(f"調用 REST API: {model_name}")
+        try:
+            response = await async_gemini_http.post(url, headers=headers, json=data)
+        except requests.exceptions.RequestException as e:
+            print(f"REST API 請求異常: {e}")
+            raise ModelCallError(f"REST API 請求失敗: {e}") from e
+        response_text = parse_gemini_response(response)
+        usage.add(response_text)
+        return response_text
+
+# 使用 REST API 串流方式呼叫 Gemini，逐段產生文字
+async def stream_gemini_api(text, model_name=PRIMARY_MODEL, history=None):
+    url, headers, data = gemini_request(text, model_name, stream=True, history=history)
+
+    async with rate_limiters.alimit(model_name, contents_text(data["contents"])) as usage:
+        print(f"串流調用 REST API: {model_name}")
+        try:
+            async with async_gemini_http.stream(url, headers=headers, json=data) as response:
+                print(f"REST API 響應狀態碼: {response.status_code}")
+                if response.status_code == 429:
+                    # 如果是配額限制，拋出異常以觸發備用邏輯
+                    raise RateLimitError(f"API 配額限制: {response.status_code}")
+                if response.status_code != 200:
+                    print(f"API 調用失敗: 狀態碼 {response.status_code}")
+                    raise ModelCallError(f"API 調用失敗: {response.status_code} {await response.aread_text()}")
+
+                async for line in response.aiter_lines():
+                    for text_part in parse_sse_line(line):
+                        usage.add(text_part)
+                        yield text_part
+        except requests.exceptions.RequestException as e:
+            print(f"REST API 串流請求異常: {e}")
+            raise ModelCallError(f"REST API 請求失敗: {e}") from e
+
+# 使用 SDK 方式呼叫 Gemini (最後備用)
+async def call_gemini_sdk(text, history=None):
+    contents = list(history or []) + [user_content(text)]
+    try:
+        async with rate_limiters.alimit(BACKUP_MODEL, contents_text(contents)) as usage:
+            response = await sync_app.backup_model.get().generate_content_async(contents)
+            usage.add(response.text)
+            return response.text
+    except ModelCallError:
+        raise
+    except Exception as e:
+        print(f"SDK API 調用失敗: {e}")
+        error_class = RateLimitError if is_rate_limit(e) else ModelCallError
+        raise error_class(f"SDK API 調用失敗: {e}") from e
+
+# 呼叫 REST API 模型，啟用批次處理時放入與同步模式共用的批次佇列 (批次在執行緒中以同步的連線池送出)
+# 請求被取消 (落後的對沖請求) 時若仍在佇列中就不會送出；帶有上下文的請求無法合併，直接呼叫
+async def call_gemini_batched(text, model_name=PRIMARY_MODEL, history=None):
+    batcher = gemini_batchers.get(model_name)
+    if batcher is None or history:
+        return await call_gemini_api(text, model_name, history=history)
+    return await asyncio.wrap_future(batcher.submit(text))
+
+# 與同步模式共用同一個模型備援策略 (熔斷器與延遲統計)，非同步模式下落後的請求會被取消
+model_router.async_models = [
+    (PRIMARY_MODEL, lambda prompt: call_gemini_batched(prompt.text, PRIMARY_MODEL, prompt.history)),
+    (REST_API_MODEL, lambda prompt: call_gemini_batched(prompt.text, REST_API_MODEL, prompt.history)),
+    (BACKUP_MODEL, lambda prompt: call_gemini_sdk(prompt.text, prompt.history)),
+]
+
+# 未命中緩存時呼叫模型，並在結束同時查詢的合併之前存入緩存
+async def fetch_response(user_query):
+    model_name, response_text = await model_router.aroute(Prompt(user_query, []))
+    # 存入緩存時可能需要計算句向量，交給執行緒池
+    await asyncio.to_thread(response_cache.put, user_query, response_text)
+    print(f"使用模型 {model_name} 的回應，存入緩存: {generate_cache_key(user_query)}")
+    return model_name, response_text
+
+# 與同步模式共用同一組管線與統計，需要等待的步驟改為 await 執行緒池的 Future 或非同步的模型呼叫
+async def decode_stage(ctx):
+    ctx.audio = await asyncio.wrap_future(audio_decoder.submit(ctx.audio, ctx.mimetype))
+
+async def asr_stage(ctx):
+    ctx.text = await asyncio.wrap_future(sync_app.speech_recognizer.submit(ctx.audio))
+
+async def llm_stage(ctx):
+    try:
+        if ctx.history:
+            model_name, response_text = await model_router.aroute(Prompt(ctx.text, ctx.history))
+        else:
+            model_name, response_text = await request_coalescer.ado(ctx.text, fetch_response)
+    except ModelCallError as e:
+        # 錯誤訊息不存入緩存
+        ctx.model_failed = True
+        ctx.answer(f"很抱歉，所有 AI 服務方式都失敗。請稍後再試。錯誤詳情：{e}")
+        return
+    ctx.answer(response_text, model_name, model_router.fallback_depth(model_name))
+
+# 讀取上下文與寫入聊天歷史 (SQLite)、緩存查找 (與共享存儲同步、計算句向量，第一次使用時還要載入模型)
+# 都會阻塞，在執行緒池中執行同步版本的步驟，不阻塞事件迴圈
+def threaded_stage(run):
+    async def arun(ctx):
+        await asyncio.to_thread(run, ctx)
+    return arun
+
+pipeline_stages['decode'].arun = decode_stage
+pipeline_stages['asr'].arun = asr_stage
+pipeline_stages['llm'].arun = llm_stage
+for name in ('context', 'cache', 'history'):
+    pipeline_stages[name].arun = threaded_stage(pipeline_stages[name].run)
+
+# 取得查詢的回應 (不合成語音、不寫入聊天歷史)
+async def get_response(user_query, session_id=None):
+    ctx = await answer_pipeline.arun(RequestContext('get_response', text=user_query, session_id=session_id))
+    return ctx.response_text
+
+app = Quart(__name__)
+app.secret_key = sync_app.app.secret_key
+
+# 聊天歷史的讀取與舊版 cookie 歷史的轉存都是 SQLite 操作，交給執行緒池，不阻塞事件迴圈
+async def aget_session_id():
+    return await asyncio.to_thread(get_session_id, session._get_current_object())
+
+async def aget_chat_history(before=None, limit=CHAT_HISTORY_PAGE_SIZE):
+    return await asyncio.to_thread(get_chat_history, session._get_current_object(), before=before, limit=limit)
+
+@app.route('/')
+async def index():
+    chat_history, history_before = await aget_chat_history()
+    return await render_template('index.html', chat_history=chat_history, history_before=history_before)
+
+@app.route('/chat_history')
+async def chat_history_page():
+    before = request.args.get('before', type=int)
+    limit = min(request.args.get('limit', CHAT_HISTORY_PAGE_SIZE, type=int), 100)
+    turns, next_before = await aget_chat_history(before=before, limit=limit)
+    return jsonify({"turns": turns, "before": next_before})
+
+@app.route('/update_voice_settings', methods=['POST'])
+async def update_voice_settings():
+    data = await request.get_json()
+    if not data:
+        return jsonify({"error": "No settings provided"}), 400
+
+    try:
+        voice_settings['volume'] = float(data.get('volume', 1.0))
+        voice_settings['rate'] = float(data.get('rate', 1.0))
+        voice_settings['pitch'] = float(data.get('pitch', 1.0))
+        return jsonify({"success": True, "settings": voice_settings})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/cache_stats')
+async def cache_stats():
+    stats = response_cache.stats()
+    stats['audio'] = sync_app.tts_audio_cache.stats()
+    if sync_app.cache_warmer is not None:
+        stats['warming'] = sync_app.cache_warmer.stats()
+    return jsonify(stats)
+
+@app.route('/model_stats')
+async def model_stats():
+    stats = model_router.stats()
+    stats['rate_limits'] = rate_limiters.stats()
+    stats['coalescing'] = request_coalescer.stats()
+    stats['batching'] = {model: batcher.stats() for model, batcher in gemini_batchers.items()}
+    stats['context'] = sync_app.conversation_context.stats()
+    return jsonify(stats)
+
+@app.route('/pipeline_stats')
+async def pipeline_stats():
+    return jsonify({
+        'stages': pipeline_metrics.stage_stats(),
+        'cache_hit_ratio': pipeline_metrics.cache_hit_ratio()
+    })
+
+@app.route('/metrics')
+async def metrics():
+    return Response(pipeline_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.after_request
+async def add_server_timing(response):
+    ctx = g.get('pipeline_context')
+    if SERVER_TIMING and ctx is not None:
+        response.headers['Server-Timing'] = ctx.server_timing()
+    return response
+
+@app.route('/decoder_stats')
+async def decoder_stats():
+    return jsonify(audio_decoder.stats())
+
+@app.route('/asr_stats')
+async def asr_stats():
+    return jsonify(sync_app.speech_recognizer.stats())
+
+@app.route('/startup_stats')
+async def startup_stats():
+    return jsonify(sync_app.get_startup_stats())
+
+@app.route('/process_audio', methods=['POST'])
+async def process_audio():
+    files = await request.files
+    if 'audio' not in files:
+        return jsonify({"error": "No audio file provided"}), 400
+
+    audio_file = files['audio']
+    ctx = g.pipeline_context = RequestContext(
+        'process_audio', audio=audio_file.read(), mimetype=audio_file.mimetype, session_id=await aget_session_id()
+    )
+
+    try:
+        # 解碼與語音識別都在各自的執行緒池中執行，這裡只等待結果
+        try:
+            await audio_pipeline.arun(ctx)
+        except DecoderBusyError as e:
+            return jsonify({"error": str(e)}), 503
+        except AudioDecodeError as e:
+            print(f"音頻轉換錯誤: {e}")
+            return jsonify({"error": f"音頻格式轉換失敗: {str(e)}"}), 500
+
+        return jsonify({
+            "input_text": ctx.text,
+            "response_text": ctx.response_text,
+            "audio_segments": ctx.tts_job.segment_urls()
+        })
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/audio_stream', methods=['POST'])
+async def audio_stream_start():
+    stream = audio_streams.create(await aget_session_id())
+    return jsonify({"stream_id": stream.id, "sample_rate": STREAM_SAMPLE_RATE})
+
+@app.route('/audio_stream/<stream_id>', methods=['POST'])
+async def audio_stream_feed(stream_id):
+    stream = audio_streams.get(stream_id)
+    if stream is None:
+        return jsonify({"error": "錄音串流不存在或已過期"}), 404
+    # VAD 逐幀計算能量，交給執行緒池以免阻塞事件迴圈
+    speech_ended = await asyncio.to_thread(audio_streams.feed, stream, await request.get_data())
+    return jsonify({
+        "speech_started": stream.vad.speech_started,
+        "speech_ended": speech_ended
+    })
+
+@app.route('/audio_stream/<stream_id>/end', methods=['POST'])
+async def audio_stream_end(stream_id):
+    stream = audio_streams.get(stream_id)
+    if stream is None:
+        return jsonify({"error": "錄音串流不存在或已過期"}), 404
+    audio_streams.finish(stream)
+    return jsonify({"speech_started": stream.vad.speech_started, "speech_ended": True})
+
+@app.route('/audio_stream/<stream_id>/result')
+async def audio_stream_result(stream_id):
+    stream = audio_streams.pop(stream_id)
+    if stream is None:
+        return jsonify({"error": "錄音串流不存在或已過期"}), 404
+    if stream.future is None:
+        audio_streams.finish(stream)
+
+    try:
+        result = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(stream.future)), timeout=60)
+    except asyncio.TimeoutError:
+        return jsonify({"error": "語音識別逾時"}), 504
+    except sr.UnknownValueError:
+        return jsonify({"error": "無法識別語音內容"}), 422
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    if result is None:
+        return jsonify({"error": "未偵測到語音"}), 422
+
+    # 聊天歷史已在識別完成時寫入
+    return jsonify(result)
+
+@app.route('/text_input', methods=['POST'])
+async def text_input():
+    data = await request.get_json()
+    if not data or 'text' not in data:
+        return jsonify({"error": "No text provided"}), 400
+
+    ctx = g.pipeline_context = RequestContext('text_input', text=data['text'], session_id=await aget_session_id())
+    try:
+        await text_pipeline.arun(ctx)
+
+        return jsonify({
+            "response_text": ctx.response_text,
+            "audio_segments": ctx.tts_job.segment_urls()
+        })
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# app.stream_steps 要求的操作在非同步模式下的實作，需要等待的操作不佔用事件迴圈
+async def _open_stream(text, history):
+    return stream_gemini_api(text, PRIMARY_MODEL, history)
+
+async def _next_chunk(chunks):
+    try:
+        return await chunks.__anext__()
+    except StopAsyncIteration:
+        return None
+
+STREAM_OPERATIONS = {
+    'stage': lambda name, ctx: pipeline_stages[name].arun(ctx),
+    'flight': lambda future: asyncio.shield(asyncio.wrap_future(future)),
+    'stream': _open_stream,
+    'next': _next_chunk,
+    'fallback': lambda prompt: model_router.aroute(prompt, exclude=(PRIMARY_MODEL,)),
+    'cache_put': lambda query, response_text: asyncio.to_thread(response_cache.put, query, response_text),
+}
+
+async def arun_stream_steps(steps):
+    """
+    run_stream_steps 的非同步版本，各操作的結果以 await 取得
+    """
+    value, error = None, None
+    try:
+        while True:
+            try:
+                operation = steps.send(value) if error is None else steps.throw(error)
+            except StopIteration:
+                return
+            value, error = None, None
+            if operation[0] == 'event':
+                yield operation[1]
+                continue
+            try:
+                value = await STREAM_OPERATIONS[operation[0]](*operation[1:])
+            except Exception as e:
+                error = e
+    finally:
+        steps.close()
+
+@app.route('/text_input_stream', methods=['POST'])
+async def text_input_stream():
+    data = await request.get_json()
+    if not data or 'text' not in data:
+        return jsonify({"error": "No text provided"}), 400
+
+    # 串流開始後無法再修改 cookie，先確定 session ID
+    session_id = await aget_session_id()
+    ctx = RequestContext('text_input_stream', text=data['text'], session_id=session_id)
+    return Response(arun_stream_steps(stream_steps(ctx)), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/tts/<digest>.mp3')
+async def tts_audio(digest):
+    if not re.fullmatch(r'[0-9a-f]{64}', digest):
+        abort(404)
+    # 語音尚未合成完成時等待 TTS 執行緒，不佔用事件迴圈
+    # 以 shield 包住，逾時時不會取消其他請求也在等待的合成工作
+    future = sync_app.tts_pipeline.pending(digest)
+    if future is not None:
+        try:
+            path = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=30)
+        except asyncio.TimeoutError:
+            abort(504)
+    else:
+        # 其他 worker 進程可能正在合成 (磁碟上只有暫存檔)，在執行緒中輪詢
+        try:
+            path = await asyncio.to_thread(sync_app.tts_pipeline.wait_audio, digest, 30)
+        except FutureTimeoutError:
+            abort(504)
+    if path is None:
+        abort(404)
+    response = await send_file(os.path.abspath(path), mimetype='audio/mpeg')
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+def create_app(prewarm=None):
+    """
+    應用工廠：與 app.create_app 相同，啟動共用元件的背景工作後返回 Quart 應用
+    用法: hypercorn 'async_app:create_app()'
+    """
+    sync_app.create_app(prewarm)
+    return app
+
+# 直接使用 async_app:app 時，在第一個請求時建立共用元件
+@app.before_request
+async def ensure_app_created():
+    if sync_app.app_ready_seconds is None:
+        await asyncio.to_thread(sync_app.create_app)
+
+if __name__ == '__main__':
+    create_app().run()
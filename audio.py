@@ -0,0 +1,227 @@
+import importlib.util
+import io
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import speech_recognition as sr
+
+from startup import LazyBackend, BackendUnavailableError
+from utils import percentile
+
+# PyAV 連帶載入 ffmpeg 的函式庫，只檢查是否安裝，第一次解碼 (或預熱) 時才匯入
+PYAV_AVAILABLE = importlib.util.find_spec('av') is not None
+
+
+def _import_pyav():
+    import av
+    return av
+
+
+pyav = LazyBackend("PyAV", _import_pyav)
+
+# 語音識別使用的 PCM 格式：16 kHz、單聲道、16 位元
+TARGET_SAMPLE_RATE = 16000
+TARGET_SAMPLE_WIDTH = 2
+
+# MP4 的索引 (moov) 通常在檔案結尾，ffmpeg 無法從管道讀取，需要寫入可 seek 的臨時檔
+_SEEKABLE_FORMATS = ('mp4', 'm4a', 'quicktime')
+
+
+class AudioDecodeError(Exception):
+    pass
+
+
+class DecoderBusyError(Exception):
+    pass
+
+
+def is_wav(data):
+    return len(data) >= 12 and data[:4] == b'RIFF' and data[8:12] == b'WAVE'
+
+
+def _pcm_rate(content_type):
+    """
+    解析 audio/l16;rate=16000 或 audio/pcm;rate=16000 之類的 MIME 類型，非原始 PCM 時返回 None
+    """
+    if not content_type:
+        return None
+    parts = [part.strip().lower() for part in content_type.split(';')]
+    if parts[0] not in ('audio/l16', 'audio/pcm'):
+        return None
+    for part in parts[1:]:
+        if part.startswith('rate='):
+            return int(part[len('rate='):])
+    return TARGET_SAMPLE_RATE
+
+
+def decode_audio(data, content_type=None, use_pyav=PYAV_AVAILABLE):
+    """
+    將上傳的音頻位元組轉換為 sr.AudioData，不經過磁碟
+    - WAV 與原始 PCM 直接使用，不需要轉碼
+    - 其他格式 (webm / ogg 等) 在安裝了 PyAV 時於進程內解碼，
+      否則透過管道交給 ffmpeg，從標準輸出讀取 16 kHz 單聲道 PCM
+    """
+    if is_wav(data):
+        with sr.AudioFile(io.BytesIO(data)) as source:
+            return sr.Recognizer().record(source)
+
+    rate = _pcm_rate(content_type)
+    if rate is not None:
+        return sr.AudioData(data, rate, TARGET_SAMPLE_WIDTH)
+
+    pcm = decode_with_pyav(data) if use_pyav else transcode_to_pcm(data, content_type)
+    return sr.AudioData(pcm, TARGET_SAMPLE_RATE, TARGET_SAMPLE_WIDTH)
+
+
+def decode_with_pyav(data):
+    """
+    使用 PyAV (ffmpeg 函式庫) 在進程內解碼並重新取樣為 16 kHz 單聲道 16 位元 PCM
+    不需要啟動 ffmpeg 進程，解碼期間會釋放 GIL
+    """
+    try:
+        av = pyav.get()
+    except BackendUnavailableError as e:
+        raise AudioDecodeError(str(e)) from e
+    chunks = []
+    try:
+        with av.open(io.BytesIO(data)) as container:
+            if not container.streams.audio:
+                raise AudioDecodeError("上傳的檔案中沒有音頻")
+            resampler = av.AudioResampler(format='s16', layout='mono', rate=TARGET_SAMPLE_RATE)
+            for frame in container.decode(container.streams.audio[0]):
+                chunks.extend(_frame_bytes(resampled) for resampled in resampler.resample(frame))
+            # 取出重新取樣器中剩餘的資料
+            chunks.extend(_frame_bytes(resampled) for resampled in resampler.resample(None))
+    except av.FFmpegError as e:
+        raise AudioDecodeError(str(e)) from e
+    if not chunks:
+        raise AudioDecodeError("無法解碼任何音頻")
+    return b''.join(chunks)
+
+
+def _frame_bytes(frame):
+    # 單聲道 s16 為單一平面，平面緩衝區可能有對齊用的填充位元組
+    return bytes(frame.planes[0])[:frame.samples * TARGET_SAMPLE_WIDTH]
+
+
+def transcode_to_pcm(data, content_type=None):
+    """
+    使用 ffmpeg 將任意格式的音頻轉換為 16 kHz 單聲道 16 位元 PCM
+    """
+    output_args = ['-f', 's16le', '-ac', '1', '-ar', str(TARGET_SAMPLE_RATE), 'pipe:1']
+    if content_type and any(fmt in content_type for fmt in _SEEKABLE_FORMATS):
+        with tempfile.NamedTemporaryFile(suffix='.mp4', delete=False) as f:
+            f.write(data)
+            temp_path = f.name
+        try:
+            return _run_ffmpeg(['-i', temp_path] + output_args, None)
+        finally:
+            os.remove(temp_path)
+    return _run_ffmpeg(['-i', 'pipe:0'] + output_args, data)
+
+
+def _run_ffmpeg(args, input_data):
+    command = ['ffmpeg', '-hide_banner', '-loglevel', 'error']
+    if input_data is None:
+        command.append('-nostdin')
+    try:
+        result = subprocess.run(
+            command + args,
+            input=input_data,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=False
+        )
+    except OSError as e:
+        raise AudioDecodeError(f"無法執行 ffmpeg: {e}") from e
+    if result.returncode != 0 or not result.stdout:
+        raise AudioDecodeError(result.stderr.decode('utf-8', errors='replace').strip() or "ffmpeg 沒有輸出任何音頻")
+    return result.stdout
+
+
+class AudioDecoderPool:
+    """
+    常駐的音頻解碼執行緒池
+    - 安裝了 PyAV 時於進程內解碼，省去每次啟動 ffmpeg 進程的成本
+    - 等待中的工作數量有上限，佇列已滿時立即拋出 DecoderBusyError 而不是無限排隊
+    - 記錄佇列深度與解碼延遲
+    """
+    def __init__(self, workers=None, max_queue=32, use_pyav=PYAV_AVAILABLE, latency_window=200):
+        self.workers = workers or os.cpu_count() or 2
+        self.max_queue = max_queue
+        self.use_pyav = use_pyav
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="audio-decoder")
+        self._slots = threading.BoundedSemaphore(self.workers + max_queue)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._active = 0
+        self._latencies = deque(maxlen=latency_window)
+        self.decoded = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def decode(self, data, content_type=None, timeout=None):
+        """
+        在解碼池中將音頻轉換為 sr.AudioData，會阻塞直到解碼完成
+        """
+        return self.submit(data, content_type).result(timeout=timeout)
+
+    def submit(self, data, content_type=None):
+        """
+        將解碼工作交給解碼池，返回結果為 sr.AudioData 的 Future
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise DecoderBusyError("音頻解碼佇列已滿，請稍後再試")
+        with self._lock:
+            self._queued += 1
+        try:
+            future = self._executor.submit(self._decode, data, content_type)
+        except Exception:
+            with self._lock:
+                self._queued -= 1
+            self._slots.release()
+            raise
+        return future
+
+    def _decode(self, data, content_type):
+        with self._lock:
+            self._queued -= 1
+            self._active += 1
+        start = time.perf_counter()
+        try:
+            result = decode_audio(data, content_type, use_pyav=self.use_pyav)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._active -= 1
+            self._slots.release()
+        with self._lock:
+            self.decoded += 1
+            self._latencies.append(elapsed)
+        return result
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                'backend': 'pyav' if self.use_pyav else 'ffmpeg',
+                'workers': self.workers,
+                'queue_depth': self._queued,
+                'active': self._active,
+                'max_queue': self.max_queue,
+                'decoded': self.decoded,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'latency_ms_p50': percentile(latencies, 0.5) * 1000,
+                'latency_ms_p95': percentile(latencies, 0.95) * 1000,
+            }
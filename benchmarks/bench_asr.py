@@ -0,0 +1,138 @@
+"""
+語音識別後端的基準測試
+以一組固定的 zh-TW 錄音比較各後端的字錯誤率 (中文逐字計算，英文逐詞計算) 與延遲：
+- 依序識別每段錄音，記錄單次延遲
+- 以多個執行緒同時送出所有錄音，經過 BatchingRecognizer 合併，記錄總耗時與平均批次大小
+
+清單檔為 UTF-8 的 TSV，每行為「錄音路徑<Tab>正確文字」，路徑相對於清單檔所在目錄；
+錄音可以是 WAV 或任何 ffmpeg / PyAV 能解碼的格式
+
+用法:
+    python benchmarks/bench_asr.py clips/zh-tw.tsv --backends google,vosk,faster-whisper \\
+        --vosk-model models/vosk-model-small-cn-0.22 --whisper-model small --concurrency 8
+"""
+import argparse
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from asr import BatchingRecognizer, create_recognizer
+from audio import decode_audio
+from utils import _CJK_RANGES, normalize_query, percentile
+
+# 中日韓文字逐字計算，其餘以連續的字母數字為一個詞
+_TOKEN = re.compile(f'[{_CJK_RANGES}]|[^\\s{_CJK_RANGES}]+')
+
+
+def tokens(text):
+    return _TOKEN.findall(normalize_query(text))
+
+
+def edit_distance(reference, hypothesis):
+    previous = list(range(len(hypothesis) + 1))
+    for i, ref in enumerate(reference, 1):
+        current = [i]
+        for j, hyp in enumerate(hypothesis, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ref != hyp)))
+        previous = current
+    return previous[-1]
+
+
+def load_manifest(path):
+    base = os.path.dirname(os.path.abspath(path))
+    clips = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            clip_path, transcript = line.rstrip('\n').split('\t', 1)
+            with open(os.path.join(base, clip_path), 'rb') as clip:
+                audio_data = decode_audio(clip.read())
+            clips.append((clip_path, audio_data, transcript))
+    return clips
+
+
+def recognize(recognizer, audio_data):
+    try:
+        return recognizer.recognize(audio_data)
+    except Exception as e:
+        # 聽不出內容或識別失敗都視為空白結果，計入錯誤率
+        print(f"  識別失敗 ({type(e).__name__}): {e}")
+        return ''
+
+
+def error_rate(clips, hypotheses):
+    errors = sum(edit_distance(tokens(transcript), tokens(hypothesis))
+                 for (_, _, transcript), hypothesis in zip(clips, hypotheses))
+    total = sum(len(tokens(transcript)) for _, _, transcript in clips)
+    return errors / total if total else 0.0
+
+
+def bench_backend(name, backend, clips, concurrency, max_batch):
+    print(f"\n== {name} ==")
+
+    # 依序識別：單次延遲
+    latencies = []
+    hypotheses = []
+    for clip_path, audio_data, transcript in clips:
+        start = time.perf_counter()
+        hypothesis = recognize(backend, audio_data)
+        latencies.append(time.perf_counter() - start)
+        hypotheses.append(hypothesis)
+        print(f"  {clip_path}: {hypothesis} (正確: {transcript})")
+    latencies.sort()
+    audio_seconds = sum(len(audio_data.frame_data) / audio_data.sample_rate / audio_data.sample_width
+                        for _, audio_data, _ in clips)
+    print(f"錯誤率 {error_rate(clips, hypotheses):.1%}  "
+          f"延遲 p50 {percentile(latencies, 0.5) * 1000:.0f} ms  "
+          f"p95 {percentile(latencies, 0.95) * 1000:.0f} ms  "
+          f"即時率 {sum(latencies) / audio_seconds:.2f}")
+
+    # 同時送出：經過批次合併
+    batching = BatchingRecognizer(backend, workers=1 if name != 'google' else concurrency,
+                                  max_batch=max_batch if name != 'google' else 1)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(lambda clip: recognize(batching, clip[1]), clips * 2))
+    elapsed = time.perf_counter() - start
+    stats = batching.stats()
+    print(f"併發 {concurrency}：{len(clips) * 2} 段共 {elapsed:.2f} s  "
+          f"平均批次大小 {stats['avg_batch_size']:.1f}  "
+          f"佇列延遲 p95 {stats['latency_ms_p95']:.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比較語音識別後端的錯誤率與延遲")
+    parser.add_argument('manifest', help="錄音清單 (TSV: 路徑<Tab>正確文字)")
+    parser.add_argument('--backends', default='google,vosk,faster-whisper')
+    parser.add_argument('--language', default='zh-TW')
+    parser.add_argument('--vosk-model', help="Vosk 模型目錄")
+    parser.add_argument('--whisper-model', default='small', help="faster-whisper 模型大小或路徑")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--max-batch', type=int, default=8)
+    args = parser.parse_args()
+
+    clips = load_manifest(args.manifest)
+    print(f"載入 {len(clips)} 段錄音")
+
+    for name in args.backends.split(','):
+        name = name.strip()
+        try:
+            model_path = args.vosk_model if name == 'vosk' else None
+            if name in ('faster-whisper', 'whisper'):
+                model_path = args.whisper_model
+            start = time.perf_counter()
+            backend = create_recognizer(name, language=args.language, model_path=model_path)
+            print(f"\n{name} 模型載入耗時 {time.perf_counter() - start:.2f} s")
+        except (RuntimeError, ValueError) as e:
+            print(f"\n略過 {name}: {e}")
+            continue
+        bench_backend(name, backend, clips, args.concurrency, args.max_batch)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+音頻解碼的基準測試
+比較舊的磁碟路徑 (保存 webm -> pydub 轉出 wav -> sr.AudioFile 讀回)、
+記憶體管道路徑 (每次啟動 ffmpeg 進程)、PyAV 進程內解碼，以及 WAV 直接讀取不轉碼的情況，
+以每秒音頻的轉換延遲呈現
+
+需要 ffmpeg (舊路徑另外需要 pydub 與 ffprobe，PyAV 路徑需要安裝 av)
+用法: python benchmarks/bench_audio_decode.py [--repeats 5]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import speech_recognition as sr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from audio import decode_audio, PYAV_AVAILABLE
+
+DURATIONS = (1, 3, 5, 10)
+
+
+def make_clip(seconds, fmt, codec_args):
+    with tempfile.NamedTemporaryFile(suffix=f".{fmt}", delete=False) as f:
+        path = f.name
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-y', '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+                    '-t', str(seconds), '-ac', '1'] + codec_args + [path], check=True)
+    with open(path, 'rb') as f:
+        data = f.read()
+    os.remove(path)
+    return data
+
+
+def legacy_decode(data):
+    """舊版 process_audio 的轉換流程"""
+    from pydub import AudioSegment
+    with tempfile.TemporaryDirectory() as temp_dir:
+        webm_path = os.path.join(temp_dir, "audio.webm")
+        wav_path = os.path.join(temp_dir, "audio.wav")
+        with open(webm_path, 'wb') as f:
+            f.write(data)
+        sound = AudioSegment.from_file(webm_path, format="webm")
+        sound.export(wav_path, format="wav")
+        with sr.AudioFile(wav_path) as source:
+            return sr.Recognizer().record(source)
+
+
+def measure(func, data, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(data)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="音頻解碼的基準測試")
+    parser.add_argument('--repeats', type=int, default=5, help="每個音頻重複解碼的次數")
+    args = parser.parse_args()
+    repeats = args.repeats
+    cases = [
+        ("磁碟 + pydub (webm)", legacy_decode, 'webm'),
+        ("ffmpeg 管道 (webm)", lambda data: decode_audio(data, 'audio/webm', use_pyav=False), 'webm'),
+        ("PyAV 進程內 (webm)", lambda data: decode_audio(data, 'audio/webm', use_pyav=True), 'webm'),
+        ("WAV 直接讀取", lambda data: decode_audio(data, 'audio/wav'), 'wav'),
+    ]
+    clips = {
+        'webm': {seconds: make_clip(seconds, 'webm', ['-c:a', 'libopus']) for seconds in DURATIONS},
+        'wav': {seconds: make_clip(seconds, 'wav', ['-ar', '16000', '-c:a', 'pcm_s16le']) for seconds in DURATIONS},
+    }
+
+    print(f"中位數延遲 (每種情況重複 {repeats} 次)")
+    for name, func, fmt in cases:
+        if 'PyAV' in name and not PYAV_AVAILABLE:
+            print(f"  {name:<20} 未安裝 av")
+            continue
+        results = []
+        try:
+            for seconds in DURATIONS:
+                latency = measure(func, clips[fmt][seconds], repeats)
+                results.append(f"{seconds:>2}s: {latency:7.1f} ms ({latency / seconds:6.1f} ms/音頻秒)")
+        except Exception as e:
+            print(f"  {name:<20} 無法執行: {e}")
+            continue
+        print(f"  {name:<20} " + "  ".join(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+多輪對話上下文的基準測試
+以模擬的 Gemini 伺服器進行一段 --turns 輪的對話，每輪記錄送出的請求大小與延遲，比較：
+- 完整歷史：每次送出所有先前的對話 (沒有 token 預算)
+- token 預算：只送出預算內最近的對話，較早的對話併入摘要
+
+用法: python benchmarks/bench_context.py --turns 100 --budget 2000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_gemini_server import start_mock_server
+
+# 模擬較長的回應，讓歷史記錄增長得更快
+REPLY = "這是模擬的回應。" * 20
+
+
+def run_conversation(app, context, turns):
+    from conversation_context import Prompt
+
+    session_id = os.urandom(8).hex()
+    sizes = []
+    latencies = []
+    for turn in range(turns):
+        query = f"第 {turn} 個問題：請繼續說明上一個回答"
+        start = time.perf_counter()
+        history = context.build(session_id)
+        _, response_text = app.model_router.route(Prompt(query, history))
+        latencies.append((time.perf_counter() - start) * 1000)
+        # 背景的摘要請求也會送到模擬伺服器，因此在這裡計算送出的請求大小
+        _, _, data = app.gemini_request(query, app.PRIMARY_MODEL, history=history)
+        sizes.append(len(json.dumps(data, ensure_ascii=False).encode('utf-8')))
+        app.conversation_store.append(session_id, query, response_text)
+        # 讓背景的摘要有機會完成
+        time.sleep(0.02)
+    return sizes, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多輪對話上下文的基準測試")
+    parser.add_argument('--turns', type=int, default=100)
+    parser.add_argument('--budget', type=int, default=2000, help="上下文的 token 預算")
+    parser.add_argument('--compact-to', type=float, default=0.5, help="摘要時壓縮到預算的比例 (1.0 為沒有遲滯)")
+    parser.add_argument('--latency', type=float, default=0.02, help="模擬 Gemini 的基本延遲秒數")
+    args = parser.parse_args()
+
+    server = start_mock_server(latency=args.latency, reply=REPLY)
+    os.environ['GEMINI_API_BASE'] = server.base_url
+    os.environ['GEMINI_RATE_LIMITS'] = ''
+    os.environ['CONVERSATION_DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix="mysiri_context_"), 'conversations.db')
+
+    import app
+    from conversation_context import ConversationContext
+    # 只需要對話記錄，不啟動整個應用
+    app.init_conversations()
+
+    strategies = [
+        ("完整歷史", ConversationContext(app.conversation_store, token_budget=10 ** 9, max_turns=args.turns)),
+        ("token 預算", ConversationContext(app.conversation_store, token_budget=args.budget,
+                                         summarize=app.summarize_conversation, compact_to=args.compact_to)),
+    ]
+    checkpoints = sorted({1, args.turns // 4, args.turns // 2, args.turns} - {0})
+    print(f"{'策略':<10}" + "".join(f"{f'第{n}輪(KB)':>12}" for n in checkpoints) + f"{'平均延遲(ms)':>14}{'摘要次數':>10}")
+    for title, context in strategies:
+        sizes, latencies = run_conversation(app, context, args.turns)
+        row = "".join(f"{sizes[n - 1] / 1024:>12.1f}" for n in checkpoints)
+        print(f"{title:<10}{row}{sum(latencies) / len(latencies):>14.1f}{context.stats()['compactions']:>10}")
+
+
+if __name__ == '__main__':
+    main()
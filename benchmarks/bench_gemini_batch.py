@@ -0,0 +1,103 @@
+"""
+Gemini 請求批次處理的基準測試
+以模擬的 Gemini 伺服器比較兩種模式在不同同時請求數下的表現：
+- off: 每個問題各自呼叫，同時進行的呼叫數量只受呼叫端的執行緒數量限制
+- fanout: 合併數毫秒內到達的問題，逐一呼叫但同時進行的呼叫數量不超過連線池大小
+
+報告 Gemini 收到的呼叫次數、模擬伺服器上同時進行的最大連線數、延遲與批次的填充率
+
+用法: python benchmarks/bench_gemini_batch.py --levels 1,16,64 --pool-size 16
+"""
+import argparse
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_gemini_server import start_mock_server
+from utils import percentile
+
+MODEL = 'primary-model'
+
+
+def make_call(app, mode, args):
+    from gemini_batch import PromptBatcher
+
+    if mode == 'off':
+        return lambda prompt: app.call_gemini_api(prompt, MODEL), None
+    batcher = PromptBatcher(
+        lambda prompts: app.fanout_gemini(prompts, MODEL),
+        max_batch=args.batch_size,
+        max_wait=args.max_wait_ms / 1000,
+        # 每批最多佔 batch_size 條連線
+        workers=max(1, args.pool_size // args.batch_size)
+    )
+    return batcher.call, batcher
+
+
+def run_level(call, concurrency, rounds):
+    latencies = []
+    failures = 0
+
+    def one(_):
+        start = time.perf_counter()
+        try:
+            # echo 模式的回應包含原本的問題，確認每個請求拿到自己的回應
+            prompt = uuid.uuid4().hex
+            ok = prompt in call(prompt)
+        except Exception:
+            ok = False
+        return ok, (time.perf_counter() - start) * 1000
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(rounds):
+            for ok, latency in pool.map(one, range(concurrency)):
+                latencies.append(latency)
+                failures += 0 if ok else 1
+    latencies.sort()
+    return failures, percentile(latencies, 0.5), percentile(latencies, 0.95)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gemini 請求批次處理的基準測試")
+    parser.add_argument('--levels', default='1,16,64', help="同時請求數")
+    parser.add_argument('--rounds', type=int, default=3, help="每個同時請求數重複的次數")
+    parser.add_argument('--latency', type=float, default=0.2, help="模擬 Gemini 的回應延遲秒數")
+    parser.add_argument('--pool-size', type=int, default=16, help="Gemini 連線池大小")
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--max-wait-ms', type=float, default=5)
+    parser.add_argument('--modes', default='off,fanout')
+    args = parser.parse_args()
+
+    server = start_mock_server(latency=args.latency, echo=True)
+    os.environ['GEMINI_API_BASE'] = server.base_url
+    os.environ['GEMINI_POOL_SIZE'] = str(args.pool_size)
+    os.environ['GEMINI_RATE_LIMITS'] = ''
+
+    import app
+
+    print(f"模擬 Gemini 延遲 {args.latency:.2f} s，連線池 {args.pool_size}，每批最多 {args.batch_size} 個，最多等待 {args.max_wait_ms:g} ms")
+    print(f"{'模式':<8}{'同時請求':>8}{'失敗':>6}{'p50(ms)':>10}{'p95(ms)':>10}{'呼叫次數':>8}{'最大連線':>8}{'平均批次':>8}{'填充率':>8}")
+    for mode in args.modes.split(','):
+        call, batcher = make_call(app, mode, args)
+        for concurrency in (int(level) for level in args.levels.split(',')):
+            server.calls = {}
+            server.peak_in_flight = 0
+            before = batcher.stats() if batcher else None
+            failures, p50, p95 = run_level(call, concurrency, args.rounds)
+            calls = sum(server.calls.values())
+            if batcher:
+                after = batcher.stats()
+                batches = after['batches'] - before['batches']
+                avg_batch = (concurrency * args.rounds) / batches if batches else 0.0
+                batch_info = f"{avg_batch:>8.1f}{avg_batch / args.batch_size:>8.2f}"
+            else:
+                batch_info = f"{'-':>8}{'-':>8}"
+            print(f"{mode:<8}{concurrency:>8}{failures:>6}{p50:>10.0f}{p95:>10.0f}{calls:>8}{server.peak_in_flight:>8}{batch_info}")
+
+
+if __name__ == '__main__':
+    main()
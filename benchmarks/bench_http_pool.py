@@ -0,0 +1,60 @@
+"""
+Gemini HTTP 連線池的基準測試
+在本地啟動一個模擬 generateContent 的伺服器，比較每次呼叫 requests.post
+(每次新建連線) 與共享的 PooledHTTPClient (保持連線) 的單次呼叫延遲
+
+用法: python benchmarks/bench_http_pool.py [--calls 500]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from http_client import PooledHTTPClient
+from mock_gemini_server import start_mock_server
+from utils import percentile
+
+
+def measure(call, calls):
+    latencies = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        response = call()
+        response.json()
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return statistics.mean(latencies), percentile(latencies, 0.5), percentile(latencies, 0.95)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gemini HTTP 連線池的基準測試")
+    parser.add_argument('--calls', type=int, default=500, help="每種方式的呼叫次數")
+    args = parser.parse_args()
+    calls = args.calls
+    server = start_mock_server()
+    url = f"{server.base_url}/v1beta/models/stub:generateContent"
+    payload = {"contents": [{"parts": [{"text": "今天天氣如何"}]}]}
+    headers = {'Content-Type': 'application/json'}
+
+    client = PooledHTTPClient(pool_size=4)
+    cases = [
+        ("requests.post (無連線池)", lambda: requests.post(url, headers=headers, json=payload, timeout=10)),
+        ("PooledHTTPClient", lambda: client.post(url, headers=headers, json=payload)),
+    ]
+    print(f"{calls} 次呼叫，HTTP/2: {'是' if client.http2 else '否'}")
+    for name, call in cases:
+        call()  # 預熱
+        mean, p50, p95 = measure(call, calls)
+        print(f"  {name:<26} 平均 {mean:6.2f} ms  p50 {p50:6.2f} ms  p95 {p95:6.2f} ms")
+
+    client.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+模型備援策略的基準測試
+以模擬的 Gemini 伺服器重現幾種故障情境，比較「逐一嘗試」(原本的做法：前一個模型失敗或逾時後才呼叫下一個)
+與 ModelRouter (對沖請求 + 熔斷器) 的延遲與各模型被呼叫的次數：
+- 正常：主要模型正常回應
+- 配額限制：主要模型固定回應 429，熔斷後不再呼叫
+- 回應緩慢：主要模型需要 --slow 秒，超過對沖延遲後同時呼叫備用模型
+- 伺服器錯誤：主要模型回應 500，錯誤訊息不會被當成回應
+
+用法: python benchmarks/bench_model_router.py [--requests 10] [--slow 3.0]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_gemini_server import start_mock_server
+
+PRIMARY = 'primary-model'
+BACKUP = 'backup-model'
+LAST = 'last-model'
+
+
+def scenarios(slow):
+    """
+    返回 [(情境名稱, 各模型的狀態碼, 各模型的延遲秒數)]
+    """
+    return [
+        ("正常", {}, {}),
+        ("配額限制", {PRIMARY: 429}, {}),
+        ("回應緩慢", {}, {PRIMARY: slow}),
+        ("伺服器錯誤", {PRIMARY: 500}, {}),
+    ]
+
+
+def make_router(call_gemini_api, hedged):
+    from model_router import ModelRouter
+    models = [(name, lambda text, name=name: call_gemini_api(text, name)) for name in (PRIMARY, BACKUP, LAST)]
+    if hedged:
+        return ModelRouter(models, default_hedge_delay=0.5, cooldown=60)
+    # 逐一嘗試：不對沖、不熔斷
+    return ModelRouter(models, hedge_delay=3600, cooldown=0, failure_threshold=10 ** 9)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模型備援策略的基準測試")
+    parser.add_argument('--requests', type=int, default=10, help="每種情境的請求數")
+    parser.add_argument('--slow', type=float, default=3.0, help="回應緩慢情境中主要模型的延遲秒數")
+    args = parser.parse_args()
+    requests_per_scenario = args.requests
+    server = start_mock_server(latency=0.1)
+    os.environ['GEMINI_API_BASE'] = server.base_url
+    os.environ['GEMINI_READ_TIMEOUT'] = '10'
+
+    import app
+
+    print(f"{'情境':<8}{'策略':<8}{'平均(ms)':>10}{'最大(ms)':>10}{'失敗':>6}  各模型呼叫次數")
+    for title, status, latency in scenarios(args.slow):
+        for strategy, hedged in (("逐一嘗試", False), ("對沖熔斷", True)):
+            server.model_status = dict(status)
+            server.model_latency = dict(latency)
+            server.calls = {}
+            router = make_router(app.call_gemini_api, hedged)
+            latencies = []
+            failures = 0
+            for i in range(requests_per_scenario):
+                start = time.perf_counter()
+                try:
+                    router.route(f"{title} {i}")
+                except Exception:
+                    failures += 1
+                latencies.append((time.perf_counter() - start) * 1000)
+            calls = ", ".join(f"{name}={server.calls.get(name, 0)}" for name in (PRIMARY, BACKUP, LAST))
+            print(f"{title:<8}{strategy:<8}{statistics.mean(latencies):>10.0f}{max(latencies):>10.0f}{failures:>6}  {calls}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+用戶端配額限制與相似查詢合併的基準測試
+以模擬的 Gemini 伺服器 (主要模型設有每分鐘請求數配額，超過時回應 429) 比較：
+
+1. 配額限制：同時送出 --burst 個不同的問題
+   - 不限制：超過配額的請求送出後收到 429，主要模型被熔斷，冷卻時間內所有請求都改用備用模型
+   - 本地限制：超過配額的請求在本地排隊，預計等待超過上限時直接改用備用模型，不會收到 429
+2. 查詢合併：同時送出 --burst 個相同或相似 (標點、空白不同) 的熱門問題，比較呼叫 Gemini 的次數
+
+用法: python benchmarks/bench_rate_limit.py --rpm 10 --burst 30
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_gemini_server import start_mock_server
+
+PRIMARY = 'primary-model'
+BACKUP = 'backup-model'
+
+SIMILAR_FORMS = ["{}", "{}？", "{} ", "  {}!"]
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    try:
+        fn(*args)
+        ok = True
+    except Exception:
+        ok = False
+    return ok, (time.perf_counter() - start) * 1000
+
+
+def run_burst(fn, queries):
+    with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+        results = list(pool.map(lambda query: timed(fn, query), queries))
+    latencies = [latency for _, latency in results]
+    failures = sum(1 for ok, _ in results if not ok)
+    return failures, statistics.median(latencies), max(latencies)
+
+
+def bench_rate_limit(app, server, args):
+    from model_router import ModelRouter
+    from rate_limit import RateLimiters
+
+    print(f"== 配額限制：主要模型每分鐘 {args.rpm} 次，同時送出 {args.burst} 個問題 ==")
+    print(f"{'策略':<8}{'失敗':>6}{'p50(ms)':>10}{'最大(ms)':>10}{'429次數':>8}  各模型呼叫次數 / 主要模型熔斷器")
+    for strategy, limits in (("不限制", {}), ("本地限制", {PRIMARY: (args.rpm, None)})):
+        server.calls, server.rejected, server._recent = {}, {}, {}
+        app.rate_limiters = RateLimiters(limits, max_wait=args.max_wait)
+        router = ModelRouter(
+            [(name, lambda text, name=name: app.call_gemini_api(text, name)) for name in (PRIMARY, BACKUP)],
+            default_hedge_delay=5.0, cooldown=60
+        )
+        queries = [uuid.uuid4().hex for _ in range(args.burst)]
+        failures, p50, worst = run_burst(router.route, queries)
+        calls = ", ".join(f"{name}={server.calls.get(name, 0)}" for name in (PRIMARY, BACKUP))
+        rejected = sum(server.rejected.values())
+        print(f"{strategy:<8}{failures:>6}{p50:>10.0f}{worst:>10.0f}{rejected:>8}  {calls} / {router.breakers[PRIMARY].state}")
+
+
+def bench_coalescing(app, server, args):
+    from single_flight import SingleFlight
+
+    print(f"\n== 查詢合併：同時送出 {args.burst} 個相似的熱門問題 ==")
+    print(f"{'策略':<8}{'失敗':>6}{'p50(ms)':>10}{'最大(ms)':>10}{'呼叫次數':>8}")
+    app.rate_limiters = app.RateLimiters({})
+    for strategy, coalesce in (("不合併", False), ("合併", True)):
+        server.calls = {}
+        topic = f"熱門問題 {uuid.uuid4().hex[:8]} 今天天氣如何"
+        queries = [SIMILAR_FORMS[i % len(SIMILAR_FORMS)].format(topic) for i in range(args.burst)]
+        if coalesce:
+            app.request_coalescer = SingleFlight()
+            fn = app.get_response
+        else:
+            fn = lambda query: app.fetch_response(query)
+        failures, p50, worst = run_burst(fn, queries)
+        print(f"{strategy:<8}{failures:>6}{p50:>10.0f}{worst:>10.0f}{sum(server.calls.values()):>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="用戶端配額限制與相似查詢合併的基準測試")
+    parser.add_argument('--rpm', type=int, default=10, help="模擬主要模型的每分鐘請求數配額")
+    parser.add_argument('--burst', type=int, default=30, help="同時送出的請求數")
+    parser.add_argument('--latency', type=float, default=0.3, help="模擬 Gemini 的回應延遲秒數")
+    parser.add_argument('--max-wait', type=float, default=1.0, help="本地排隊的等待上限秒數")
+    args = parser.parse_args()
+
+    server = start_mock_server(latency=args.latency, model_rpm={PRIMARY: args.rpm})
+    os.environ['GEMINI_API_BASE'] = server.base_url
+    os.environ['GEMINI_POOL_SIZE'] = str(max(args.burst, 20))
+
+    import app
+    bench_rate_limit(app, server, args)
+    bench_coalescing(app, server, args)
+
+
+if __name__ == '__main__':
+    main()
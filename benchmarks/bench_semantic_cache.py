@@ -0,0 +1,146 @@
+"""
+語意緩存的基準測試
+- 向量索引在不同記錄數下的搜尋延遲 (單一查詢與一批查詢，一次矩陣乘法)
+- ResponseCache.get 未命中時加上語意查找的總延遲 (特徵雜湊向量，不含模型推論時間)
+- 安裝了 sentence-transformers 時，比較改寫問題的命中率、誤判率與模型的向量化延遲
+
+用法: python benchmarks/bench_semantic_cache.py [--dim 384] [--model paraphrase-multilingual-MiniLM-L12-v2]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from cache import ResponseCache
+from semantic_cache import (SemanticTier, HashingEmbedder, VectorIndex, SENTENCE_TRANSFORMERS_AVAILABLE,
+                            DEFAULT_EMBEDDING_MODEL, SEMANTIC_THRESHOLD, create_embedder)
+from utils import percentile
+
+INDEX_SIZES = (1000, 10000, 50000, 100000)
+BATCH_SIZE = 32
+
+# 字面上幾乎沒有共同字元的改寫 (Jaccard 相似度找不到)
+PARAPHRASE_PAIRS = [
+    ("明天天氣如何", "明天會下雨嗎"),
+    ("現在幾點了", "請告訴我現在的時間"),
+    ("推薦一家附近好吃的拉麵店", "這附近有什麼好吃的拉麵"),
+    ("一公斤等於幾磅", "一公斤換算成磅是多少"),
+    ("美金對台幣的匯率是多少", "一美元可以換多少新台幣"),
+    ("什麼是機器學習", "機器學習是什麼意思"),
+    ("感冒的時候應該吃什麼", "感冒了適合吃哪些食物"),
+    ("世界上最高的山是哪一座", "全世界最高的山叫什麼名字"),
+]
+
+# 相似但答案不同的問題，不應該命中
+DISTINCT_PAIRS = [
+    ("今天台北的天氣如何", "今天台中的天氣如何"),
+    ("台積電今天的股價是多少", "鴻海今天的股價是多少"),
+    ("幫我設定明天早上七點的鬧鐘", "幫我設定明天早上八點的鬧鐘"),
+    ("一公斤等於幾磅", "一磅等於幾公斤"),
+    ("從台北車站到松山機場要怎麼走", "從台北車站到桃園機場要怎麼走"),
+]
+
+
+def random_unit_vectors(rng, count, dim):
+    vectors = rng.standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def timed(func, repeats):
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return percentile(samples, 0.5) * 1000, percentile(samples, 0.95) * 1000
+
+
+def bench_index(dim):
+    print(f"向量索引搜尋延遲 (dim={dim}，float32):")
+    print(f"  {'記錄數':>8}  {'記憶體':>8}  {'單一 p50':>9}  {'單一 p95':>9}  {f'{BATCH_SIZE} 個 p50':>10}  {'每查詢':>8}")
+    rng = np.random.default_rng(0)
+    for size in INDEX_SIZES:
+        index = VectorIndex(dim)
+        for key, vector in enumerate(random_unit_vectors(rng, size, dim)):
+            index.add(key, vector)
+        single = random_unit_vectors(rng, 1, dim)
+        batch = random_unit_vectors(rng, BATCH_SIZE, dim)
+        repeats = 200 if size <= 10000 else 50
+        p50, p95 = timed(lambda: index.search(single, SEMANTIC_THRESHOLD), repeats)
+        batch_p50, _ = timed(lambda: index.search(batch, SEMANTIC_THRESHOLD), max(10, repeats // 5))
+        memory = size * dim * 4 / 1024 / 1024
+        print(f"  {size:>8}  {memory:>6.1f}MB  {p50:>7.3f}ms  {p95:>7.3f}ms  {batch_p50:>8.3f}ms  "
+              f"{batch_p50 / BATCH_SIZE:>6.3f}ms")
+
+
+def bench_cache_miss(lookups=500):
+    """
+    未命中時 ResponseCache.get 的總延遲：精確、Jaccard、向量化與向量搜尋
+    """
+    print("\nResponseCache.get 未命中的延遲 (hashing 向量，dim=256):")
+    alphabet = ''.join(chr(code) for code in range(0x4e00, 0x4e00 + 3000))
+    for size in (1000, 10000, 50000):
+        rng = random.Random(size)
+        queries = [''.join(rng.choice(alphabet) for _ in range(rng.randint(6, 16))) for _ in range(size)]
+        probes = [''.join(rng.choice(alphabet) for _ in range(10)) for _ in range(lookups)]
+        results = []
+        for semantic in (None, SemanticTier(HashingEmbedder())):
+            cache = ResponseCache(3600, max_entries=None, semantic=semantic)
+            for query in queries:
+                cache.put(query, query)
+            samples = []
+            for probe in probes:
+                start = time.perf_counter()
+                cache.get(probe)
+                samples.append(time.perf_counter() - start)
+            samples.sort()
+            results.append((percentile(samples, 0.5) * 1000, percentile(samples, 0.95) * 1000))
+        (plain_p50, plain_p95), (semantic_p50, semantic_p95) = results
+        print(f"  {size:>7} 筆  只有相似查詢 p50 {plain_p50:.3f}ms p95 {plain_p95:.3f}ms  "
+              f"加上語意查找 p50 {semantic_p50:.3f}ms p95 {semantic_p95:.3f}ms")
+
+
+def bench_model(model_name):
+    print(f"\n句向量模型 {model_name}:")
+    embedder = create_embedder('sentence-transformers', model_name)
+    queries = [query for pair in PARAPHRASE_PAIRS + DISTINCT_PAIRS for query in pair]
+    embedder.embed(queries[:1])  # 第一次呼叫包含初始化
+    p50, p95 = timed(lambda: embedder.embed([random.choice(queries)]), 100)
+    print(f"  單一查詢向量化 p50 {p50:.2f}ms p95 {p95:.2f}ms")
+
+    def similarities(pairs):
+        left = embedder.embed([a for a, _ in pairs])
+        right = embedder.embed([b for _, b in pairs])
+        return (left * right).sum(axis=1)
+
+    paraphrase = similarities(PARAPHRASE_PAIRS)
+    distinct = similarities(DISTINCT_PAIRS)
+    print(f"  改寫問題的相似度 {np.round(np.sort(paraphrase), 3).tolist()}")
+    print(f"  不同問題的相似度 {np.round(np.sort(distinct), 3).tolist()}")
+    for threshold in (0.8, 0.85, 0.9, 0.95):
+        print(f"  閾值 {threshold:.2f}  改寫命中 {np.mean(paraphrase >= threshold):6.1%}  "
+              f"不同問題誤判 {np.mean(distinct >= threshold):6.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="語意緩存的基準測試")
+    parser.add_argument('--dim', type=int, default=384, help="向量維度 (預設模型為 384)")
+    parser.add_argument('--model', default=DEFAULT_EMBEDDING_MODEL, help="sentence-transformers 模型名稱")
+    args = parser.parse_args()
+
+    bench_index(args.dim)
+    bench_cache_miss()
+    if SENTENCE_TRANSFORMERS_AVAILABLE:
+        bench_model(args.model)
+    else:
+        print("\n未安裝 sentence-transformers，略過改寫命中率與模型延遲的測試")
+
+
+if __name__ == '__main__':
+    main()
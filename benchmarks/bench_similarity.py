@@ -0,0 +1,126 @@
+"""
+相似查詢緩存的基準測試
+比較舊的空白分詞與新的中文字元 n-gram 分詞在中文查詢上的命中率，
+並測量不同緩存大小下的查找延遲
+
+用法: python benchmarks/bench_similarity.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import ResponseCache
+from utils import normalize_query, tokenize_query, jaccard_similarity, SIMILARITY_THRESHOLD
+
+# 常見的語音助理問題
+BASE_QUERIES = [
+    "今天台北的天氣如何",
+    "明天早上會不會下雨",
+    "幫我設定明天早上七點的鬧鐘",
+    "現在幾點了",
+    "台積電今天的股價是多少",
+    "推薦一家附近好吃的拉麵店",
+    "從台北車站到松山機場要怎麼走",
+    "請講一個好笑的笑話給我聽",
+    "一公斤等於幾磅",
+    "美金對台幣的匯率是多少",
+    "幫我翻譯早安成英文",
+    "什麼是機器學習",
+    "介紹一下台灣的夜市文化",
+    "週末有什麼好看的電影",
+    "感冒的時候應該吃什麼",
+    "如何煮一碗好吃的牛肉麵",
+    "光速每秒多少公里",
+    "世界上最高的山是哪一座",
+    "幫我算一百二十乘以三十五",
+    "播放一些輕鬆的音樂",
+]
+
+# 使用者常見的改寫方式：加上標點、全形字、禮貌用語等
+VARIANT_TEMPLATES = [
+    "{q}？",
+    "{q}?",
+    "{q}。",
+    "請問{q}",
+    "請問，{q}？",
+    "{q}呢",
+    " {q} ",
+    "{q}！！",
+]
+
+
+def legacy_is_similar(query1, query2):
+    """舊版 is_similar_query：只以空白分詞"""
+    q1 = ' '.join(query1.lower().split())
+    q2 = ' '.join(query2.lower().split())
+    if q1 == q2:
+        return True
+    set1, set2 = set(q1.split()), set(q2.split())
+    union = len(set1 | set2)
+    return union > 0 and len(set1 & set2) / union > SIMILARITY_THRESHOLD
+
+
+def ngram_is_similar(query1, query2):
+    q1, q2 = normalize_query(query1), normalize_query(query2)
+    if q1 == q2:
+        return True
+    return jaccard_similarity(tokenize_query(q1), tokenize_query(q2)) > SIMILARITY_THRESHOLD
+
+
+def measure_hit_rate(is_similar):
+    hits = total = false_hits = pairs = 0
+    for query in BASE_QUERIES:
+        for template in VARIANT_TEMPLATES:
+            total += 1
+            if is_similar(template.format(q=query), query):
+                hits += 1
+        for other in BASE_QUERIES:
+            if other is not query:
+                pairs += 1
+                if is_similar(query, other):
+                    false_hits += 1
+    return hits / total, false_hits / pairs
+
+
+def random_query(rng, alphabet):
+    return ''.join(rng.choice(alphabet) for _ in range(rng.randint(6, 16)))
+
+
+def measure_lookup_latency(size, lookups=2000):
+    rng = random.Random(size)
+    # 以常用漢字範圍隨機產生填充查詢
+    alphabet = ''.join(chr(code) for code in range(0x4e00, 0x4e00 + 3000))
+    cache = ResponseCache(expiry=3600)
+    for _ in range(size):
+        query = random_query(rng, alphabet)
+        cache.put(query, query)
+    for query in BASE_QUERIES:
+        cache.put(query, query)
+
+    probes = [rng.choice(VARIANT_TEMPLATES).format(q=rng.choice(BASE_QUERIES)) for _ in range(lookups)]
+    hits = 0
+    start = time.perf_counter()
+    for probe in probes:
+        if cache.get(probe) is not None:
+            hits += 1
+    elapsed = time.perf_counter() - start
+    return elapsed / lookups * 1e6, hits / lookups
+
+
+def main():
+    print("命中率 (改寫查詢命中 / 不同查詢誤判):")
+    for name, func in (("空白分詞", legacy_is_similar), ("字元 n-gram", ngram_is_similar)):
+        hit_rate, false_rate = measure_hit_rate(func)
+        print(f"  {name:<10} 命中率 {hit_rate:6.1%}  誤判率 {false_rate:6.1%}")
+
+    print("\n查找延遲 (ResponseCache.get):")
+    for size in (10, 1000, 10000, 100000):
+        latency, hit_rate = measure_lookup_latency(size)
+        print(f"  {size:>7} 筆緩存  平均 {latency:8.2f} µs/次  命中率 {hit_rate:6.1%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+"""
+啟動時間的基準測試
+- python -X importtime：匯入 app.py 的總時間、耗時最多的直接匯入，以及重量級套件是否在啟動時被匯入
+- 進程啟動到就緒：在子進程中以 create_app() 啟動服務，測量從建立進程到 /startup_stats 回應的時間
+  (--prewarm 時另外測量背景預先初始化所有後端所需的時間)
+
+可以保存為基準 (--save-baseline) 並與之後的執行比較 (--baseline)，啟動變慢超過 --tolerance 時以狀態碼 1 結束
+用法:
+    python benchmarks/bench_startup.py --runs 5 --save-baseline benchmarks/startup_baseline.json
+    python benchmarks/bench_startup.py --runs 5 --baseline benchmarks/startup_baseline.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 只在使用時才需要的重量級套件，不應該在匯入 app 或建立應用時載入
+DEFERRED_MODULES = ('google.generativeai', 'numpy', 'sentence_transformers', 'vosk', 'faster_whisper', 'av', 'pyttsx3')
+
+# 建立應用之後稍等一下，背景執行緒若在啟動時匯入套件也會被發現
+IMPORT_CODE = ("import sys, time, app; app.create_app(prewarm=False); time.sleep(0.2); "
+               "print('LOADED', *(name for name in {modules!r} if name in sys.modules))")
+
+# (指標, 是否越高越好)
+COMPARED_METRICS = (
+    ('import_ms', False),
+    ('start_to_ready_ms', False),
+    ('ready_seconds', False),
+)
+
+SERVE_CODE = """
+import sys
+sys.path.insert(0, {root!r})
+import app
+from werkzeug.serving import make_server
+server = make_server('127.0.0.1', 0, app.create_app(prewarm={prewarm}), threaded=True)
+print('PORT', server.server_port, flush=True)
+server.serve_forever()
+"""
+
+
+def child_env(work_dir):
+    env = dict(os.environ)
+    env['CONVERSATION_DB_PATH'] = os.path.join(work_dir, 'conversations.db')
+    env['TTS_CACHE_DIR'] = os.path.join(work_dir, 'tts')
+    env.pop('CACHE_WARM_LOG', None)
+    return env
+
+
+def parse_importtime(stderr):
+    """
+    解析 -X importtime 的輸出，返回 [(模組, 自身微秒, 累計微秒, 巢狀層級)]
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        modules.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return modules
+
+
+def measure_imports(env, top=10):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', IMPORT_CODE.format(modules=DEFERRED_MODULES)],
+        cwd=ROOT, env=env, capture_output=True, text=True, timeout=120
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"匯入 app 失敗:\n{result.stderr[-2000:]}")
+    modules = parse_importtime(result.stderr)
+    app_index = next(i for i, (name, _, _, depth) in enumerate(modules) if name == 'app' and depth == 0)
+    # app 的直接匯入出現在它之前、層級為 1 的連續項目中
+    direct = []
+    for name, _, cumulative, depth in reversed(modules[:app_index]):
+        if depth == 0:
+            break
+        if depth == 1:
+            direct.append((name, cumulative))
+    # -X importtime 也會列出匯入失敗的模組 (例如未安裝的選用套件)，以 sys.modules 判斷實際載入的套件
+    loaded = next(line.split()[1:] for line in result.stdout.splitlines() if line.startswith('LOADED'))
+    return {
+        'import_ms': modules[app_index][2] / 1000,
+        'slowest': sorted(direct, key=lambda item: -item[1])[:top],
+        'deferred': {name: name in loaded for name in DEFERRED_MODULES},
+    }
+
+
+def measure_start(env, prewarm, timeout=60):
+    """
+    啟動一個服務進程，返回 (建立進程到 /startup_stats 回應的秒數, 服務回報的統計)
+    """
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-c', SERVE_CODE.format(root=ROOT, prewarm=prewarm)],
+        cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    )
+    try:
+        port = None
+        for line in process.stdout:
+            if line.startswith('PORT '):
+                port = int(line.split()[1])
+                break
+        if port is None:
+            raise RuntimeError("服務進程沒有啟動")
+        url = f"http://127.0.0.1:{port}/startup_stats"
+        while True:
+            try:
+                response = requests.get(url, timeout=1)
+                if response.status_code == 200:
+                    break
+            except requests.exceptions.ConnectionError:
+                pass
+            if time.perf_counter() - started > timeout:
+                raise RuntimeError("等待服務就緒逾時")
+            time.sleep(0.005)
+        start_to_ready = time.perf_counter() - started
+        stats = response.json()
+        while prewarm and stats['prewarm']['finished_seconds'] is None:
+            if time.perf_counter() - started > timeout:
+                raise RuntimeError("等待預先初始化逾時")
+            time.sleep(0.05)
+            stats = requests.get(url, timeout=1).json()
+        return start_to_ready, stats
+    finally:
+        process.kill()
+        process.wait()
+
+
+def compare(current, baseline, tolerance):
+    """
+    印出與基準的比較，返回變慢超過 tolerance 的指標
+    """
+    regressions = []
+    print(f"\n與基準比較 (容許 {tolerance:.0%})")
+    print(f"{'指標':<20}{'基準':>12}{'本次':>12}{'變化':>10}")
+    for name, higher_is_better in COMPARED_METRICS:
+        before, after = baseline.get(name), current.get(name)
+        if before is None or after is None:
+            continue
+        change = (after - before) / before if before else 0.0
+        worse = -change if higher_is_better else change
+        regressed = worse > tolerance
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<20}{before:>12.2f}{after:>12.2f}{change:>+10.1%}{'  退步' if regressed else ''}")
+    # 原本延遲匯入的套件又在啟動時被匯入
+    for name, loaded in current.get('deferred', {}).items():
+        if loaded and not baseline.get('deferred', {}).get(name, False):
+            regressions.append(name)
+            print(f"{name:<20}{'延遲':>12}{'已匯入':>12}{'':>10}  退步")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="啟動時間的基準測試")
+    parser.add_argument('--runs', type=int, default=5, help="啟動服務的次數 (取中位數)")
+    parser.add_argument('--prewarm', action='store_true', help="同時測量背景預先初始化後端的時間")
+    parser.add_argument('--baseline', help="與此基準檔案比較")
+    parser.add_argument('--save-baseline', help="將本次結果保存為基準檔案")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="與基準比較時容許的變慢比例")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="mysiri_startup_")
+    env = child_env(work_dir)
+
+    imports = measure_imports(env)
+    print(f"匯入 app: {imports['import_ms']:.0f} ms")
+    print("耗時最多的直接匯入 (累計):")
+    for name, cumulative in imports['slowest']:
+        print(f"  {cumulative / 1000:>8.1f} ms  {name}")
+    print("啟動時匯入的重量級套件:")
+    for name, imported in imports['deferred'].items():
+        print(f"  {name:<24}{'已匯入' if imported else '延遲'}")
+
+    starts, ready, prewarm = [], [], []
+    for _ in range(args.runs):
+        start_to_ready, stats = measure_start(env, args.prewarm)
+        starts.append(start_to_ready)
+        ready.append(stats['ready_seconds'])
+        if args.prewarm:
+            prewarm.append(stats['prewarm']['finished_seconds'])
+    summary = {
+        'import_ms': round(imports['import_ms'], 1),
+        'start_to_ready_ms': round(statistics.median(starts) * 1000, 1),
+        'ready_seconds': statistics.median(ready),
+        'prewarmed_seconds': statistics.median(prewarm) if prewarm else None,
+        'deferred': imports['deferred'],
+        'runs': args.runs,
+    }
+    print(f"\n進程啟動到就緒 (中位數，{args.runs} 次): {summary['start_to_ready_ms']:.0f} ms "
+          f"(服務回報 {summary['ready_seconds']:.2f} 秒)")
+    if prewarm:
+        print(f"背景預先初始化完成: 進程啟動後 {summary['prewarmed_seconds']:.2f} 秒")
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(summary, baseline, args.tolerance):
+            sys.exit(1)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"\n已保存基準: {args.save_baseline}")
+
+
+if __name__ == '__main__':
+    main()
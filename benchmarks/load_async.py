@@ -0,0 +1,142 @@
+"""
+同步 (Flask) 與非同步 (Quart / ASGI) 服務模式的負載測試
+模擬的 Gemini 每次回應需要 --latency 秒，逐步增加同時進行中的對話數量，
+比較兩種模式能同時處理多少個對話：
+- 同步模式以固定數量的執行緒處理請求 (相當於 gunicorn --threads N)，超過的請求只能排隊
+- 非同步模式在單一事件迴圈上處理所有請求，等待 Gemini 時不佔用執行緒
+
+若所有請求都能在約 --latency 秒內完成，代表該數量的對話可以同時進行
+
+需要 pip install quart httpx hypercorn
+用法: python benchmarks/load_async.py --latency 1.0 --threads 16 --levels 16,64,256
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pyttsx3
+import requests
+from werkzeug.serving import BaseWSGIServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_gemini_server import start_mock_server
+from stress_concurrency import FakeTTSEngine
+from utils import percentile
+
+
+class ThreadPoolWSGIServer(BaseWSGIServer):
+    """以固定數量的執行緒處理請求的 WSGI 伺服器"""
+    def __init__(self, host, port, app, threads):
+        super().__init__(host, port, app)
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self._pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def start_sync_server(threads):
+    import app
+    server = ThreadPoolWSGIServer('127.0.0.1', 0, app.create_app(), threads)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def start_async_server():
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+    import async_app
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    config = Config()
+    config.bind = [f"127.0.0.1:{port}"]
+    config.backlog = 1024
+    config.accesslog = None
+    config.errorlog = None
+
+    async def run():
+        # 在非主執行緒中無法註冊訊號處理器，改為永不觸發的關閉條件
+        await serve(async_app.create_app(), config, shutdown_trigger=asyncio.Event().wait)
+
+    threading.Thread(target=lambda: asyncio.run(run()), daemon=True).start()
+
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(f"{base_url}/cache_stats", timeout=1)
+            break
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.05)
+    return base_url
+
+
+def conversation(base_url):
+    # 每個對話使用不同的問題，避免命中緩存
+    start = time.perf_counter()
+    try:
+        response = requests.post(f"{base_url}/text_input", json={"text": uuid.uuid4().hex}, timeout=120)
+        ok = response.status_code == 200 and 'response_text' in response.json()
+    except requests.exceptions.RequestException:
+        ok = False
+    return ok, time.perf_counter() - start
+
+
+def run_level(base_url, concurrency):
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.perf_counter()
+        results = list(pool.map(lambda _: conversation(base_url), range(concurrency)))
+        elapsed = time.perf_counter() - start
+    latencies = sorted(latency for _, latency in results)
+    ok = sum(1 for success, _ in results if success)
+    return ok, elapsed, percentile(latencies, 0.5), percentile(latencies, 0.95)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比較同步與非同步服務模式可同時處理的對話數量")
+    parser.add_argument('--latency', type=float, default=1.0, help="模擬 Gemini 的回應延遲秒數")
+    parser.add_argument('--threads', type=int, default=16, help="同步模式的執行緒數量")
+    parser.add_argument('--levels', default='16,64,256', help="要測試的同時對話數量")
+    parser.add_argument('--modes', default='sync,async')
+    args = parser.parse_args()
+
+    gemini = start_mock_server(latency=args.latency, echo=True)
+    os.environ['GEMINI_API_BASE'] = gemini.base_url
+    # 模擬伺服器沒有配額限制，不需要在本地排隊
+    os.environ.setdefault('GEMINI_RATE_LIMITS', '')
+    work_dir = tempfile.mkdtemp(prefix="mysiri_load_")
+    os.environ['TTS_CACHE_DIR'] = os.path.join(work_dir, 'tts')
+    os.environ['CONVERSATION_DB_PATH'] = os.path.join(work_dir, 'conversations.db')
+    # 同步模式的連線池不應成為瓶頸
+    os.environ.setdefault('GEMINI_POOL_SIZE', '1024')
+    os.environ.setdefault('ASYNC_GEMINI_POOL_SIZE', '1024')
+    pyttsx3.init = FakeTTSEngine
+
+    levels = [int(level) for level in args.levels.split(',')]
+    print(f"模擬 Gemini 延遲 {args.latency:.2f} s，同步模式 {args.threads} 個執行緒")
+    print(f"{'模式':<6}{'同時對話':>8}{'成功':>8}{'總耗時(s)':>12}{'p50(s)':>10}{'p95(s)':>10}")
+    for mode in args.modes.split(','):
+        base_url = start_sync_server(args.threads) if mode == 'sync' else start_async_server()
+        for concurrency in levels:
+            ok, elapsed, p50, p95 = run_level(base_url, concurrency)
+            print(f"{mode:<6}{concurrency:>8}{ok:>8}{elapsed:>12.2f}{p50:>10.2f}{p95:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+"""
+離線的負載測試：不消耗真實的 Gemini 配額與語音識別，測量 app.py 的吞吐量
+- Gemini：本地模擬伺服器，可設定延遲、隨機 429 的比例與回應字數
+- 語音識別：模擬的識別器，依 WebM 錄音的長度辨識出查詢組合中的問題 (可設定延遲)
+- 語音合成：模擬的 TTS 引擎，將文字寫入音頻檔
+負載產生器依查詢組合 (--mix) 的權重，以 --concurrency 個同時進行的使用者重播 /text_input 與 /process_audio 請求，
+每個使用者保留 cookie 連續問 --session-turns 個問題後才開始新的對話 (與真實使用者一樣有多輪上下文)
+另外以 --conversations 段多輪對話 (一個問題加上數個追問) 測量帶入上下文、不使用緩存的路徑，分開報告
+
+報告每秒請求數、延遲分位數、回應緩存命中率、各步驟的 p95 與記憶體增長，
+可以保存為基準 (--save-baseline) 並與之後的執行比較 (--baseline)
+
+查詢組合的檔案每行為 "權重<Tab>問題"，問題中的 {n} 會替換為隨機的代號 (每次都是新的問題，相似查詢也不會命中緩存)
+
+需要 ffmpeg 產生測試用的 WebM 錄音
+用法:
+    python benchmarks/load_test.py --requests 400 --concurrency 16 --save-baseline benchmarks/load_baseline.json
+    python benchmarks/load_test.py --requests 400 --concurrency 16 --baseline benchmarks/load_baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pyttsx3
+import requests
+import speech_recognition as sr
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_gemini_server import start_mock_server
+from stress_concurrency import BASE_SECONDS, STEP_SECONDS, FakeTTSEngine, make_clip
+from utils import percentile
+
+# 預設的查詢組合：少數熱門問題佔大部分請求，另有一部分每次都不同的問題
+DEFAULT_MIX = [
+    (20, "今天天氣如何？"),
+    (12, "現在幾點了？"),
+    (10, "請講一個笑話"),
+    (8, "台北有什麼好吃的？"),
+    (6, "幫我設定明天早上七點的鬧鐘"),
+    (5, "推薦一部電影"),
+    (4, "如何煮一杯好喝的咖啡？"),
+    (3, "介紹一下太陽系"),
+    (2, "翻譯：早安"),
+    (10, "請解釋代號 {n} 的意義"),
+]
+
+# 多輪對話情境中接在第一個問題之後的追問 (需要上下文，不使用共用的緩存)
+FOLLOW_UPS = ["為什麼？", "再詳細一點", "那台中呢？", "可以舉個例子嗎？", "還有其他的嗎？"]
+
+# 與基準比較的指標：(名稱, 數值越大越好)
+COMPARED_METRICS = [
+    ('requests_per_sec', True),
+    ('latency_ms_p50', False),
+    ('latency_ms_p95', False),
+    ('latency_ms_p99', False),
+    ('cache_hit_ratio', True),
+    ('memory_growth_mb', False),
+    ('follow_up_latency_ms_p95', False),
+]
+
+
+def load_mix(path):
+    mix = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            weight, query = line.split('\t', 1)
+            mix.append((float(weight), query))
+    return mix
+
+
+def rss_mb():
+    # 目前的常駐記憶體 (Linux)，其他平台使用峰值
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if platform.system() == 'Darwin' else peak / 1024
+
+
+class QueryMix:
+    """依權重抽出問題，{n} 替換為隨機的代號"""
+    def __init__(self, mix, seed):
+        self.queries = [query for _, query in mix]
+        self.weights = [weight for weight, _ in mix]
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def pick(self):
+        with self._lock:
+            return self._random.choices(range(len(self.queries)), self.weights)[0]
+
+    def text(self, index):
+        query = self.queries[index]
+        if '{n}' not in query:
+            return query
+        with self._lock:
+            return query.replace('{n}', f"{self._random.getrandbits(64):016x}")
+
+
+def install_fakes(mix, asr_latency, tts_latency):
+    """以模擬的語音識別與 TTS 引擎取代真實的後端"""
+    def fake_recognize_google(self, audio_data, language=None, **kwargs):
+        # 第 i 個問題的錄音長度為 BASE_SECONDS + i * STEP_SECONDS
+        seconds = len(audio_data.frame_data) / (audio_data.sample_rate * audio_data.sample_width)
+        time.sleep(asr_latency)
+        return mix.text(round((seconds - BASE_SECONDS) / STEP_SECONDS))
+
+    class SlowTTSEngine(FakeTTSEngine):
+        def runAndWait(self):
+            time.sleep(tts_latency * len(self._jobs))
+            super().runAndWait()
+
+    sr.Recognizer.recognize_google = fake_recognize_google
+    pyttsx3.init = SlowTTSEngine
+
+
+def send(session, base_url, mix, clips, kind, index, fetch_audio, text=None):
+    start = time.perf_counter()
+    try:
+        if kind == 'audio':
+            response = session.post(base_url + '/process_audio',
+                                    files={'audio': ('recording.webm', clips[index], 'audio/webm')}, timeout=120)
+        else:
+            response = session.post(base_url + '/text_input', json={'text': text or mix.text(index)}, timeout=120)
+        ok = response.status_code == 200
+        if ok and fetch_audio:
+            for url in response.json().get('audio_segments', []):
+                ok = ok and session.get(base_url + url, timeout=60).status_code == 200
+    except requests.exceptions.RequestException:
+        ok = False
+    return kind, ok, time.perf_counter() - start
+
+
+def run_load(base_url, mix, clips, schedule, concurrency, fetch_audio, session_turns):
+    # 每個使用者各自的連線與 cookie：連續 session_turns 個請求屬於同一段對話，之後清除 cookie 開始新的對話
+    local = threading.local()
+
+    def one(item):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+            local.turns = 0
+        if local.turns >= session_turns:
+            local.session.cookies.clear()
+            local.turns = 0
+        local.turns += 1
+        return send(local.session, base_url, mix, clips, item[0], item[1], fetch_audio)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(one, schedule))
+
+
+def run_conversations(base_url, mix, conversations, turns, concurrency, seed):
+    """
+    多輪對話情境：每段對話先問查詢組合中的一個問題，接著追問 turns - 1 次
+    返回 [(第幾輪, 是否成功, 延遲秒數)]
+    """
+    rng = random.Random(seed)
+    scripts = [[mix.text(mix.pick())] + rng.sample(FOLLOW_UPS, min(turns - 1, len(FOLLOW_UPS)))
+               for _ in range(conversations)]
+
+    def converse(script):
+        session = requests.Session()
+        return [(turn,) + send(session, base_url, mix, None, 'text', None, False, text=text)[1:]
+                for turn, text in enumerate(script)]
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return [result for results in executor.map(converse, scripts) for result in results]
+
+
+def summarize(results, elapsed):
+    latencies = sorted(latency for _, ok, latency in results if ok)
+    summary = {
+        'requests': len(results),
+        'failures': sum(1 for _, ok, _ in results if not ok),
+        'requests_per_sec': len(results) / elapsed if elapsed else 0.0,
+        'latency_ms_p50': percentile(latencies, 0.5) * 1000,
+        'latency_ms_p95': percentile(latencies, 0.95) * 1000,
+        'latency_ms_p99': percentile(latencies, 0.99) * 1000,
+    }
+    for kind in ('text', 'audio'):
+        kind_latencies = sorted(latency for k, ok, latency in results if ok and k == kind)
+        summary[f'{kind}_latency_ms_p95'] = percentile(kind_latencies, 0.95) * 1000
+    return summary
+
+
+def compare(current, baseline, tolerance):
+    """
+    印出與基準的比較，返回退步超過 tolerance 的指標
+    """
+    regressions = []
+    print(f"\n與基準比較 (容許 {tolerance:.0%})")
+    print(f"{'指標':<20}{'基準':>12}{'本次':>12}{'變化':>10}")
+    for name, higher_is_better in COMPARED_METRICS:
+        before, after = baseline.get(name), current.get(name)
+        if before is None or after is None:
+            continue
+        change = (after - before) / before if before else 0.0
+        worse = -change if higher_is_better else change
+        # 記憶體增長的數值很小，只在超過 1 MB 時才算退步
+        regressed = worse > tolerance and not (name == 'memory_growth_mb' and after - before < 1)
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<20}{before:>12.2f}{after:>12.2f}{change:>+10.1%}{'  退步' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="離線的負載測試 (模擬 Gemini、語音識別與 TTS)")
+    parser.add_argument('--requests', type=int, default=400, help="測量的請求數")
+    parser.add_argument('--warmup', type=int, default=40, help="測量前先送出的請求數 (不計入結果)")
+    parser.add_argument('--concurrency', type=int, default=16, help="同時進行的使用者數")
+    parser.add_argument('--session-turns', type=int, default=5, help="每個使用者在同一段對話中連續送出的請求數")
+    parser.add_argument('--conversations', type=int, default=40, help="多輪對話情境的對話數 (0 表示不測量)")
+    parser.add_argument('--conversation-turns', type=int, default=4, help="多輪對話情境中每段對話的問題數 (含追問)")
+    parser.add_argument('--context-mode', choices=('always', 'follow-up'), default='always',
+                        help="應用程式的 CONTEXT_MODE (follow-up 時同一段對話中沒有指涉用語的問題也使用緩存)")
+    parser.add_argument('--audio-ratio', type=float, default=0.3, help="/process_audio 請求的比例")
+    parser.add_argument('--mix', help="查詢組合的檔案 (每行 權重<Tab>問題)，預設使用內建的組合")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.2, help="模擬 Gemini 的回應延遲秒數")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="模擬 Gemini 隨機回應 429 的比例")
+    parser.add_argument('--reply-chars', type=int, default=200, help="模擬 Gemini 回應的字數")
+    parser.add_argument('--asr-latency', type=float, default=0.05, help="模擬語音識別的延遲秒數")
+    parser.add_argument('--tts-latency', type=float, default=0.01, help="模擬每段語音合成的延遲秒數")
+    parser.add_argument('--fetch-audio', action='store_true', help="延遲包括下載所有語音片段")
+    parser.add_argument('--baseline', help="與此基準檔案比較")
+    parser.add_argument('--save-baseline', help="將本次結果保存為基準檔案")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="與基準比較時容許的退步比例")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="mysiri_load_")
+    gemini = start_mock_server(latency=args.latency, error_rate=args.error_rate,
+                               reply_chars=args.reply_chars, seed=args.seed)
+    os.environ['GEMINI_API_BASE'] = gemini.base_url
+    # 模擬伺服器的 429 由應用程式的備援策略處理，不需要在本地排隊
+    os.environ.setdefault('GEMINI_RATE_LIMITS', '')
+    os.environ['TTS_CACHE_DIR'] = os.path.join(work_dir, 'tts')
+    os.environ['CONVERSATION_DB_PATH'] = os.path.join(work_dir, 'conversations.db')
+    os.environ['CONTEXT_MODE'] = args.context_mode
+
+    mix = QueryMix(load_mix(args.mix) if args.mix else DEFAULT_MIX, args.seed)
+    install_fakes(mix, args.asr_latency, args.tts_latency)
+
+    import app
+    server = make_server('127.0.0.1', 0, app.create_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    clips = [make_clip(work_dir, index) for index in range(len(mix.queries))]
+    schedule_random = random.Random(args.seed)
+    schedule = [
+        ('audio' if schedule_random.random() < args.audio_ratio else 'text', mix.pick())
+        for _ in range(args.warmup + args.requests)
+    ]
+
+    run_load(base_url, mix, clips, schedule[:args.warmup], args.concurrency, args.fetch_audio, args.session_turns)
+    cache_before = app.response_cache.stats()
+    bypass_before = app.pipeline_metrics.counter('cache_lookups_total', result='bypass')
+    memory_before = rss_mb()
+    start = time.perf_counter()
+    results = run_load(base_url, mix, clips, schedule[args.warmup:], args.concurrency, args.fetch_audio,
+                       args.session_turns)
+    elapsed = time.perf_counter() - start
+    memory_after = rss_mb()
+    cache_after = app.response_cache.stats()
+    bypassed = app.pipeline_metrics.counter('cache_lookups_total', result='bypass') - bypass_before
+
+    conversation_results = []
+    if args.conversations:
+        bypass_before = app.pipeline_metrics.counter('cache_lookups_total', result='bypass')
+        conversation_results = run_conversations(base_url, mix, args.conversations, args.conversation_turns,
+                                                 args.concurrency, args.seed)
+        conversation_bypassed = app.pipeline_metrics.counter('cache_lookups_total', result='bypass') - bypass_before
+    server.shutdown()
+
+    summary = summarize(results, elapsed)
+    hits = cache_after['hits'] - cache_before['hits']
+    misses = cache_after['misses'] - cache_before['misses']
+    summary['cache_hit_ratio'] = hits / (hits + misses) if hits + misses else 0.0
+    summary['cache_bypassed'] = bypassed
+    summary['memory_growth_mb'] = memory_after - memory_before
+    summary['memory_mb'] = memory_after
+    summary['gemini_calls'] = sum(gemini.calls.values())
+    summary['gemini_429'] = sum(gemini.rejected.values())
+    summary['stage_ms_p95'] = {stage: stats['ms_p95'] for stage, stats in app.pipeline_metrics.stage_stats().items()}
+
+    print(f"請求 {summary['requests']} 個 (失敗 {summary['failures']})，同時 {args.concurrency} 個使用者，"
+          f"語音比例 {args.audio_ratio:.0%}，耗時 {elapsed:.2f} s")
+    print(f"每秒請求數      {summary['requests_per_sec']:.1f}")
+    print(f"延遲 p50/p95/p99 {summary['latency_ms_p50']:.0f} / {summary['latency_ms_p95']:.0f} / "
+          f"{summary['latency_ms_p99']:.0f} ms (文字 p95 {summary['text_latency_ms_p95']:.0f} ms，"
+          f"語音 p95 {summary['audio_latency_ms_p95']:.0f} ms)")
+    print(f"緩存命中率      {summary['cache_hit_ratio']:.1%} (帶入上下文、不使用緩存 {bypassed} 個)")
+    print(f"Gemini 呼叫     {summary['gemini_calls']} 次 (429: {summary['gemini_429']})")
+    print(f"記憶體          {summary['memory_mb']:.1f} MB (增長 {summary['memory_growth_mb']:+.1f} MB)")
+    print("各步驟 p95 (ms) " + ", ".join(f"{stage} {ms:.1f}" for stage, ms in sorted(summary['stage_ms_p95'].items())))
+
+    if conversation_results:
+        first = sorted(latency for turn, ok, latency in conversation_results if ok and turn == 0)
+        follow_ups = sorted(latency for turn, ok, latency in conversation_results if ok and turn > 0)
+        summary['conversation_failures'] = sum(1 for _, ok, _ in conversation_results if not ok)
+        summary['conversation_bypassed'] = conversation_bypassed
+        summary['first_latency_ms_p95'] = percentile(first, 0.95) * 1000
+        summary['follow_up_latency_ms_p50'] = percentile(follow_ups, 0.5) * 1000
+        summary['follow_up_latency_ms_p95'] = percentile(follow_ups, 0.95) * 1000
+        print(f"\n多輪對話        {args.conversations} 段，每段 {args.conversation_turns} 個問題 "
+              f"(失敗 {summary['conversation_failures']}，帶入上下文 {conversation_bypassed} 個)")
+        print(f"第一個問題 p95  {summary['first_latency_ms_p95']:.0f} ms")
+        print(f"追問 p50/p95    {summary['follow_up_latency_ms_p50']:.0f} / {summary['follow_up_latency_ms_p95']:.0f} ms")
+
+    # 基準只在相同的參數下才有比較意義，一起保存
+    summary['options'] = {key: value for key, value in vars(args).items()
+                          if key not in ('baseline', 'save_baseline', 'tolerance')}
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('options') != summary['options']:
+            print("注意：基準使用不同的參數，比較結果僅供參考")
+        if compare(summary, baseline, args.tolerance) or summary['failures'] or summary.get('conversation_failures'):
+            exit_code = 1
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"\n已保存基準: {args.save_baseline}")
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""
+模擬 Gemini REST API 的本地伺服器
+支援 generateContent 與 streamGenerateContent (alt=sse)，可設定延遲與回應的字數，
+也可以讓個別模型固定回應錯誤狀態碼 (例如 429)、以不同的延遲回應、模擬每分鐘請求數的配額，
+或讓一定比例的呼叫隨機回應 429，讓應用程式在不消耗真實配額的情況下進行測試與基準測試
+
+用法:
+    python benchmarks/mock_gemini_server.py --port 8765 --latency 0.2
+    python benchmarks/mock_gemini_server.py --status gemini-2.0-flash=429 --model-latency gemini-1.0-pro=3
+    python benchmarks/mock_gemini_server.py --rpm gemini-2.0-flash=15
+    python benchmarks/mock_gemini_server.py --error-rate 0.05 --reply-chars 400
+    GEMINI_API_BASE=http://127.0.0.1:8765 python app.py
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = "這是模擬的回應。今天天氣晴朗，適合出門散步！還有其他問題嗎？"
+
+_MODEL_PATH = re.compile(r'/models/([^:/]+):')
+
+
+def _candidate(text):
+    return {"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]}
+
+
+class MockGeminiHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 才會保持連線
+    protocol_version = 'HTTP/1.1'
+    # 標頭與內容分開寫出，保持連線時需關閉 Nagle 演算法以免被延遲 ACK 拖慢
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            payload = json.loads(body)
+            prompt = payload["contents"][-1]["parts"][0]["text"]
+        except (ValueError, KeyError, IndexError):
+            payload, prompt = {}, ""
+        reply = self.server.reply_for(prompt)
+        match = _MODEL_PATH.search(self.path)
+        model = match.group(1) if match else None
+        over_quota = self.server.record_call(model)
+        try:
+            self._respond(model, reply, over_quota)
+        finally:
+            self.server.end_call()
+
+    def _respond(self, model, reply, over_quota):
+        latency = self.server.model_latency.get(model, self.server.latency)
+
+        status = 429 if over_quota else self.server.model_status.get(model, 200)
+        if status != 200:
+            time.sleep(latency)
+            self._send_json(status, {"error": {"code": status, "message": f"模擬的錯誤 ({model})"}})
+        elif ':streamGenerateContent' in self.path:
+            self._stream(reply, latency)
+        else:
+            time.sleep(latency)
+            self._send_json(200, _candidate(reply))
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, reply, latency):
+        # 以 SSE 格式分段送出回應 (chunked 傳輸)，每段之間間隔 chunk_delay
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        time.sleep(latency)
+        size = self.server.chunk_chars
+        for i in range(0, len(reply), size):
+            event = json.dumps(_candidate(reply[i:i + size]), ensure_ascii=False)
+            self._write_chunk(f"data: {event}\r\n\r\n".encode('utf-8'))
+            time.sleep(self.server.chunk_delay)
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockGeminiServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 預設的 listen backlog 只有 5，大量同時連線時會被拒絕並延遲重試
+    request_queue_size = 1024
+
+    def __init__(self, address, latency=0.0, chunk_delay=0.05, chunk_chars=8, reply=None, echo=False,
+                 model_status=None, model_latency=None, model_rpm=None, error_rate=0.0, reply_chars=None, seed=None):
+        super().__init__(address, MockGeminiHandler)
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.chunk_chars = chunk_chars
+        self.reply = reply
+        self.echo = echo
+        # 模型名稱 -> 固定回應的狀態碼 / 延遲秒數，執行中可以直接修改
+        self.model_status = dict(model_status or {})
+        self.model_latency = dict(model_latency or {})
+        # 模型名稱 -> 每分鐘請求數上限，超過時回應 429
+        self.model_rpm = dict(model_rpm or {})
+        # 隨機回應 429 的呼叫比例，與回應的字數 (None 表示使用原本的回應)
+        self.error_rate = error_rate
+        self.reply_chars = reply_chars
+        self._random = random.Random(seed)
+        self.calls = {}
+        self.rejected = {}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._recent = {}
+        self._calls_lock = threading.Lock()
+
+    def record_call(self, model):
+        """
+        記錄一次呼叫，返回是否要回應 429 (超過該模型的每分鐘請求數配額，或隨機被限流)
+        """
+        now = time.monotonic()
+        with self._calls_lock:
+            self.calls[model] = self.calls.get(model, 0) + 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.rejected[model] = self.rejected.get(model, 0) + 1
+                return True
+            rpm = self.model_rpm.get(model)
+            if rpm is None:
+                return False
+            recent = self._recent.setdefault(model, [])
+            recent[:] = [t for t in recent if now - t < 60]
+            if len(recent) >= rpm:
+                self.rejected[model] = self.rejected.get(model, 0) + 1
+                return True
+            recent.append(now)
+            return False
+
+    def end_call(self):
+        with self._calls_lock:
+            self.in_flight -= 1
+
+    def reply_for(self, prompt):
+        # echo 模式下回應包含原始問題，方便驗證每個請求拿到自己的回應
+        if self.echo:
+            reply = f"收到：{prompt}。"
+        else:
+            reply = self.reply if self.reply is not None else DEFAULT_REPLY
+        if self.reply_chars is None:
+            return reply
+        # 重複預設的回應補足到指定的字數
+        padding = DEFAULT_REPLY * (self.reply_chars // len(DEFAULT_REPLY) + 1)
+        return (reply + padding)[:max(self.reply_chars, len(reply) if self.echo else 0)]
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+
+def start_mock_server(host='127.0.0.1', port=0, **kwargs):
+    """
+    在背景執行緒啟動模擬伺服器，返回伺服器物件 (以 base_url 取得位址)
+    """
+    server = MockGeminiServer((host, port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模擬 Gemini REST API 的本地伺服器")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help="回應前的延遲秒數")
+    parser.add_argument('--chunk-delay', type=float, default=0.05, help="串流模式下每段之間的延遲秒數")
+    parser.add_argument('--status', action='append', default=[], metavar='MODEL=CODE',
+                        help="讓指定模型固定回應此狀態碼，例如 gemini-2.0-flash=429")
+    parser.add_argument('--model-latency', action='append', default=[], metavar='MODEL=SECONDS',
+                        help="指定模型的回應延遲秒數")
+    parser.add_argument('--rpm', action='append', default=[], metavar='MODEL=RPM',
+                        help="指定模型的每分鐘請求數配額，超過時回應 429")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="隨機回應 429 的呼叫比例 (0~1)")
+    parser.add_argument('--reply-chars', type=int, default=None, help="回應的字數")
+    args = parser.parse_args()
+
+    server = MockGeminiServer(
+        (args.host, args.port), latency=args.latency, chunk_delay=args.chunk_delay,
+        model_status={model: int(code) for model, code in (item.split('=', 1) for item in args.status)},
+        model_latency={model: float(sec) for model, sec in (item.split('=', 1) for item in args.model_latency)},
+        model_rpm={model: int(rpm) for model, rpm in (item.split('=', 1) for item in args.rpm)},
+        error_rate=args.error_rate, reply_chars=args.reply_chars
+    )
+    print(f"模擬 Gemini 伺服器運行於 {server.base_url}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
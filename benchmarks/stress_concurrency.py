@@ -0,0 +1,126 @@
+"""
+並發壓力測試：同時發送大量 /process_audio 與 /text_input 請求，
+驗證每個使用者拿到的回應文字與語音都是自己的
+
+使用本地模擬的 Gemini 伺服器 (回應中包含原始問題)、模擬的語音識別
+(依錄音長度辨識出使用者編號) 與模擬的 TTS 引擎 (將文字寫入音頻檔)，
+需要 ffmpeg 產生測試用的 WebM 錄音
+
+用法: python benchmarks/stress_concurrency.py [--users 20]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pyttsx3
+import requests
+import speech_recognition as sr
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_gemini_server import start_mock_server
+
+# 第 i 個語音使用者的錄音長度為 BASE_SECONDS + i * STEP_SECONDS
+BASE_SECONDS = 0.5
+STEP_SECONDS = 0.2
+
+
+class FakeTTSEngine:
+    """將要合成的文字直接寫入檔案的 TTS 引擎"""
+    def __init__(self):
+        self._jobs = []
+
+    def setProperty(self, name, value):
+        pass
+
+    def save_to_file(self, text, path):
+        self._jobs.append((text, path))
+
+    def runAndWait(self):
+        for text, path in self._jobs:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        self._jobs = []
+
+    def stop(self):
+        pass
+
+
+def fake_recognize_google(self, audio_data, language=None, **kwargs):
+    """依錄音長度推算使用者編號"""
+    seconds = len(audio_data.frame_data) / (audio_data.sample_rate * audio_data.sample_width)
+    user = round((seconds - BASE_SECONDS) / STEP_SECONDS)
+    return f"語音使用者{user}號"
+
+
+def make_clip(directory, user):
+    path = os.path.join(directory, f"user{user}.webm")
+    subprocess.run([
+        'ffmpeg', '-loglevel', 'error', '-y', '-f', 'lavfi', '-i', 'anullsrc=r=48000:cl=mono',
+        '-t', str(BASE_SECONDS + user * STEP_SECONDS), '-c:a', 'libopus', path
+    ], check=True)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def fetch_audio_text(base_url, urls):
+    return ''.join(requests.get(base_url + url, timeout=60).content.decode('utf-8') for url in urls)
+
+
+def voice_user(base_url, user, clip):
+    expected = f"語音使用者{user}號"
+    response = requests.post(base_url + '/process_audio', files={'audio': ('recording.webm', clip, 'audio/webm')},
+                             timeout=120).json()
+    audio_text = fetch_audio_text(base_url, response.get('audio_segments', []))
+    return (response.get('input_text') == expected and expected in response.get('response_text', '')
+            and expected in audio_text)
+
+
+def text_user(base_url, user):
+    expected = f"文字使用者{user}號"
+    response = requests.post(base_url + '/text_input', json={'text': expected}, timeout=120).json()
+    audio_text = fetch_audio_text(base_url, response.get('audio_segments', []))
+    return expected in response.get('response_text', '') and expected in audio_text
+
+
+def main():
+    parser = argparse.ArgumentParser(description="並發壓力測試")
+    parser.add_argument('--users', type=int, default=20, help="同時發送請求的使用者數量")
+    args = parser.parse_args()
+    users = args.users
+    work_dir = tempfile.mkdtemp(prefix="mysiri_stress_")
+
+    gemini = start_mock_server(latency=0.05, echo=True)
+    os.environ['GEMINI_API_BASE'] = gemini.base_url
+    # 模擬伺服器沒有配額限制，不需要在本地排隊
+    os.environ.setdefault('GEMINI_RATE_LIMITS', '')
+    os.environ['TTS_CACHE_DIR'] = os.path.join(work_dir, 'tts')
+    os.environ['CONVERSATION_DB_PATH'] = os.path.join(work_dir, 'conversations.db')
+    pyttsx3.init = FakeTTSEngine
+    sr.Recognizer.recognize_google = fake_recognize_google
+
+    import app
+    server = make_server('127.0.0.1', 0, app.create_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    clips = [make_clip(work_dir, user) for user in range(users)]
+    with ThreadPoolExecutor(max_workers=users * 2) as executor:
+        voice_results = [executor.submit(voice_user, base_url, user, clips[user]) for user in range(users)]
+        text_results = [executor.submit(text_user, base_url, user) for user in range(users)]
+        voice_ok = sum(future.result() for future in voice_results)
+        text_ok = sum(future.result() for future in text_results)
+
+    server.shutdown()
+    print(f"語音請求: {voice_ok}/{users} 拿到自己的回應與語音")
+    print(f"文字請求: {text_ok}/{users} 拿到自己的回應與語音")
+    sys.exit(0 if voice_ok == users and text_ok == users else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,380 @@
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from utils import generate_cache_key, normalize_query, tokenize_query, jaccard_similarity, SIMILARITY_THRESHOLD
+
+# 從共享存儲載入的記錄每批計算向量的數量
+INDEX_BATCH_SIZE = 256
+
+
+class CacheEntry:
+    """
+    緩存中的單筆記錄
+    保存原始查詢、回應以及預先計算好的 token 集合
+    warmed 表示由緩存預熱預先取得 (而不是即時請求的回應)，用於統計預熱的效果
+    """
+    __slots__ = ('key', 'query', 'normalized', 'tokens', 'response', 'created_at', 'size', 'warmed')
+
+    def __init__(self, key, query, normalized, tokens, response, created_at, warmed=False):
+        self.key = key
+        self.query = query
+        self.normalized = normalized
+        self.tokens = tokens
+        self.response = response
+        self.created_at = created_at
+        self.size = _entry_size(query, normalized, tokens, response)
+        self.warmed = warmed
+
+
+def _entry_size(query, normalized, tokens, response):
+    """
+    估算一筆記錄佔用的位元組數 (以 UTF-8 編碼長度計算文字內容)
+    """
+    size = len(query.encode('utf-8')) + len(normalized.encode('utf-8')) + len(response.encode('utf-8'))
+    return size + sum(len(token.encode('utf-8')) for token in tokens)
+
+
+class ResponseCache:
+    """
+    帶有索引、容量上限的響應緩存
+    - 以正規化後的查詢做精確匹配 (dict)
+    - 以 token 前綴建立倒排索引，用於 Jaccard 相似查詢
+    - 以最小堆管理過期時間，查詢時不需掃描整個緩存
+    - 超過筆數或總位元組上限時，依 LRU 順序淘汰最久未使用的記錄
+    max_entries / max_bytes 為 None 或 0 時表示不限制
+
+    指定 store (例如 SQLiteCacheStore) 時，寫入會同步到共享存儲；
+    第一次查詢時才載入存儲中的記錄，之後在未命中時定期拉取其他進程新增的記錄
+
+    指定 semantic (semantic_cache.SemanticTier) 時，相似查詢也找不到的查詢再以向量的餘弦相似度查找；
+    向量索引與緩存記錄一起寫入、過期和淘汰
+    """
+    def __init__(self, expiry, threshold=SIMILARITY_THRESHOLD, max_entries=None, max_bytes=None,
+                 store=None, sync_interval=1.0, semantic=None):
+        self.expiry = expiry
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.store = store
+        self.sync_interval = sync_interval
+        self.semantic = semantic
+        self._store_cursor = None  # None 表示尚未從存儲預熱
+        self._last_sync = 0.0
+        self._sync_lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> CacheEntry，依最近使用順序排列
+        self._exact = {}         # 正規化查詢 -> key
+        self._index = {}         # token -> 以該 token 為前綴的 key 集合
+        self._expiry_heap = []   # (過期時間, key)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # 統計數據
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.warmed_hits = 0
+        self.semantic_hits = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _prefix_tokens(self, tokens):
+        """
+        前綴過濾：將 token 依固定的全域順序排序後取前綴
+        若兩個集合的 Jaccard 相似度 >= 閾值，它們的前綴必定有交集
+        """
+        ordered = sorted(tokens, key=lambda t: (hash(t), t))
+        prefix_len = len(ordered) - int(self.threshold * len(ordered)) + 1
+        return ordered[:max(1, min(prefix_len, len(ordered)))]
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry.size
+        if self.semantic is not None:
+            self.semantic.index.remove(key)
+        if self._exact.get(entry.normalized) == key:
+            del self._exact[entry.normalized]
+        for token in self._prefix_tokens(entry.tokens):
+            bucket = self._index.get(token)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._index[token]
+
+    def _purge_expired(self, now):
+        # 只彈出堆頂已過期的項目，攤銷成本為 O(log n)
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            expires_at, key = heapq.heappop(heap)
+            entry = self._entries.get(key)
+            # 同一個 key 可能已被重新寫入，只刪除時間戳相符的舊記錄
+            if entry is not None and entry.created_at + self.expiry == expires_at:
+                self._remove(key)
+                self.expirations += 1
+        # 被覆寫或淘汰的記錄會在堆中留下失效項目，過多時重建堆
+        if len(heap) > 2 * len(self._entries) + 64:
+            self._expiry_heap = [(entry.created_at + self.expiry, key) for key, entry in self._entries.items()]
+            heapq.heapify(self._expiry_heap)
+
+    def _evict_if_needed(self):
+        while self._entries and (
+            (self.max_entries and len(self._entries) > self.max_entries) or
+            (self.max_bytes and self._bytes > self.max_bytes)
+        ):
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def _is_fresh(self, entry, now):
+        return now - entry.created_at <= self.expiry
+
+    def _find(self, query, now):
+        normalized = normalize_query(query)
+        key = self._exact.get(normalized)
+        if key is not None:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_fresh(entry, now):
+                return entry
+
+        tokens = tokenize_query(normalized)
+        if not tokens:
+            return None
+
+        # 從倒排索引收集候選項，再以長度過濾和精確的 Jaccard 計算驗證
+        candidates = set()
+        for token in self._prefix_tokens(tokens):
+            bucket = self._index.get(token)
+            if bucket:
+                candidates.update(bucket)
+
+        size = len(tokens)
+        best_entry = None
+        best_similarity = self.threshold
+        for key in candidates:
+            entry = self._entries[key]
+            other_size = len(entry.tokens)
+            if other_size < self.threshold * size or size < self.threshold * other_size:
+                continue
+            if not self._is_fresh(entry, now):
+                continue
+            similarity = jaccard_similarity(tokens, entry.tokens)
+            if similarity > best_similarity:
+                best_entry = entry
+                best_similarity = similarity
+        return best_entry
+
+    def _find_semantic(self, vector, now):
+        match = self.semantic.search(vector)
+        if match is None:
+            return None
+        entry = self._entries.get(match[0])
+        if entry is None or not self._is_fresh(entry, now):
+            return None
+        return entry
+
+    def _embed(self, query):
+        """
+        計算查詢的向量，未啟用語意查找或向量化失敗時返回 None (只影響語意查找，不影響緩存本身)
+        """
+        if self.semantic is None:
+            return None
+        try:
+            return self.semantic.embed(query)
+        except Exception as e:
+            print(f"計算查詢向量時出錯: {e}")
+            return None
+
+    def _insert(self, entry, vector=None):
+        # 呼叫端需持有 self._lock
+        self._remove(entry.key)
+        # 單筆記錄已超過總容量上限時不存入緩存
+        if self.max_bytes and entry.size > self.max_bytes:
+            return
+        if vector is not None:
+            self.semantic.index.add(entry.key, vector)
+        self._entries[entry.key] = entry
+        self._bytes += entry.size
+        self._exact[entry.normalized] = entry.key
+        for token in self._prefix_tokens(entry.tokens):
+            self._index.setdefault(token, set()).add(entry.key)
+        heapq.heappush(self._expiry_heap, (entry.created_at + self.expiry, entry.key))
+        self._evict_if_needed()
+
+    def _lookup(self, query, now):
+        with self._lock:
+            self._purge_expired(now)
+            entry = self._find(query, now)
+            if entry is None:
+                return None
+            self._entries.move_to_end(entry.key)
+            return entry
+
+    def _lookup_semantic(self, query, now):
+        # 向量在鎖外計算，查找期間不阻塞其他請求
+        vector = self._embed(query)
+        if vector is None:
+            return None
+        with self._lock:
+            self._purge_expired(now)
+            entry = self._find_semantic(vector, now)
+            if entry is None:
+                return None
+            self._entries.move_to_end(entry.key)
+            return entry
+
+    def _index_entries(self, entries):
+        """
+        為從共享存儲載入的記錄分批計算向量並加入索引，期間已被覆寫或移除的記錄略過
+        """
+        for start in range(0, len(entries), INDEX_BATCH_SIZE):
+            batch = entries[start:start + INDEX_BATCH_SIZE]
+            try:
+                vectors = self.semantic.embed_many([entry.query for entry in batch])
+            except Exception as e:
+                print(f"計算共享緩存記錄的向量時出錯: {e}")
+                return
+            with self._lock:
+                for entry, vector in zip(batch, vectors):
+                    if self._entries.get(entry.key) is entry:
+                        self.semantic.index.add(entry.key, vector)
+
+    def _sync_from_store(self, now):
+        """
+        從共享存儲載入新的記錄，返回是否有載入任何記錄
+        """
+        if self.store is None:
+            return False
+        if self._store_cursor is not None and now - self._last_sync < self.sync_interval:
+            return False
+        # 已有其他執行緒在同步時直接跳過，避免請求互相等待
+        if not self._sync_lock.acquire(blocking=False):
+            return False
+        try:
+            warmup = self._store_cursor is None
+            rows, cursor = self.store.load_since(self._store_cursor or 0, limit=self.max_entries if warmup else None)
+            self._store_cursor = cursor
+            self._last_sync = now
+        except Exception as e:
+            print(f"從共享緩存載入記錄時出錯: {e}")
+            return False
+        finally:
+            self._sync_lock.release()
+
+        entries = []
+        for key, query, response, created_at in rows:
+            normalized = normalize_query(query)
+            entries.append(CacheEntry(key, query, normalized, tokenize_query(normalized), response, created_at))
+        with self._lock:
+            for entry in entries:
+                current = self._entries.get(entry.key)
+                if current is None or current.created_at < entry.created_at:
+                    self._insert(entry)
+        if self.semantic is not None and entries:
+            if warmup:
+                # 啟動時載入的記錄可能很多，在背景計算向量，不延遲第一個請求
+                threading.Thread(target=self._index_entries, args=(entries,),
+                                 name="semantic-cache-index", daemon=True).start()
+            else:
+                self._index_entries(entries)
+        if warmup:
+            print(f"從共享緩存預熱 {len(entries)} 筆記錄")
+        return bool(entries)
+
+    def get(self, query):
+        """
+        查找與查詢相同或相似的緩存回應，找不到時返回 None
+        """
+        now = time.time()
+        entry = self._lookup(query, now)
+        # 本地未命中時，檢查其他進程是否已緩存相似的查詢
+        if entry is None and self._sync_from_store(now):
+            entry = self._lookup(query, now)
+        # 字面上相似的查詢都找不到時，再以語意查找改寫過的查詢
+        semantic = False
+        if entry is None and self.semantic is not None:
+            entry = self._lookup_semantic(query, now)
+            semantic = entry is not None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if semantic:
+                self.semantic_hits += 1
+            if entry.warmed:
+                self.warmed_hits += 1
+        return entry.response
+
+    def contains(self, query):
+        """
+        是否已緩存相同或相似的查詢 (不計入命中統計，也不改變 LRU 順序)
+        """
+        now = time.time()
+        with self._lock:
+            self._purge_expired(now)
+            if self._find(query, now) is not None:
+                return True
+        if self._sync_from_store(now):
+            with self._lock:
+                if self._find(query, now) is not None:
+                    return True
+        vector = self._embed(query)
+        if vector is None:
+            return False
+        with self._lock:
+            return self._find_semantic(vector, now) is not None
+
+    def put(self, query, response, warmed=False):
+        """
+        將查詢及其回應存入緩存，返回緩存鍵
+        warmed 為 True 表示由緩存預熱預先取得 (共享存儲不保存這個標記)
+        """
+        now = time.time()
+        key = generate_cache_key(query)
+        normalized = normalize_query(query)
+        entry = CacheEntry(key, query, normalized, tokenize_query(normalized), response, now, warmed)
+        vector = self._embed(query)
+        with self._lock:
+            self._purge_expired(now)
+            self._insert(entry, vector)
+        if self.store is not None:
+            self.store.save(key, query, response, now)
+        return key
+
+    def stats(self):
+        """
+        返回緩存的統計數據
+        """
+        with self._lock:
+            self._purge_expired(time.time())
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'warmed_entries': sum(1 for entry in self._entries.values() if entry.warmed),
+                'warmed_hits': self.warmed_hits,
+                # 命中中由預熱的記錄提供的比例
+                'warmed_hit_share': self.warmed_hits / self.hits if self.hits else 0.0,
+                'semantic_hits': self.semantic_hits,
+                'semantic': self.semantic.stats() if self.semantic is not None else None,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._exact.clear()
+            self._index.clear()
+            self._expiry_heap.clear()
+            self._bytes = 0
+            if self.semantic is not None:
+                self.semantic.index.clear()
@@ -0,0 +1,144 @@
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+
+from utils import PerProcess, connect_sqlite
+
+# 通知寫入執行緒結束的標記
+_STOP = object()
+
+
+class SQLiteCacheStore(PerProcess):
+    """
+    以 SQLite (WAL 模式) 持久化響應緩存，讓多個 worker 進程共享同一份緩存
+    - 寫入先放入佇列，由背景執行緒批次提交，請求路徑不會等待磁碟同步
+    - 讀取以自增 id 作為游標，只載入上次同步之後新增的記錄
+    讀取連線與寫入執行緒在第一次使用時才建立 (見 PerProcess)
+    """
+    def __init__(self, path, expiry, batch_size=100, flush_interval=0.5):
+        PerProcess.__init__(self)
+        self.path = path
+        self.expiry = expiry
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = None
+        self._writer = None
+        self._reader = None
+        self._read_lock = threading.Lock()
+        self._closed = False
+
+        conn = connect_sqlite(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS response_cache (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT UNIQUE NOT NULL,
+                query TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_created_at ON response_cache (created_at)")
+        conn.commit()
+        conn.close()
+        atexit.register(self.close)
+
+    def _start_process(self, forked):
+        self._queue = queue.Queue()
+        self._reader = connect_sqlite(self.path)
+        self._writer = threading.Thread(target=self._write_loop, args=(self._queue,),
+                                        name="cache-store-writer", daemon=True)
+        self._writer.start()
+
+    def save(self, key, query, response, created_at):
+        """
+        非阻塞地加入一筆待寫入的記錄
+        """
+        if not self._closed:
+            self._per_process()
+            self._queue.put((key, query, response, created_at))
+
+    def load_since(self, last_id, limit=None):
+        """
+        載入 id 大於 last_id 且尚未過期的記錄
+        返回 (記錄列表, 讀到的最大 id)，記錄為 (key, query, response, created_at)
+        指定 limit 時只載入最新的 limit 筆 (用於啟動時的預熱)
+        """
+        min_created_at = time.time() - self.expiry
+        self._per_process()
+        with self._read_lock:
+            if limit:
+                rows = self._reader.execute(
+                    "SELECT id, key, query, response, created_at FROM response_cache "
+                    "WHERE id > ? AND created_at > ? ORDER BY id DESC LIMIT ?",
+                    (last_id, min_created_at, limit)
+                ).fetchall()
+                rows.reverse()
+            else:
+                rows = self._reader.execute(
+                    "SELECT id, key, query, response, created_at FROM response_cache "
+                    "WHERE id > ? AND created_at > ? ORDER BY id",
+                    (last_id, min_created_at)
+                ).fetchall()
+        # 游標取自這次讀到的記錄：另外查詢 MAX(id) 可能讀到較新的快照，跳過兩次查詢之間寫入的記錄
+        cursor = max([last_id] + [row[0] for row in rows])
+        return [row[1:] for row in rows], cursor
+
+    def _write_loop(self, jobs):
+        conn = connect_sqlite(self.path)
+        last_cleanup = time.time()
+        while True:
+            batch = []
+            try:
+                item = jobs.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = None
+            if item is not None:
+                batch.append(item)
+                # 收集佇列中已有的記錄，合併為一次交易
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(jobs.get_nowait())
+                    except queue.Empty:
+                        break
+
+            stop = any(entry is _STOP for entry in batch)
+            batch = [entry for entry in batch if entry is not _STOP]
+            try:
+                if batch:
+                    # INSERT OR REPLACE 會產生新的 id，讓其他進程能同步到覆寫後的記錄
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO response_cache (key, query, response, created_at) VALUES (?, ?, ?, ?)",
+                        batch
+                    )
+                    conn.commit()
+                now = time.time()
+                if now - last_cleanup > 60:
+                    conn.execute("DELETE FROM response_cache WHERE created_at <= ?", (now - self.expiry,))
+                    conn.commit()
+                    last_cleanup = now
+            except sqlite3.Error as e:
+                print(f"緩存寫入 SQLite 時出錯: {e}")
+            finally:
+                for _ in range(len(batch) + (1 if stop else 0)):
+                    jobs.task_done()
+            if stop:
+                conn.close()
+                return
+
+    def flush(self):
+        """
+        等待佇列中的記錄全部寫入
+        """
+        if self._started_here():
+            self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._started_here():
+            self._queue.put(_STOP)
+            self._writer.join(timeout=5)
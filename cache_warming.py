@@ -0,0 +1,206 @@
+"""
+依歷史查詢記錄預熱回應緩存
+讀取查詢記錄 (聊天歷史的 SQLite 資料庫、JSONL 或每行一個問題的文字檔)，依出現次數排序，
+在背景以配額預算內的速率預先取得熱門問題的回應
+
+用法:
+    python cache_warming.py conversations.db --top 20            # 只列出排名
+    CACHE_DB_PATH=cache.db python cache_warming.py conversations.db --warm  # 預先寫入共享緩存
+"""
+import argparse
+import json
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+from rate_limit import TokenBucket
+from utils import normalize_query
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+# JSONL 記錄中可能保存問題的欄位
+QUERY_FIELDS = ('text', 'query', 'user', 'user_message')
+
+
+def read_query_log(path, limit=None):
+    """
+    讀取查詢記錄中的問題 (依記錄順序)
+    - SQLite 資料庫：聊天歷史 (ConversationStore) 中使用者的訊息，limit 為最近的筆數
+    - .jsonl：每行一個 JSON 物件，取第一個存在的 text / query / user / user_message 欄位
+    - 其他：每行一個問題
+    """
+    with open(path, 'rb') as f:
+        header = f.read(len(SQLITE_HEADER))
+    if header == SQLITE_HEADER:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            rows = conn.execute(
+                "SELECT user_message FROM conversation_turns ORDER BY id DESC LIMIT ?",
+                (limit if limit else -1,)
+            ).fetchall()
+        finally:
+            conn.close()
+        return [row[0] for row in reversed(rows)]
+
+    queries = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith('.jsonl'):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                line = next((record[field] for field in QUERY_FIELDS
+                             if isinstance(record, dict) and isinstance(record.get(field), str)), None)
+                if not line:
+                    continue
+            queries.append(line)
+    return queries[-limit:] if limit else queries
+
+
+def rank_queries(queries, top=100, min_count=2):
+    """
+    依正規化後的問題計算出現次數，返回最常見的 top 個 [(問題, 次數)]
+    每組問題以最常出現的原始寫法代表，出現少於 min_count 次的問題不預熱
+    """
+    counts = Counter()
+    spellings = {}
+    for query in queries:
+        normalized = normalize_query(query)
+        if not normalized:
+            continue
+        counts[normalized] += 1
+        spellings.setdefault(normalized, Counter())[query] += 1
+    return [
+        (spellings[normalized].most_common(1)[0][0], count)
+        for normalized, count in counts.most_common(top)
+        if count >= min_count
+    ]
+
+
+class CacheWarmer:
+    """
+    在背景依序預先取得熱門問題的回應，fetch(query) 負責呼叫模型並以 warmed=True 存入緩存
+    - 每分鐘最多 rate 次預取，總共最多 budget 次 (配額預算，包括失敗的呼叫)
+    - ready() 返回 False 時暫停 (例如配額餘量不足或主要模型冷卻中)，讓即時請求優先使用配額
+    - 已緩存相同或相似問題的不重複取得
+    """
+    def __init__(self, cache, fetch, queries, rate=6, budget=50, ready=None, poll_interval=1.0):
+        self.cache = cache
+        self.fetch = fetch
+        self.queries = list(queries)
+        self.rate = rate
+        self.budget = budget
+        self.ready = ready
+        self.poll_interval = poll_interval
+        # 容量為 1：不累積額度，預取平均分散在時間上
+        self._bucket = TokenBucket(rate / 60.0, 1)
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.prefetched = 0
+        self.skipped = 0
+        self.failed = 0
+        self.paused_seconds = 0.0
+        self.position = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="cache-warmer", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _wait_until_ready(self):
+        # 返回 False 表示已停止
+        while self.ready is not None and not self.ready():
+            started = time.monotonic()
+            if self._stop.wait(self.poll_interval):
+                return False
+            with self._lock:
+                self.paused_seconds += time.monotonic() - started
+        return not self._stop.is_set()
+
+    def run(self):
+        for query, _ in self.queries:
+            if self.prefetched + self.failed >= self.budget:
+                break
+            with self._lock:
+                self.position += 1
+            if self.cache.contains(query):
+                with self._lock:
+                    self.skipped += 1
+                continue
+            if not self._wait_until_ready():
+                return
+            now = time.monotonic()
+            wait = self._bucket.wait_time(1, now)
+            self._bucket.take(1)
+            if wait > 0 and self._stop.wait(wait):
+                return
+            try:
+                self.fetch(query)
+                with self._lock:
+                    self.prefetched += 1
+            except Exception as e:
+                print(f"預熱緩存失敗 ({query}): {e}")
+                with self._lock:
+                    self.failed += 1
+        print(f"緩存預熱完成: 取得 {self.prefetched} 個，已在緩存中 {self.skipped} 個，失敗 {self.failed} 個")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': self.running,
+                'queries': len(self.queries),
+                'position': self.position,
+                'prefetched': self.prefetched,
+                'skipped': self.skipped,
+                'failed': self.failed,
+                'budget': self.budget,
+                'rate_per_min': self.rate,
+                'paused_seconds': round(self.paused_seconds, 1),
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="依歷史查詢記錄預熱回應緩存")
+    parser.add_argument('logs', nargs='+', help="查詢記錄 (聊天歷史的 SQLite 資料庫、.jsonl 或每行一個問題)")
+    parser.add_argument('--top', type=int, default=100, help="預熱最常見的問題數")
+    parser.add_argument('--min-count', type=int, default=2, help="至少出現的次數")
+    parser.add_argument('--limit', type=int, default=None, help="每個記錄只讀取最近的筆數")
+    parser.add_argument('--warm', action='store_true',
+                        help="呼叫模型預先取得回應 (需設定 CACHE_DB_PATH，寫入共享緩存供服務啟動時載入)")
+    parser.add_argument('--rate', type=float, default=6, help="每分鐘最多預取的次數")
+    parser.add_argument('--budget', type=int, default=50, help="最多呼叫模型的次數")
+    args = parser.parse_args()
+
+    queries = []
+    for path in args.logs:
+        queries.extend(read_query_log(path, args.limit))
+    ranked = rank_queries(queries, args.top, args.min_count)
+    print(f"讀取 {len(queries)} 個問題，{len(ranked)} 個出現至少 {args.min_count} 次")
+    for query, count in ranked:
+        print(f"{count:>6}  {query}")
+    if not args.warm:
+        return
+
+    import app
+    if app.cache_store is None:
+        print("注意：未設定 CACHE_DB_PATH，預先取得的回應只保存在這個進程中")
+    # 在前景執行，完成後才結束
+    CacheWarmer(app.response_cache, app.prefetch_response, ranked,
+                rate=args.rate, budget=args.budget, ready=app.cache_warming_ready).run()
+    print(app.response_cache.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import re
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from rate_limit import estimate_tokens
+
+# 送給模型備援策略的請求：目前的問題與先前對話的 Gemini contents (不含目前的問題)
+Prompt = namedtuple('Prompt', ['text', 'history'])
+
+SUMMARY_PROMPT = (
+    "請將以下對話整理成不超過 {max_chars} 字的繁體中文摘要，保留使用者提到的事實、偏好與尚未解決的問題，"
+    "只輸出摘要本身。\n"
+    "{previous}"
+    "對話：\n{dialogue}"
+)
+
+
+# 指涉先前對話的用語：代名詞、指示詞、接續的追問 (例如 "那台中呢"、"為什麼"、"再詳細一點")
+_FOLLOW_UP = re.compile(
+    r'[它他她]|[這那][個些樣裡邊種麼]|剛[才剛]|之前|前面|上面|上一|繼續|還有|然後|為什麼|為何|再|更多|詳細|'
+    r'舉[個例]|另[一外]|其他|第[一二三四五六七八九十\d]+[個點項]|呢\W*$|'
+    r'\b(it|its|that|this|these|those|they|them|he|she|his|her|why|more|again|continue|previous|above|else)\b',
+    re.IGNORECASE
+)
+
+
+def depends_on_context(query):
+    """
+    粗略判斷問題是否指涉先前的對話 (只用於 CONTEXT_MODE=follow-up 的緩存最佳化)
+    沒有指涉用語的問題仍可能需要上下文，因此預設每個問題都帶入上下文
+    """
+    return _FOLLOW_UP.search(query.strip()) is not None
+
+
+def user_content(text):
+    return {"role": "user", "parts": [{"text": text}]}
+
+
+def model_content(text):
+    return {"role": "model", "parts": [{"text": text}]}
+
+
+def contents_text(contents):
+    """
+    contents 中所有文字合併，用於估計 token 數量
+    """
+    return ''.join(part.get("text", "") for content in contents for part in content["parts"])
+
+
+class ConversationContext:
+    """
+    為每個對話組成送給 Gemini 的多輪上下文，總長度不超過 token_budget
+    - 從最新的一輪往前加入完整的對話，直到超過預算
+    - 放不下的較早對話在背景以模型濃縮成摘要 (增量：每次只把新移出的對話併入既有摘要)，
+      摘要作為上下文的開頭；摘要完成前這些對話直接省略 (截斷)
+    - 遲滯：需要摘要時一次移出較多的對話，只保留不超過 compact_to 比例的預算與輪數，
+      之後的幾輪都放得下，穩定狀態下每隔數輪才摘要一次，而不是每輪都呼叫模型
+    因此每次請求的內容大小與延遲不會隨對話變長而增加，摘要也不在請求路徑上產生
+
+    summarize(previous_summary, turns, max_chars) 返回新的摘要文字；為 None 時只截斷
+    """
+    def __init__(self, store, token_budget=2000, max_turns=20, summarize=None, summary_share=0.25, compact_to=0.5):
+        self.store = store
+        self.token_budget = token_budget
+        self.max_turns = max_turns
+        self.summarize = summarize
+        self.compact_to = compact_to
+        # 摘要最多佔用的預算比例
+        self.summary_tokens = int(token_budget * summary_share)
+        self._compacting = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="context-compactor")
+        self.compactions = 0
+        self.compaction_failures = 0
+
+    @property
+    def enabled(self):
+        return self.token_budget > 0
+
+    def build(self, session_id):
+        """
+        返回目前對話的上下文 (Gemini contents 列表，不含目前的問題)；新的對話返回空列表
+        """
+        if not self.enabled or session_id is None:
+            return []
+        summary, covered_until = self.store.get_summary(session_id)
+        turns, older = self.store.history(session_id, limit=self.max_turns)
+        fresh = [turn for turn in turns if turn['id'] > covered_until]
+
+        budget = self.token_budget - (estimate_tokens(summary) if summary else 0)
+        kept = []
+        costs = []
+        for turn in reversed(fresh):
+            cost = estimate_tokens(turn['user']) + estimate_tokens(turn['system'])
+            if cost > budget:
+                break
+            kept.append(turn)
+            costs.append(cost)
+            budget -= cost
+        kept.reverse()
+        costs.reverse()
+
+        # 有對話被移出上下文 (放不下，或比讀取的範圍更早) 且尚未併入摘要時，在背景更新摘要
+        evicted = len(kept) < len(fresh) or (older is not None and turns and turns[0]['id'] - 1 > covered_until)
+        if evicted and fresh:
+            boundary = self._compaction_boundary(kept, costs, fresh)
+            if boundary > covered_until:
+                self._schedule_compaction(session_id, boundary)
+
+        contents = []
+        if summary:
+            contents.append(user_content(f"（先前對話的摘要）{summary}"))
+            contents.append(model_content("好的，我記得先前的對話。"))
+        for turn in kept:
+            contents.append(user_content(turn['user']))
+            contents.append(model_content(turn['system']))
+        return contents
+
+    def _compaction_boundary(self, kept, costs, fresh):
+        """
+        摘要涵蓋到的最後一輪 id：這次請求仍使用完整的 kept，但摘要完成後只留下最新的幾輪
+        (不超過 compact_to 比例的預算與輪數，至少一輪)，讓之後的對話有空間累積
+        """
+        if not kept:
+            return fresh[-1]['id']
+        retained_tokens = self.token_budget * self.compact_to
+        retained_turns = max(1, int(self.max_turns * self.compact_to))
+        boundary = kept[-1]['id'] - 1
+        used = costs[-1]
+        for count, (turn, cost) in enumerate(zip(reversed(kept[:-1]), reversed(costs[:-1])), 2):
+            used += cost
+            if used > retained_tokens or count > retained_turns:
+                break
+            boundary = turn['id'] - 1
+        return boundary
+
+    def _schedule_compaction(self, session_id, boundary):
+        if self.summarize is None:
+            return
+        with self._lock:
+            if session_id in self._compacting:
+                return
+            self._compacting.add(session_id)
+        self._executor.submit(self._compact, session_id, boundary)
+
+    def _compact(self, session_id, boundary):
+        try:
+            summary, covered_until = self.store.get_summary(session_id)
+            turns = self.store.turns_between(session_id, covered_until, boundary)
+            if turns:
+                # 摘要字數上限：中文約每字一個 token
+                summary = self.summarize(summary, turns, self.summary_tokens)
+                # 模型不一定遵守字數限制，超過預算時截斷，避免摘要本身佔滿上下文
+                if estimate_tokens(summary) > self.summary_tokens:
+                    summary = summary[:self.summary_tokens]
+            self.store.save_summary(session_id, summary, boundary)
+            with self._lock:
+                self.compactions += 1
+        except Exception as e:
+            # 摘要失敗時這些對話維持截斷，下次請求再重試
+            print(f"對話摘要失敗: {e}")
+            with self._lock:
+                self.compaction_failures += 1
+        finally:
+            with self._lock:
+                self._compacting.discard(session_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'token_budget': self.token_budget,
+                'max_turns': self.max_turns,
+                'compact_to': self.compact_to,
+                'compacting': len(self._compacting),
+                'compactions': self.compactions,
+                'compaction_failures': self.compaction_failures,
+            }
+
+
+def build_summary_prompt(previous_summary, turns, max_chars):
+    previous = f"先前的摘要：{previous_summary}\n" if previous_summary else ""
+    dialogue = "\n".join(f"使用者：{turn['user']}\n助理：{turn['system']}" for turn in turns)
+    return SUMMARY_PROMPT.format(max_chars=max_chars, previous=previous, dialogue=dialogue)
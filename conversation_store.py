@@ -0,0 +1,159 @@
+import atexit
+import datetime
+import threading
+import time
+
+from utils import PerProcess, connect_sqlite
+
+
+def _turn(row):
+    turn_id, user_message, system_response, timestamp = row
+    return {'id': turn_id, 'user': user_message, 'system': system_response, 'timestamp': timestamp}
+
+
+class ConversationStore(PerProcess):
+    """
+    以 SQLite (WAL 模式) 在服務器端保存聊天歷史，以 session ID 區分對話
+    cookie 中只需要保存 session ID，不再隨每個請求傳送完整的歷史記錄
+    - 每個對話只保留最近的 max_turns 輪
+    - 超過 ttl 秒沒有新訊息的對話會被刪除
+    - 以自增 id 作為游標分頁讀取，讀取較早的記錄時不需要載入整個對話
+    多個 worker 進程可以共用同一個資料庫檔案，每個進程使用自己的連線 (見 PerProcess)
+    """
+    def __init__(self, path, max_turns=500, ttl=30 * 24 * 60 * 60, cleanup_interval=60 * 60):
+        PerProcess.__init__(self)
+        self.path = path
+        self.max_turns = max_turns
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self._lock = threading.Lock()
+        self._last_cleanup = 0.0
+
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_turns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                user_message TEXT NOT NULL,
+                system_response TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_conversation_turns_session ON conversation_turns (session_id, id)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_conversation_turns_created_at ON conversation_turns (created_at)"
+        )
+        # 已移出上下文的較早對話的摘要，covered_until 為摘要涵蓋到的最後一輪 id
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_summaries (
+                session_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                covered_until INTEGER NOT NULL
+            )
+        """)
+        self._conn.commit()
+        atexit.register(self.close)
+
+    def _start_process(self, forked):
+        return connect_sqlite(self.path)
+
+    @property
+    def _conn(self):
+        return self._per_process()
+
+    def append(self, session_id, user_message, system_response):
+        """
+        新增一輪對話，返回它的 id
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO conversation_turns (session_id, user_message, system_response, timestamp, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (session_id, user_message, system_response, datetime.datetime.now().isoformat(), now)
+            )
+            turn_id = cursor.lastrowid
+            # 只保留該對話最近的 max_turns 輪 (id 由所有對話共用，需要以 OFFSET 找出分界)
+            self._conn.execute(
+                "DELETE FROM conversation_turns WHERE session_id = ? AND id <= ("
+                "SELECT id FROM conversation_turns WHERE session_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (session_id, session_id, self.max_turns)
+            )
+            if now - self._last_cleanup > self.cleanup_interval:
+                self._delete_expired(now)
+            self._conn.commit()
+        return turn_id
+
+    def _delete_expired(self, now):
+        # 呼叫端需持有鎖；刪除最後一則訊息已超過 ttl 的整個對話
+        self._conn.execute(
+            "DELETE FROM conversation_turns WHERE session_id IN ("
+            "SELECT session_id FROM conversation_turns GROUP BY session_id HAVING MAX(created_at) <= ?)",
+            (now - self.ttl,)
+        )
+        self._conn.execute(
+            "DELETE FROM conversation_summaries WHERE session_id NOT IN (SELECT DISTINCT session_id FROM conversation_turns)"
+        )
+        self._last_cleanup = now
+
+    def history(self, session_id, before=None, limit=20):
+        """
+        讀取一頁聊天歷史，返回 (依時間排序的記錄列表, 下一頁的游標)
+        before 為游標 (只讀取 id 小於它的記錄)，沒有更早的記錄時下一頁的游標為 None
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, user_message, system_response, timestamp FROM conversation_turns "
+                "WHERE session_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (session_id, before if before is not None else 2 ** 63 - 1, limit + 1)
+            ).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        turns = [_turn(row) for row in rows]
+        return turns, (turns[0]['id'] if has_more else None)
+
+    def turns_between(self, session_id, after_id, until_id):
+        """
+        讀取 after_id < id <= until_id 的記錄 (依時間排序)
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, user_message, system_response, timestamp FROM conversation_turns "
+                "WHERE session_id = ? AND id > ? AND id <= ? ORDER BY id",
+                (session_id, after_id, until_id)
+            ).fetchall()
+        return [_turn(row) for row in rows]
+
+    def get_summary(self, session_id):
+        """
+        返回 (摘要, 摘要涵蓋到的最後一輪 id)，沒有摘要時返回 ("", 0)
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT summary, covered_until FROM conversation_summaries WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return row if row else ("", 0)
+
+    def save_summary(self, session_id, summary, covered_until):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO conversation_summaries (session_id, summary, covered_until) VALUES (?, ?, ?)",
+                (session_id, summary, covered_until)
+            )
+            self._conn.commit()
+
+    def count(self, session_id):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM conversation_turns WHERE session_id = ?", (session_id,)
+            ).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._started_here():
+                self._conn.close()
+                self._forget_process()
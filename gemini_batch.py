@@ -0,0 +1,118 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from utils import PerProcess, percentile
+
+
+class PromptBatcher(PerProcess):
+    """
+    合併同時到達的 Gemini 請求
+    請求放入佇列後由固定數量的執行緒處理：每個執行緒取出第一個請求後，最多再等待 max_wait 秒
+    收集其他同時到達的請求 (最多 max_batch 個)，一起交給 dispatch，
+    dispatch 接收問題的列表，返回相同長度的列表，每個元素是回應文字或該請求的異常
+
+    fill_ratio (平均批次大小 / max_batch) 表示合併的效果：接近 0 代表負載低、幾乎沒有合併，
+    此時 max_wait 只會增加延遲，應該調低或關閉批次處理
+    執行緒在第一個請求時才啟動 (見 PerProcess)
+    """
+    def __init__(self, dispatch, max_batch=8, max_wait=0.005, workers=4, name="gemini", latency_window=200):
+        PerProcess.__init__(self)
+        self.dispatch = dispatch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.workers = workers
+        self.name = name
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._waits = deque(maxlen=latency_window)
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.batches = 0
+        self.full_batches = 0
+        self._threads = []
+
+    def _start_process(self, forked):
+        self._queue = queue.Queue()
+        self._threads = [
+            threading.Thread(target=self._run, args=(self._queue,), name=f"{self.name}-batch-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+        return self._queue
+
+    def submit(self, prompt):
+        future = Future()
+        with self._lock:
+            self.submitted += 1
+        jobs = self._per_process()
+        jobs.put((prompt, future, time.perf_counter()))
+        return future
+
+    def call(self, prompt, timeout=None):
+        """
+        取得一個問題的回應，會阻塞直到所在的批次完成
+        """
+        return self.submit(prompt).result(timeout=timeout)
+
+    def _collect(self, jobs):
+        batch = [jobs.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(jobs.get(timeout=remaining) if remaining > 0 else jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, jobs):
+        while True:
+            # 已取消的請求 (例如非同步模式下落後的對沖請求) 不再送出
+            batch = [item for item in self._collect(jobs) if item[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            dispatched_at = time.perf_counter()
+            try:
+                results = self.dispatch([prompt for prompt, _, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            with self._lock:
+                self.batches += 1
+                if len(batch) == self.max_batch:
+                    self.full_batches += 1
+                for (_, _, submitted_at), result in zip(batch, results):
+                    self._waits.append(dispatched_at - submitted_at)
+                    if isinstance(result, Exception):
+                        self.failed += 1
+                    else:
+                        self.completed += 1
+            for (_, future, _), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            processed = self.completed + self.failed
+            avg_batch_size = processed / self.batches if self.batches else 0.0
+            return {
+                'max_batch': self.max_batch,
+                'max_wait_ms': self.max_wait * 1000,
+                'queue_depth': self._queue.qsize(),
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'batches': self.batches,
+                'full_batches': self.full_batches,
+                'avg_batch_size': avg_batch_size,
+                'fill_ratio': avg_batch_size / self.max_batch,
+                'queue_wait_ms_p50': percentile(waits, 0.5) * 1000,
+                'queue_wait_ms_p95': percentile(waits, 0.95) * 1000,
+            }
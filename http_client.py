@@ -0,0 +1,184 @@
+import itertools
+from contextlib import asynccontextmanager, contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+    HTTPX_AVAILABLE = True
+except ImportError:
+    HTTPX_AVAILABLE = False
+
+try:
+    import h2  # noqa: F401  httpx 需要 h2 才能使用 HTTP/2
+    HTTP2_AVAILABLE = HTTPX_AVAILABLE
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class PooledHTTPClient:
+    """
+    共享的 HTTP 連線池客戶端
+    - 保持連線 (keep-alive)，重複請求時不需重新進行 TCP/TLS 握手
+    - 連線與讀取分別設定逾時
+    - 安裝了 httpx 與 h2 時使用 HTTP/2，否則使用 requests.Session
+    httpx 的異常會轉換為 requests.exceptions.RequestException，呼叫端只需處理一種異常
+    """
+    def __init__(self, pool_size=20, connect_timeout=3.05, read_timeout=10, http2=True):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.http2 = http2 and HTTP2_AVAILABLE
+
+        if self.http2:
+            self._client = httpx.Client(
+                http2=True,
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout)
+            )
+        else:
+            self._client = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=False)
+            self._client.mount('https://', adapter)
+            self._client.mount('http://', adapter)
+
+    def post(self, url, headers=None, json=None, timeout=None):
+        """
+        發送 POST 請求，返回的響應物件提供 status_code、text 和 json()
+        """
+        if self.http2:
+            try:
+                return self._client.post(url, headers=headers, json=json, timeout=timeout or self._client.timeout)
+            except httpx.HTTPError as e:
+                raise requests.exceptions.RequestException(str(e)) from e
+        return self._client.post(
+            url, headers=headers, json=json,
+            timeout=timeout or (self.connect_timeout, self.read_timeout)
+        )
+
+    @contextmanager
+    def stream(self, url, headers=None, json=None, timeout=None):
+        """
+        發送 POST 請求並以串流方式讀取響應
+        返回的響應物件提供 status_code、text 和 iter_lines()
+        """
+        if self.http2:
+            try:
+                with self._client.stream('POST', url, headers=headers, json=json,
+                                         timeout=timeout or self._client.timeout) as response:
+                    yield _HTTPXStreamResponse(response)
+            except httpx.HTTPError as e:
+                raise requests.exceptions.RequestException(str(e)) from e
+            return
+        response = self._client.post(
+            url, headers=headers, json=json, stream=True,
+            timeout=timeout or (self.connect_timeout, self.read_timeout)
+        )
+        # SSE 規範使用 UTF-8，但 requests 對未標示編碼的 text/* 預設為 ISO-8859-1
+        if response.encoding is None or response.encoding.lower() == 'iso-8859-1':
+            response.encoding = 'utf-8'
+        try:
+            yield _RequestsStreamResponse(response)
+        finally:
+            response.close()
+
+    def close(self):
+        self._client.close()
+
+
+class AsyncPooledHTTPClient:
+    """
+    PooledHTTPClient 的 asyncio 版本 (需要 httpx)
+    等待 Gemini 回應時不佔用執行緒，同時進行中的請求數量只受連線池大小限制；
+    連線池已滿時請求會排隊等待可用的連線。
+    httpcore 每次分配連線都會掃描池中所有連線，連線數量上百時成本隨平方增長，
+    因此將連線池分成多個較小的 httpx.AsyncClient 輪流使用
+    """
+    def __init__(self, pool_size=20, connect_timeout=3.05, read_timeout=10, http2=True, shard_size=32):
+        if not HTTPX_AVAILABLE:
+            raise RuntimeError("非同步模式需要先安裝 httpx: pip install httpx")
+        self.pool_size = pool_size
+        self.http2 = http2 and HTTP2_AVAILABLE
+        shards = max(1, -(-pool_size // shard_size))
+        per_shard = -(-pool_size // shards)
+        self._clients = [
+            httpx.AsyncClient(
+                http2=self.http2,
+                limits=httpx.Limits(max_connections=per_shard, max_keepalive_connections=per_shard),
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout)
+            )
+            for _ in range(shards)
+        ]
+        self._next = itertools.cycle(self._clients)
+
+    async def post(self, url, headers=None, json=None, timeout=None):
+        client = next(self._next)
+        try:
+            return await client.post(url, headers=headers, json=json, timeout=timeout or client.timeout)
+        except httpx.HTTPError as e:
+            raise requests.exceptions.RequestException(str(e)) from e
+
+    @asynccontextmanager
+    async def stream(self, url, headers=None, json=None, timeout=None):
+        """
+        發送 POST 請求並以串流方式讀取響應
+        返回的響應物件提供 status_code、aread_text() 和 aiter_lines()
+        """
+        client = next(self._next)
+        try:
+            async with client.stream('POST', url, headers=headers, json=json,
+                                     timeout=timeout or client.timeout) as response:
+                yield _AsyncHTTPXStreamResponse(response)
+        except httpx.HTTPError as e:
+            raise requests.exceptions.RequestException(str(e)) from e
+
+    async def aclose(self):
+        for client in self._clients:
+            await client.aclose()
+
+
+class _RequestsStreamResponse:
+    """
+    requests 的 iter_lines 預設累積 512 位元組才產出，串流時改為收到多少就處理多少
+    """
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+
+    @property
+    def text(self):
+        return self._response.text
+
+    def iter_lines(self, decode_unicode=True):
+        return self._response.iter_lines(chunk_size=None, decode_unicode=decode_unicode)
+
+
+class _HTTPXStreamResponse:
+    """
+    讓 httpx 的串流響應與 requests 的響應有相同的介面
+    """
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+
+    @property
+    def text(self):
+        self._response.read()
+        return self._response.text
+
+    def iter_lines(self, decode_unicode=True):
+        return self._response.iter_lines()
+
+
+class _AsyncHTTPXStreamResponse:
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+
+    async def aread_text(self):
+        await self._response.aread()
+        return self._response.text
+
+    def aiter_lines(self):
+        return self._response.aiter_lines()
@@ -0,0 +1,305 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from utils import percentile
+
+
+class ModelCallError(Exception):
+    """模型呼叫失敗 (HTTP 錯誤、逾時、無法解析的響應等)，不應作為回應顯示或緩存"""
+    # 是否計入熔斷器的失敗次數
+    trips_breaker = True
+
+
+class RateLimitError(ModelCallError):
+    """模型回應 429 / 配額限制"""
+    pass
+
+
+class AllModelsFailedError(ModelCallError):
+    pass
+
+
+def is_rate_limit(error):
+    error_str = str(error)
+    return isinstance(error, RateLimitError) or "429" in error_str or "quota" in error_str.lower()
+
+
+class CircuitBreaker:
+    """
+    單一模型的熔斷器
+    - 遇到配額限制 (429) 時立即斷開，cooldown 秒內不再嘗試這個模型
+    - 其他錯誤連續發生 failure_threshold 次才斷開
+    - 冷卻時間結束後只放行一個試探請求，成功即恢復，失敗則重新冷卻
+    """
+    def __init__(self, cooldown=60, failure_threshold=3):
+        self.cooldown = cooldown
+        self.failure_threshold = failure_threshold
+        self._failures = 0
+        self._open_until = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._open_until == 0.0:
+                return 'closed'
+            return 'open' if time.monotonic() < self._open_until else 'half-open'
+
+    def allow(self):
+        with self._lock:
+            if self._open_until == 0.0:
+                return True
+            if time.monotonic() < self._open_until or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._open_until = 0.0
+            self._probing = False
+
+    def release(self):
+        """
+        試探請求被取消、沒有得到結果時呼叫，讓下一個請求可以再次試探
+        """
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self, rate_limited=False):
+        with self._lock:
+            self._failures += 1
+            if rate_limited or self._probing or self._failures >= self.failure_threshold:
+                self._open_until = time.monotonic() + self.cooldown
+            self._probing = False
+
+
+class ModelStats:
+    """單一模型的延遲與呼叫統計"""
+    def __init__(self, latency_window=200):
+        self.latencies = deque(maxlen=latency_window)
+        self.calls = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.wins = 0
+
+
+class ModelRouter:
+    """
+    依序排列的模型備援策略
+    - 從第一個可用 (未熔斷) 的模型開始呼叫
+    - 若呼叫失敗，立即呼叫下一個模型
+    - 若超過對沖延遲 (該模型近期延遲的 p95，樣本不足時為 default_hedge_delay) 仍未回應，
+      同時呼叫下一個模型 (hedged request)，先成功的結果勝出，其餘請求取消或忽略
+    因此最壞情況的延遲不再是所有模型逾時時間的總和
+
+    models 為 (名稱, 呼叫函式) 的列表，呼叫函式接收查詢文字並返回回應文字，失敗時拋出異常；
+    route 使用 models 中的一般函式，aroute 使用 async_models 中同名模型的協程函式 (非同步模式)，
+    兩者共用熔斷器與延遲統計
+    """
+    def __init__(self, models, async_models=None, hedge_delay=None, default_hedge_delay=2.0, hedge_percentile=0.95,
+                 min_samples=20, cooldown=60, failure_threshold=3, max_workers=32):
+        self.models = list(models)
+        self.async_models = list(async_models or [])
+        self.hedge_delay = hedge_delay
+        self.default_hedge_delay = default_hedge_delay
+        self.hedge_percentile = hedge_percentile
+        self.min_samples = min_samples
+        self.breakers = {name: CircuitBreaker(cooldown, failure_threshold) for name, _ in self.models}
+        self._stats = {name: ModelStats() for name, _ in self.models}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="model-router")
+        self.hedges = 0
+        self.exhausted = 0
+
+    def hedge_delay_for(self, name):
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        with self._lock:
+            latencies = sorted(self._stats[name].latencies)
+        if len(latencies) < self.min_samples:
+            return self.default_hedge_delay
+        return percentile(latencies, self.hedge_percentile)
+
+    def fallback_depth(self, name):
+        """
+        模型在備援順序中的位置，0 為主要模型
+        """
+        for depth, (model_name, _) in enumerate(self.models):
+            if model_name == name:
+                return depth
+        return None
+
+    def record(self, name, latency=None, error=None):
+        """
+        記錄一次呼叫的結果 (串流呼叫等不經過 route 的請求也應記錄，讓熔斷器得知模型狀態)
+        """
+        rate_limited = error is not None and getattr(error, 'trips_breaker', True) and is_rate_limit(error)
+        with self._lock:
+            stats = self._stats[name]
+            stats.calls += 1
+            if error is None:
+                if latency is not None:
+                    stats.latencies.append(latency)
+            else:
+                stats.failures += 1
+                if rate_limited:
+                    stats.rate_limited += 1
+        if error is None:
+            self.breakers[name].record_success()
+        elif getattr(error, 'trips_breaker', True):
+            self.breakers[name].record_failure(rate_limited)
+        else:
+            # 請求沒有送出 (例如本地排隊逾時)，模型狀態未知；若是半開狀態的試探請求則釋放名額
+            self.breakers[name].release()
+
+    def _next_model(self, pending):
+        # 熔斷器在真正要呼叫時才檢查，半開狀態的試探名額不會被沒有送出的請求佔用
+        while pending:
+            name, call = pending.pop(0)
+            if self.breakers[name].allow():
+                return name, call
+        return None
+
+    def _win(self, name, hedged):
+        with self._lock:
+            self._stats[name].wins += 1
+            if hedged:
+                self.hedges += 1
+
+    def _fail_all(self, errors):
+        with self._lock:
+            self.exhausted += 1
+        if not errors:
+            raise AllModelsFailedError("所有模型都在冷卻中")
+        raise AllModelsFailedError("; ".join(f"{name}: {error}" for name, error in errors))
+
+    def _timed_call(self, name, call, query):
+        start = time.perf_counter()
+        try:
+            result = call(query)
+        except Exception as e:
+            self.record(name, error=e)
+            raise
+        self.record(name, latency=time.perf_counter() - start)
+        return result
+
+    def route(self, query, exclude=()):
+        """
+        取得回應，返回 (模型名稱, 回應文字)；所有模型都失敗時拋出 AllModelsFailedError
+        exclude 為這次不嘗試的模型名稱
+        """
+        pending = [(name, call) for name, call in self.models if name not in exclude]
+        running = {}
+        errors = []
+        hedged = False
+        latest = None
+        while True:
+            if not running:
+                model = self._next_model(pending)
+                if model is None:
+                    break
+                latest = model[0]
+                running[self._executor.submit(self._timed_call, model[0], model[1], query)] = latest
+            timeout = self.hedge_delay_for(latest) if pending else None
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # 超過對沖延遲仍未回應，同時呼叫下一個模型
+                model = self._next_model(pending)
+                if model is not None:
+                    latest = model[0]
+                    running[self._executor.submit(self._timed_call, model[0], model[1], query)] = latest
+                    hedged = True
+                continue
+            for future in done:
+                name = running.pop(future)
+                error = future.exception()
+                if error is None:
+                    # 先成功者勝出；執行中的請求無法中斷，其結果會被忽略
+                    for other, other_name in running.items():
+                        # 還在排隊的請求被取消後不會執行 _timed_call，釋放 _next_model 取得的試探名額
+                        if other.cancel():
+                            self.breakers[other_name].release()
+                    self._win(name, hedged)
+                    return name, future.result()
+                print(f"模型 {name} 呼叫失敗: {error}")
+                errors.append((name, error))
+        self._fail_all(errors)
+
+    async def _atimed_call(self, name, call, query):
+        start = time.perf_counter()
+        try:
+            result = await call(query)
+        except asyncio.CancelledError:
+            # 被其他先成功的模型取消，不計入失敗
+            self.breakers[name].release()
+            raise
+        except Exception as e:
+            self.record(name, error=e)
+            raise
+        self.record(name, latency=time.perf_counter() - start)
+        return result
+
+    async def aroute(self, query, exclude=()):
+        """
+        route 的非同步版本：落後的請求會被取消 (關閉連線)
+        """
+        pending = [(name, call) for name, call in self.async_models if name not in exclude]
+        running = {}
+        errors = []
+        hedged = False
+        latest = None
+        try:
+            while True:
+                if not running:
+                    model = self._next_model(pending)
+                    if model is None:
+                        break
+                    latest = model[0]
+                    running[asyncio.ensure_future(self._atimed_call(model[0], model[1], query))] = latest
+                timeout = self.hedge_delay_for(latest) if pending else None
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    model = self._next_model(pending)
+                    if model is not None:
+                        latest = model[0]
+                        running[asyncio.ensure_future(self._atimed_call(model[0], model[1], query))] = latest
+                        hedged = True
+                    continue
+                for task in done:
+                    name = running.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        self._win(name, hedged)
+                        return name, task.result()
+                    print(f"模型 {name} 呼叫失敗: {error}")
+                    errors.append((name, error))
+            self._fail_all(errors)
+        finally:
+            for task in running:
+                task.cancel()
+
+    def stats(self):
+        with self._lock:
+            models = {}
+            for name, _ in self.models:
+                stats = self._stats[name]
+                latencies = sorted(stats.latencies)
+                models[name] = {
+                    'calls': stats.calls,
+                    'failures': stats.failures,
+                    'rate_limited': stats.rate_limited,
+                    'wins': stats.wins,
+                    'latency_ms_p50': percentile(latencies, 0.5) * 1000,
+                    'latency_ms_p95': percentile(latencies, 0.95) * 1000,
+                }
+            hedges, exhausted = self.hedges, self.exhausted
+        for name in models:
+            models[name]['circuit'] = self.breakers[name].state
+            models[name]['hedge_delay_ms'] = self.hedge_delay_for(name) * 1000
+        return {'models': models, 'hedges': hedges, 'exhausted': exhausted}
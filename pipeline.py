@@ -0,0 +1,258 @@
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from utils import percentile
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Stage:
+    """
+    管線中的一個步驟，run(ctx) 讀取並更新 RequestContext
+    arun 為非同步模式使用的協程函式，未提供時非同步管線也直接呼叫 run；
+    skip(ctx) 為真時略過這個步驟 (例如緩存命中時不呼叫模型)，不記錄耗時
+    """
+    def __init__(self, name, run=None, arun=None, skip=None):
+        self.name = name
+        self.run = run
+        self.arun = arun
+        self.skip = skip
+
+
+class RequestTrace:
+    """
+    單一請求各步驟的耗時，可轉換為 Server-Timing 標頭
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def add(self, name, seconds):
+        self.spans.append((name, seconds))
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def server_timing(self, descriptions=None):
+        descriptions = descriptions or {}
+        entries = []
+        for name, seconds in self.spans + [('total', time.perf_counter() - self.started)]:
+            entry = f"{name};dur={seconds * 1000:.1f}"
+            if descriptions.get(name):
+                entry += f';desc="{descriptions[name]}"'
+            entries.append(entry)
+        return ", ".join(entries)
+
+
+class RequestContext:
+    """
+    在管線各步驟之間傳遞的請求狀態
+    cache: hit / miss / bypass (帶入了先前對話的上下文，不使用共用的緩存)；model 為回應的模型，
+    fallback_depth 為它在備援順序中的位置 (0 為主要模型)，緩存命中或全部失敗時為 None
+    """
+    def __init__(self, route, text=None, audio=None, mimetype=None, session_id=None):
+        self.route = route
+        self.text = text
+        # 上傳的音頻 (bytes，格式為 mimetype)，解碼後為 sr.AudioData
+        self.audio = audio
+        self.mimetype = mimetype
+        self.session_id = session_id
+        self.history = []
+        self.response_text = None
+        self.cache = None
+        self.model = None
+        self.fallback_depth = None
+        self.model_failed = False
+        self.tts_job = None
+        self.failed_stage = None
+        self.trace = RequestTrace()
+
+    def answer(self, response_text, model=None, fallback_depth=None):
+        self.response_text = response_text
+        self.model = model
+        self.fallback_depth = fallback_depth
+
+    def server_timing(self):
+        """
+        Server-Timing 標頭的內容，緩存步驟附上查詢結果，模型步驟附上回應的模型
+        """
+        return self.trace.server_timing({'cache': self.cache, 'llm': self.model})
+
+
+class Pipeline:
+    """
+    依序執行各個步驟 (語音識別、緩存、模型、語音合成、聊天歷史)，每個步驟都記錄耗時，
+    結束時 (包括失敗) 把請求交給 metrics 統計；不同的路由以不同的步驟組合共用同一組步驟
+    """
+    def __init__(self, stages, metrics):
+        self.stages = list(stages)
+        self.metrics = metrics
+
+    def run(self, ctx):
+        try:
+            for stage in self.stages:
+                if stage.skip is not None and stage.skip(ctx):
+                    continue
+                with ctx.trace.span(stage.name):
+                    try:
+                        stage.run(ctx)
+                    except Exception:
+                        ctx.failed_stage = stage.name
+                        raise
+        finally:
+            self.metrics.record(ctx)
+        return ctx
+
+    async def arun(self, ctx):
+        try:
+            for stage in self.stages:
+                if stage.skip is not None and stage.skip(ctx):
+                    continue
+                with ctx.trace.span(stage.name):
+                    try:
+                        if stage.arun is not None:
+                            await stage.arun(ctx)
+                        else:
+                            stage.run(ctx)
+                    except Exception:
+                        ctx.failed_stage = stage.name
+                        raise
+        finally:
+            self.metrics.record(ctx)
+        return ctx
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class PipelineMetrics:
+    """
+    管線的統計：各步驟耗時 (最近 window 個樣本的 p50/p95/p99，加上累計的總和與次數)、
+    請求數、緩存命中率、回應的模型與備援深度，以 Prometheus 文字格式輸出
+    """
+    def __init__(self, prefix="mysiri", window=1024):
+        self.prefix = prefix
+        self.window = window
+        self._lock = threading.Lock()
+        self._durations = defaultdict(lambda: deque(maxlen=window))
+        self._duration_sums = defaultdict(float)
+        self._duration_counts = defaultdict(int)
+        self._counters = defaultdict(int)
+        self._gauges = []
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            self._durations[stage].append(seconds)
+            self._duration_sums[stage] += seconds
+            self._duration_counts[stage] += 1
+
+    def register_gauge(self, name, help_text, callback, metric_type='gauge'):
+        """
+        輸出時呼叫 callback 取得目前的數值，返回數字或 [(labels 字典, 數值)] 列表
+        由元件自行累計的計數 (例如緩存的命中數) 以 metric_type='counter' 輸出
+        """
+        self._gauges.append((name, help_text, callback, metric_type))
+
+    def record(self, ctx):
+        for name, seconds in ctx.trace.spans:
+            self.observe(name, seconds)
+        self.inc('requests_total', route=ctx.route, status='error' if ctx.failed_stage else 'ok')
+        if ctx.failed_stage:
+            self.inc('stage_errors_total', stage=ctx.failed_stage)
+        if ctx.cache is not None:
+            self.inc('cache_lookups_total', result=ctx.cache)
+        if ctx.model is not None:
+            self.inc('model_responses_total', model=ctx.model)
+        if ctx.fallback_depth is not None:
+            self.inc('fallback_depth_total', depth=ctx.fallback_depth)
+        if ctx.model_failed:
+            self.inc('model_failures_total')
+
+    def counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def cache_hit_ratio(self):
+        hits = self.counter('cache_lookups_total', result='hit')
+        misses = self.counter('cache_lookups_total', result='miss')
+        return hits / (hits + misses) if hits + misses else 0.0
+
+    def stage_stats(self):
+        with self._lock:
+            stages = {stage: sorted(samples) for stage, samples in self._durations.items()}
+            counts = dict(self._duration_counts)
+        return {
+            stage: dict(
+                {'count': counts[stage]},
+                **{f'ms_p{int(q * 100)}': percentile(samples, q) * 1000 for q in QUANTILES}
+            )
+            for stage, samples in stages.items()
+        }
+
+    def render(self):
+        """
+        Prometheus 文字格式 (text/plain; version=0.0.4)
+        """
+        prefix = self.prefix
+        lines = []
+        with self._lock:
+            durations = {stage: sorted(samples) for stage, samples in self._durations.items()}
+            sums = dict(self._duration_sums)
+            counts = dict(self._duration_counts)
+            counters = defaultdict(list)
+            for (name, labels), value in sorted(self._counters.items()):
+                counters[name].append((labels, value))
+
+        lines.append(f"# HELP {prefix}_stage_duration_seconds 管線各步驟的耗時 (分位數取最近 {self.window} 個樣本)")
+        lines.append(f"# TYPE {prefix}_stage_duration_seconds summary")
+        for stage, samples in sorted(durations.items()):
+            for q in QUANTILES:
+                lines.append(
+                    f"{prefix}_stage_duration_seconds{_labels([('stage', stage), ('quantile', q)])} "
+                    f"{percentile(samples, q):.6f}"
+                )
+            lines.append(f"{prefix}_stage_duration_seconds_sum{_labels([('stage', stage)])} {sums[stage]:.6f}")
+            lines.append(f"{prefix}_stage_duration_seconds_count{_labels([('stage', stage)])} {counts[stage]}")
+
+        for name, help_text in (
+            ('requests_total', "處理的請求數"),
+            ('stage_errors_total', "失敗的步驟"),
+            ('cache_lookups_total', "回應緩存查詢結果 (bypass 表示帶入了先前對話的上下文，不使用緩存)"),
+            ('model_responses_total', "各模型提供的回應數"),
+            ('fallback_depth_total', "回應的模型在備援順序中的位置 (0 為主要模型)"),
+            ('model_failures_total', "所有模型都失敗的請求數"),
+        ):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            for labels, value in counters.get(name, []):
+                lines.append(f"{prefix}_{name}{_labels(labels)} {value}")
+
+        lines.append(f"# HELP {prefix}_cache_hit_ratio 回應緩存命中率 (不含 bypass)")
+        lines.append(f"# TYPE {prefix}_cache_hit_ratio gauge")
+        lines.append(f"{prefix}_cache_hit_ratio {self.cache_hit_ratio():.6f}")
+
+        for name, help_text, callback, metric_type in self._gauges:
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+            value = callback()
+            for labels, sample in (value if isinstance(value, list) else [({}, value)]):
+                lines.append(f"{prefix}_{name}{_labels(sorted(labels.items()))} {sample}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,226 @@
+import asyncio
+import re
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from model_router import ModelCallError
+from utils import _CJK_RANGES
+
+_CJK_CHAR = re.compile(f'[{_CJK_RANGES}]')
+
+
+class RateLimitQueueTimeout(ModelCallError):
+    """
+    本地配額用完且排隊時間會超過上限，請求沒有送出
+    模型本身沒有故障，因此不觸發熔斷器，只讓備援策略改用其他模型
+    """
+    trips_breaker = False
+
+
+def estimate_tokens(text):
+    """
+    粗略估計文字的 token 數量：中日韓文字約每字一個 token，其他文字約每 4 個字元一個 token
+    """
+    cjk = len(_CJK_CHAR.findall(text))
+    return max(1, cjk + (len(text) - cjk + 3) // 4)
+
+
+class TokenBucket:
+    """
+    令牌桶：每秒補充 rate 個令牌，最多累積 capacity 個
+    以預約的方式扣除令牌：餘額不足時仍先扣除 (餘額變為負數)，並返回需要等待的秒數，
+    因此等待中的請求依到達順序放行，等待本身不需要持有鎖
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        # 呼叫端需持有鎖
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount, now):
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self._tokens) / self.rate)
+
+    def take(self, amount):
+        self._tokens -= min(amount, self.capacity)
+
+    def give(self, amount):
+        self._tokens = min(self.capacity, self._tokens + amount)
+
+    @property
+    def available(self):
+        return self._tokens
+
+
+class ModelRateLimiter:
+    """
+    單一模型的用戶端配額限制，對應 Gemini 的每分鐘請求數 (RPM) 與每分鐘 token 數 (TPM)
+    超過配額的請求在本地排隊，而不是送出後收到 429；
+    預計排隊時間超過 max_wait 時拋出 RateLimitQueueTimeout，讓備援策略改用其他模型
+
+    送出前以 (輸入 token 估計值 + expected_output_tokens) 預約 TPM，收到回應後依實際輸出修正
+    """
+    def __init__(self, rpm, tpm=None, max_wait=5.0, expected_output_tokens=300):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_wait = max_wait
+        self.expected_output_tokens = expected_output_tokens
+        self._requests = TokenBucket(rpm / 60.0, rpm)
+        self._tokens = TokenBucket(tpm / 60.0, tpm) if tpm else None
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+
+    def reserve(self, text):
+        """
+        預約一次呼叫的配額，返回 (需要等待的秒數, 預約的 token 數)
+        """
+        tokens = estimate_tokens(text) + self.expected_output_tokens
+        with self._lock:
+            now = time.monotonic()
+            wait = self._requests.wait_time(1, now)
+            if self._tokens is not None:
+                wait = max(wait, self._tokens.wait_time(tokens, now))
+            if wait > self.max_wait:
+                self.rejected += 1
+                raise RateLimitQueueTimeout(f"本地配額已用完，需要等待 {wait:.1f} 秒")
+            self._requests.take(1)
+            if self._tokens is not None:
+                self._tokens.take(tokens)
+            self.admitted += 1
+            if wait > 0:
+                self.queued += 1
+                self.total_wait += wait
+        return wait, tokens
+
+    def acquire(self, text):
+        """
+        取得一次呼叫的配額，必要時阻塞等待，返回預約的 token 數
+        """
+        wait, tokens = self.reserve(text)
+        if wait > 0:
+            time.sleep(wait)
+        return tokens
+
+    async def aacquire(self, text):
+        wait, tokens = self.reserve(text)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return tokens
+
+    def settle(self, reserved_tokens, response_text=None):
+        """
+        依實際的回應修正預約的 token 數；呼叫失敗 (response_text 為 None) 時退回輸出部分的預約
+        """
+        if self._tokens is None:
+            return
+        actual_output = estimate_tokens(response_text) if response_text else 0
+        with self._lock:
+            self._tokens.give(self.expected_output_tokens - actual_output)
+
+    def headroom(self):
+        """
+        目前可用的每分鐘請求數佔配額的比例 (有請求在排隊時為負數)
+        """
+        with self._lock:
+            self._requests._refill(time.monotonic())
+            return self._requests.available / self.rpm
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            self._requests._refill(now)
+            stats = {
+                'rpm': self.rpm,
+                'tpm': self.tpm,
+                'available_requests': round(self._requests.available, 2),
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'rejected': self.rejected,
+                'avg_wait_ms': self.total_wait / self.queued * 1000 if self.queued else 0.0,
+            }
+            if self._tokens is not None:
+                self._tokens._refill(now)
+                stats['available_tokens'] = round(self._tokens.available)
+            return stats
+
+
+class _Usage:
+    """記錄一次呼叫實際產生的輸出，用於修正 token 預約"""
+    def __init__(self):
+        self.parts = []
+
+    def add(self, text):
+        self.parts.append(text)
+
+    @property
+    def text(self):
+        return ''.join(self.parts) or None
+
+
+class RateLimiters:
+    """
+    各模型的用戶端配額限制，沒有設定配額的模型不受限制
+    用法:
+        with rate_limiters.limit(model_name, prompt) as usage:
+            response_text = ...
+            usage.add(response_text)
+    """
+    def __init__(self, limits, max_wait=5.0, expected_output_tokens=300):
+        self._limiters = {
+            model: ModelRateLimiter(rpm, tpm, max_wait=max_wait, expected_output_tokens=expected_output_tokens)
+            for model, (rpm, tpm) in limits.items()
+        }
+
+    def get(self, model):
+        return self._limiters.get(model)
+
+    @contextmanager
+    def limit(self, model, text):
+        limiter = self._limiters.get(model)
+        usage = _Usage()
+        if limiter is None:
+            yield usage
+            return
+        reserved = limiter.acquire(text)
+        try:
+            yield usage
+        finally:
+            limiter.settle(reserved, usage.text)
+
+    @asynccontextmanager
+    async def alimit(self, model, text):
+        limiter = self._limiters.get(model)
+        usage = _Usage()
+        if limiter is None:
+            yield usage
+            return
+        reserved = await limiter.aacquire(text)
+        try:
+            yield usage
+        finally:
+            limiter.settle(reserved, usage.text)
+
+    def stats(self):
+        return {model: limiter.stats() for model, limiter in self._limiters.items()}
+
+
+def parse_rate_limits(spec):
+    """
+    解析 "模型=RPM:TPM,模型=RPM" 格式的設定，返回 {模型: (rpm, tpm)}
+    """
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        model, _, values = item.partition('=')
+        rpm, _, tpm = values.partition(':')
+        limits[model.strip()] = (float(rpm), float(tpm) if tpm else None)
+    return limits
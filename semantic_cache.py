@@ -0,0 +1,229 @@
+"""
+語意緩存：以向量的餘弦相似度查找改寫過的相似查詢
+字元 n-gram 的 Jaccard 相似度只能找到字面相近的查詢，"明天天氣如何" 與 "明天會下雨嗎" 幾乎沒有共同的
+n-gram；在 CPU 上以小型的句向量模型把查詢轉為單位向量，存放在 NumPy 矩陣中，一次矩陣乘法即可算出
+與所有記錄的餘弦相似度
+"""
+import importlib.util
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from startup import LazyBackend
+from utils import normalize_query, tokenize_query
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+# sentence-transformers 會連帶匯入 torch (數秒)，只檢查是否安裝，載入模型時才匯入
+SENTENCE_TRANSFORMERS_AVAILABLE = importlib.util.find_spec('sentence_transformers') is not None
+
+# 預設的句向量模型：多語言、384 維，CPU 上每個查詢約數毫秒
+DEFAULT_EMBEDDING_MODEL = 'paraphrase-multilingual-MiniLM-L12-v2'
+# 餘弦相似度閾值，過低時 "台北的天氣" 與 "台中的天氣" 這類只差一個詞的問題也會被視為相同
+SEMANTIC_THRESHOLD = 0.9
+
+
+class Embedder:
+    """
+    查詢向量化後端的共同介面
+    embed 接收文字列表，返回 float32 矩陣 (筆數, 維度)，每一列已正規化為單位長度
+    """
+    name = None
+
+    def embed(self, texts):
+        raise NotImplementedError
+
+
+class SentenceTransformerEmbedder(Embedder):
+    """
+    以 sentence-transformers 在本地 CPU 上計算句向量
+    模型在第一次計算向量 (或預熱) 時載入一次，之後所有查詢共用
+    """
+    name = 'sentence-transformers'
+
+    def __init__(self, model_name=DEFAULT_EMBEDDING_MODEL, device='cpu', batch_size=32):
+        if not SENTENCE_TRANSFORMERS_AVAILABLE or not NUMPY_AVAILABLE:
+            raise RuntimeError("使用語意緩存需要安裝 numpy 與 sentence-transformers")
+        self.model_name = model_name
+        self.device = device
+        self.batch_size = batch_size
+        self.model = LazyBackend(f"句向量模型 {model_name}", self._load)
+
+    def _load(self):
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(self.model_name, device=self.device)
+
+    def embed(self, texts):
+        vectors = self.model.get().encode(list(texts), batch_size=self.batch_size,
+                                          normalize_embeddings=True, convert_to_numpy=True)
+        return np.asarray(vectors, dtype=np.float32)
+
+
+class HashingEmbedder(Embedder):
+    """
+    不需要模型的特徵雜湊向量：把 tokenize_query 的 token (中文為字元 n-gram) 雜湊到固定維度
+    只反映字面上的相似度，用於測試與基準測試，找不到真正的改寫
+    """
+    name = 'hashing'
+
+    def __init__(self, dim=256):
+        if not NUMPY_AVAILABLE:
+            raise RuntimeError("使用語意緩存需要安裝 numpy")
+        self.dim = dim
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in tokenize_query(normalize_query(text)):
+                h = zlib.crc32(token.encode('utf-8'))
+                # 最高位決定正負號，減少雜湊碰撞造成的偏差
+                vectors[row, h % self.dim] += -1.0 if h & 0x80000000 else 1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+def create_embedder(backend='sentence-transformers', model_name=None):
+    """
+    依名稱建立向量化後端：sentence-transformers / hashing
+    """
+    if backend in ('sentence-transformers', 'st'):
+        return SentenceTransformerEmbedder(model_name or DEFAULT_EMBEDDING_MODEL)
+    if backend == 'hashing':
+        return HashingEmbedder()
+    raise ValueError(f"未知的語意緩存後端: {backend}")
+
+
+class VectorIndex:
+    """
+    平面 (暴力搜尋) 向量索引
+    向量連續存放在預先配置的 NumPy 矩陣前 len(self) 列，刪除時把最後一列搬到空位，
+    搜尋時以一次矩陣乘法計算一批查詢與所有記錄的餘弦相似度 (向量皆為單位長度)
+    dim 為 None 時依第一個加入的向量決定 (模型延遲載入，建立索引時還不知道維度)
+    不是執行緒安全的，由呼叫端 (ResponseCache) 持有鎖
+    """
+    def __init__(self, dim=None, initial_capacity=1024):
+        if not NUMPY_AVAILABLE:
+            raise RuntimeError("使用語意緩存需要安裝 numpy")
+        self.dim = dim
+        self.initial_capacity = initial_capacity
+        self._vectors = None if dim is None else np.zeros((initial_capacity, dim), dtype=np.float32)
+        self._keys = []   # 列 -> key
+        self._rows = {}   # key -> 列
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def add(self, key, vector):
+        if self._vectors is None:
+            self.dim = len(vector)
+            self._vectors = np.zeros((self.initial_capacity, self.dim), dtype=np.float32)
+        row = self._rows.get(key)
+        if row is None:
+            row = len(self._keys)
+            if row == len(self._vectors):
+                grown = np.zeros((max(1, 2 * row), self.dim), dtype=np.float32)
+                grown[:row] = self._vectors
+                self._vectors = grown
+            self._keys.append(key)
+            self._rows[key] = row
+        self._vectors[row] = vector
+
+    def remove(self, key):
+        row = self._rows.pop(key, None)
+        if row is None:
+            return
+        last_key = self._keys.pop()
+        last = len(self._keys)
+        if row != last:
+            self._vectors[row] = self._vectors[last]
+            self._keys[row] = last_key
+            self._rows[last_key] = row
+
+    def clear(self):
+        self._keys.clear()
+        self._rows.clear()
+
+    def search(self, vectors, threshold):
+        """
+        vectors 為一個或一批 (m, dim) 查詢向量，返回每個查詢最相似的 (key, 相似度)，
+        相似度低於 threshold 時為 None
+        """
+        vectors = np.atleast_2d(vectors)
+        count = len(self._keys)
+        if count == 0:
+            return [None] * len(vectors)
+        scores = vectors @ self._vectors[:count].T
+        best = scores.argmax(axis=1)
+        best_scores = scores[np.arange(len(vectors)), best]
+        return [
+            (self._keys[row], score) if score >= threshold else None
+            for row, score in zip(best.tolist(), best_scores.tolist())
+        ]
+
+
+class SemanticTier:
+    """
+    ResponseCache 的語意查找層：向量化後端加上向量索引
+    索引中的記錄與 ResponseCache 的記錄同步增刪，因此過期與淘汰的規則完全相同；
+    最近查詢的向量會暫存起來，未命中後呼叫模型、再寫入緩存時不需重新計算
+    """
+    def __init__(self, embedder, threshold=SEMANTIC_THRESHOLD, memo_size=256):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.memo_size = memo_size
+        self.index = VectorIndex(getattr(embedder, 'dim', None))
+        self._memo = OrderedDict()  # 正規化查詢 -> 向量
+        self._lock = threading.Lock()
+        self.embedded = 0
+        self.embed_seconds = 0.0
+
+    def _embed_batch(self, texts):
+        started = time.perf_counter()
+        vectors = self.embedder.embed(texts)
+        with self._lock:
+            self.embedded += len(texts)
+            self.embed_seconds += time.perf_counter() - started
+        return vectors
+
+    def embed(self, query):
+        normalized = normalize_query(query)
+        with self._lock:
+            vector = self._memo.get(normalized)
+            if vector is not None:
+                self._memo.move_to_end(normalized)
+                return vector
+        vector = self._embed_batch([query])[0]
+        with self._lock:
+            self._memo[normalized] = vector
+            while len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+        return vector
+
+    def embed_many(self, queries):
+        """
+        一次計算多個查詢的向量 (例如從共享存儲載入的記錄)，不經過暫存
+        """
+        return self._embed_batch(list(queries))
+
+    def search(self, vector):
+        # 呼叫端需持有 ResponseCache 的鎖
+        return self.index.search(vector, self.threshold)[0]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': self.embedder.name,
+                'dim': self.index.dim,
+                'threshold': self.threshold,
+                'indexed': len(self.index),
+                'embedded': self.embedded,
+                'embed_ms_avg': self.embed_seconds / self.embedded * 1000 if self.embedded else 0.0,
+            }
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from model_router import ModelCallError
+from utils import SIMILARITY_THRESHOLD, normalize_query, tokenize_query, jaccard_similarity
+
+
+class _Flight:
+    __slots__ = ('normalized', 'tokens', 'future', 'followers')
+
+    def __init__(self, normalized, tokens):
+        self.normalized = normalized
+        self.tokens = tokens
+        self.future = Future()
+        self.followers = 0
+
+
+class SingleFlight:
+    """
+    合併同時進行的相同或相似查詢 (判斷方式與 is_similar_query 相同)
+    第一個請求 (leader) 實際呼叫模型，其他同時到達的相似查詢 (follower) 等待並共用它的結果，
+    因此熱門問題同時未命中緩存時只會呼叫一次 Gemini。
+    進行中的查詢數量不多，直接逐一比較 token 集合
+    """
+    def __init__(self, threshold=SIMILARITY_THRESHOLD):
+        self.threshold = threshold
+        self._flights = []
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _match(self, normalized, tokens):
+        for flight in self._flights:
+            if flight.normalized == normalized or jaccard_similarity(tokens, flight.tokens) > self.threshold:
+                return flight
+        return None
+
+    def begin(self, query):
+        """
+        加入一個查詢，返回 (flight, 是否為 leader)
+        leader 必須在完成時呼叫 end；follower 等待 flight.future 的結果
+        """
+        normalized = normalize_query(query)
+        tokens = tokenize_query(normalized)
+        with self._lock:
+            flight = self._match(normalized, tokens)
+            if flight is not None:
+                flight.followers += 1
+                self.coalesced += 1
+                return flight, False
+            flight = _Flight(normalized, tokens)
+            self._flights.append(flight)
+            self.leaders += 1
+            return flight, True
+
+    def end(self, flight, result=None, error=None):
+        with self._lock:
+            self._flights.remove(flight)
+        if error is not None:
+            flight.future.set_exception(error)
+        else:
+            flight.future.set_result(result)
+
+    def do(self, query, fn):
+        """
+        以 fn(query) 取得結果，相似的查詢正在進行時改為等待它的結果
+        """
+        flight, leader = self.begin(query)
+        if not leader:
+            return flight.future.result()
+        try:
+            result = fn(query)
+        except Exception as e:
+            self.end(flight, error=e)
+            raise
+        self.end(flight, result)
+        return result
+
+    async def ado(self, query, fn):
+        """
+        do 的非同步版本，fn 為協程函式
+        """
+        flight, leader = self.begin(query)
+        if not leader:
+            return await asyncio.shield(asyncio.wrap_future(flight.future))
+        try:
+            result = await fn(query)
+        except BaseException as e:
+            # 包含 leader 被取消的情況 (例如用戶端斷線)，避免 follower 永遠等待；
+            # follower 收到模型呼叫失敗，與串流回應中斷時相同，由備援策略的錯誤處理返回錯誤訊息
+            self.end(flight, error=e if isinstance(e, Exception) else ModelCallError("相同問題的請求已取消"))
+            raise
+        self.end(flight, result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': len(self._flights),
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+            }
@@ -0,0 +1,122 @@
+"""
+延遲初始化與啟動時間
+重量級的後端 (Gemini SDK、離線語音識別模型、語音合成引擎、句向量模型) 包裝成 LazyBackend，匯入模組時只記下如何建立，
+第一次使用時才初始化；需要時可在啟動後由 Prewarmer 在背景預先載入，讓第一個請求不必等待
+"""
+import os
+import threading
+import time
+
+# 本模組被匯入的時間，無法讀取 /proc 時作為進程啟動時間的近似值
+_IMPORTED_AT = time.time()
+
+
+def process_uptime():
+    """
+    進程啟動至今的秒數 (Linux 從 /proc 讀取，包括直譯器啟動與匯入模組的時間)
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # 第 22 個欄位為進程啟動時間 (開機後的 clock ticks)，行程名稱可能包含空格，從右括號之後開始分割
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        # clock ticks 的精度為 10 毫秒
+        return round(uptime - start_ticks / os.sysconf('SC_CLK_TCK'), 2)
+    except (OSError, ValueError, IndexError):
+        return time.time() - _IMPORTED_AT
+
+
+class BackendUnavailableError(RuntimeError):
+    """
+    後端初始化失敗 (在 retry_interval 內不重試，直接拋出)
+    """
+    pass
+
+
+class LazyBackend:
+    """
+    第一次呼叫 get() 時才執行 factory 建立後端，之後共用同一個實例
+    同時到達的請求只初始化一次，其他請求等待結果；初始化失敗時拋出 BackendUnavailableError，
+    retry_interval 秒後的下一次呼叫再重試，不會讓後端永遠處於未定義的狀態
+    """
+    def __init__(self, name, factory, retry_interval=30.0):
+        self.name = name
+        self.factory = factory
+        self.retry_interval = retry_interval
+        self._instance = None
+        self._ready = False
+        self._lock = threading.Lock()
+        self._error = None
+        self._failed_at = None
+        self.init_seconds = None
+
+    @property
+    def ready(self):
+        return self._ready
+
+    def get(self):
+        if self._ready:
+            return self._instance
+        with self._lock:
+            if self._ready:
+                return self._instance
+            if self._failed_at is not None and time.monotonic() - self._failed_at < self.retry_interval:
+                raise BackendUnavailableError(f"{self.name} 初始化失敗: {self._error}")
+            started = time.perf_counter()
+            try:
+                instance = self.factory()
+            except Exception as e:
+                self._error = e
+                self._failed_at = time.monotonic()
+                print(f"初始化 {self.name} 失敗: {e}")
+                raise BackendUnavailableError(f"{self.name} 初始化失敗: {e}") from e
+            self.init_seconds = time.perf_counter() - started
+            self._instance = instance
+            self._error = None
+            self._failed_at = None
+            self._ready = True
+            print(f"{self.name} 初始化完成 ({self.init_seconds:.2f} 秒)")
+            return instance
+
+    def reset(self):
+        """
+        丟棄目前的實例 (例如已處於異常狀態)，下一次 get() 重新初始化
+        """
+        with self._lock:
+            self._instance = None
+            self._ready = False
+
+    def stats(self):
+        return {
+            'ready': self._ready,
+            'init_seconds': self.init_seconds,
+            'error': str(self._error) if self._error is not None else None,
+        }
+
+
+class Prewarmer:
+    """
+    在背景依序初始化一組 LazyBackend，失敗的後端記錄錯誤後略過 (第一次使用時會再重試)
+    """
+    def __init__(self, backends):
+        self.backends = list(backends)
+        self._thread = None
+        self.finished_at = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="prewarm", daemon=True)
+        self._thread.start()
+        return self
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def run(self):
+        for backend in self.backends:
+            try:
+                backend.get()
+            except BackendUnavailableError:
+                pass
+        self.finished_at = process_uptime()
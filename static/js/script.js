@@ -10,11 +10,26 @@ document.addEventListener('DOMContentLoaded', function() {
     let mediaRecorder;
     let audioChunks = [];
     let isRecording = false;
+    let micStream = null;
+    
+    // 支援 Web Audio 時以 PCM 串流上傳錄音，由服務器偵測說話結束 (VAD) 後立即識別
+    const AudioContextClass = window.AudioContext || window.webkitAudioContext;
+    const useStreamingAsr = !!AudioContextClass;
+    const STREAM_SEND_INTERVAL = 200; // 每 200 毫秒上傳一次音頻
+    let pcmStream = null;
+    
+    // 待播放的語音片段
+    let audioQueue = [];
+    let isPlayingAudio = false;
+    
+    // 瀏覽器支援串流讀取時，文字回應會逐段顯示
+    const useStreaming = typeof ReadableStream !== 'undefined' && typeof TextDecoder !== 'undefined';
     
     // 初始化語音錄制
     async function initializeRecording() {
         try {
             const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
+            micStream = stream;
             
             // 檢查支援的音頻格式
             let mimeType = 'audio/webm';
@@ -45,11 +60,17 @@ document.addEventListener('DOMContentLoaded', function() {
     
     // 添加消息到聊天窗口
     function addMessage(text, className) {
+        createMessage(text, className);
+    }
+    
+    // 創建消息元素並返回，方便之後逐段更新內容
+    function createMessage(text, className) {
         const message = document.createElement('div');
         message.className = `message ${className}`;
         message.textContent = text;
         chatContainer.appendChild(message);
         chatContainer.scrollTop = chatContainer.scrollHeight;
+        return message;
     }
     
     // 發送文本消息
@@ -63,6 +84,11 @@ document.addEventListener('DOMContentLoaded', function() {
         // 顯示加載中狀態
         const loadingId = showLoading();
         
+        if (useStreaming) {
+            await streamTextMessage(text, loadingId);
+            return;
+        }
+        
         try {
             const response = await fetch('/text_input', {
                 method: 'POST',
@@ -87,9 +113,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 }
             } else {
                 addMessage(data.response_text, 'system-message');
-                if (data.audio_url) {
-                    playResponseAudio(data.audio_url);
-                }
+                playResponseAudio(data.audio_segments);
             }
         } catch (error) {
             // 隱藏加載中狀態
@@ -100,6 +124,84 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
+    // 以 SSE 串流方式發送文本消息，回應逐段顯示
+    async function streamTextMessage(text, loadingId) {
+        let message = null;
+        resetAudioQueue();
+        
+        try {
+            const response = await fetch('/text_input_stream', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: JSON.stringify({ text: text })
+            });
+            
+            if (!response.ok || !response.body) {
+                hideLoading(loadingId);
+                const data = await response.json();
+                showError(data.error || '發送失敗，請稍後再試。');
+                return;
+            }
+            
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder('utf-8');
+            let buffer = '';
+            
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                
+                // SSE 事件以空行分隔
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                    const rawEvent = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+                    const dataLine = rawEvent.split('\n').find(line => line.startsWith('data:'));
+                    if (!dataLine) continue;
+                    
+                    const event = JSON.parse(dataLine.slice(5).trim());
+                    if (event.type === 'delta') {
+                        if (!message) {
+                            hideLoading(loadingId);
+                            message = createMessage('', 'system-message');
+                        }
+                        message.textContent += event.text;
+                        chatContainer.scrollTop = chatContainer.scrollHeight;
+                    } else if (event.type === 'audio') {
+                        // 每個句子的語音片段就緒後依序播放
+                        enqueueAudio(event.url);
+                    } else if (event.type === 'done') {
+                        if (!message) {
+                            hideLoading(loadingId);
+                            message = createMessage(event.response_text, 'system-message');
+                        }
+                    } else if (event.type === 'error') {
+                        hideLoading(loadingId);
+                        showError(event.error);
+                    }
+                }
+            }
+        } catch (error) {
+            hideLoading(loadingId);
+            console.error('發送文本出錯:', error);
+            addMessage('發送失敗，請稍後再試。', 'system-message error-message');
+        }
+    }
+    
+    // 顯示錯誤消息
+    function showError(error) {
+        // 檢查是否是配額限制錯誤
+        if (error.includes('429') || error.toLowerCase().includes('quota')) {
+            addMessage(`API 配額限制: ${error}`, 'system-message error-message');
+            addMessage('提示: 您可能已達到免費 API 使用限額。請稍後再試或考慮升級至付費計劃。', 'system-message');
+        } else {
+            addMessage(`錯誤: ${error}`, 'system-message error-message');
+        }
+    }
+    
     // 顯示加載中狀態
     function showLoading() {
         const loadingMessage = document.createElement('div');
@@ -118,6 +220,142 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
     
+    // 顯示語音查詢的結果
+    function showVoiceResult(data) {
+        if (data.error) {
+            // 檢查是否是配額限制錯誤
+            if (data.error.includes('429') || data.error.toLowerCase().includes('quota')) {
+                addMessage(`API 配額限制: ${data.error}`, 'system-message error-message');
+                addMessage('提示: 您可能已達到免費 API 使用限額。請稍後再試或考慮升級至付費計劃。', 'system-message');
+            } else {
+                addMessage(`錯誤: ${data.error}`, 'system-message error-message');
+            }
+        } else {
+            if (data.input_text) {
+                // 將識別的語音文字填入輸入框
+                textInput.value = data.input_text;
+                
+                addMessage(data.input_text, 'user-message');
+            }
+            addMessage(data.response_text, 'system-message');
+            playResponseAudio(data.audio_segments);
+        }
+    }
+    
+    // 將瀏覽器取樣率的浮點音頻降取樣為 16 位元 PCM
+    function downsampleToPcm16(samples, inputRate, outputRate) {
+        const ratio = inputRate / outputRate;
+        const length = Math.floor(samples.length / ratio);
+        const pcm = new Int16Array(length);
+        for (let i = 0; i < length; i++) {
+            // 取區間內的平均值，避免直接抽樣造成混疊
+            const start = Math.floor(i * ratio);
+            const end = Math.min(samples.length, Math.floor((i + 1) * ratio));
+            let sum = 0;
+            for (let j = start; j < end; j++) {
+                sum += samples[j];
+            }
+            const value = Math.max(-1, Math.min(1, sum / Math.max(1, end - start)));
+            pcm[i] = value < 0 ? value * 0x8000 : value * 0x7FFF;
+        }
+        return pcm;
+    }
+    
+    // 開始串流錄音：邊錄邊上傳 PCM，服務器偵測到說話結束時自動停止
+    async function startStreamingRecording() {
+        const response = await fetch('/audio_stream', { method: 'POST' });
+        const { stream_id: streamId, sample_rate: sampleRate } = await response.json();
+        
+        const context = new AudioContextClass();
+        const source = context.createMediaStreamSource(micStream);
+        const processor = context.createScriptProcessor(4096, 1, 1);
+        const state = {
+            id: streamId,
+            context,
+            source,
+            processor,
+            chunks: [],
+            sending: Promise.resolve(),
+            finished: false,
+            timer: null
+        };
+        
+        processor.onaudioprocess = (event) => {
+            if (!state.finished) {
+                state.chunks.push(downsampleToPcm16(event.inputBuffer.getChannelData(0), context.sampleRate, sampleRate));
+            }
+        };
+        source.connect(processor);
+        processor.connect(context.destination);
+        
+        state.timer = setInterval(() => sendPcmChunks(state), STREAM_SEND_INTERVAL);
+        pcmStream = state;
+    }
+    
+    // 依序上傳累積的 PCM 音頻
+    function sendPcmChunks(state) {
+        if (state.chunks.length === 0) return state.sending;
+        const chunks = state.chunks;
+        state.chunks = [];
+        const body = new Int16Array(chunks.reduce((total, chunk) => total + chunk.length, 0));
+        let offset = 0;
+        chunks.forEach(chunk => {
+            body.set(chunk, offset);
+            offset += chunk.length;
+        });
+        
+        state.sending = state.sending.then(async () => {
+            if (state.finished) return;
+            const response = await fetch(`/audio_stream/${state.id}`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/octet-stream' },
+                body: body.buffer
+            });
+            const data = await response.json();
+            if (data.error || data.speech_ended) {
+                // 服務器已偵測到說話結束，正在識別
+                finishStreamingRecording(false);
+            }
+        });
+        return state.sending;
+    }
+    
+    // 停止串流錄音並取得識別結果；userStopped 為 true 時通知服務器錄音已結束
+    async function finishStreamingRecording(userStopped) {
+        const state = pcmStream;
+        if (!state || state.finished) return;
+        pcmStream = null;
+        isRecording = false;
+        clearInterval(state.timer);
+        
+        voiceButton.classList.remove('recording');
+        micIcon.style.display = 'inline';
+        recordingStatus.style.display = 'none';
+        
+        const loadingId = showLoading();
+        try {
+            if (userStopped) {
+                await sendPcmChunks(state);
+            }
+            state.finished = true;
+            state.processor.disconnect();
+            state.source.disconnect();
+            state.context.close();
+            
+            if (userStopped) {
+                await fetch(`/audio_stream/${state.id}/end`, { method: 'POST' });
+            }
+            const response = await fetch(`/audio_stream/${state.id}/result`);
+            hideLoading(loadingId);
+            showVoiceResult(await response.json());
+        } catch (error) {
+            hideLoading(loadingId);
+            
+            console.error('串流語音識別出錯:', error);
+            addMessage('發送失敗，請稍後再試。', 'system-message error-message');
+        }
+    }
+    
     // 發送錄音到服務器
     async function sendAudioToServer() {
         if (audioChunks.length === 0) return;
@@ -155,28 +393,7 @@ document.addEventListener('DOMContentLoaded', function() {
             // 隱藏加載中狀態
             hideLoading(loadingId);
             
-            const data = await response.json();
-            
-            if (data.error) {
-                // 檢查是否是配額限制錯誤
-                if (data.error.includes('429') || data.error.toLowerCase().includes('quota')) {
-                    addMessage(`API 配額限制: ${data.error}`, 'system-message error-message');
-                    addMessage('提示: 您可能已達到免費 API 使用限額。請稍後再試或考慮升級至付費計劃。', 'system-message');
-                } else {
-                    addMessage(`錯誤: ${data.error}`, 'system-message error-message');
-                }
-            } else {
-                if (data.input_text) {
-                    // 將識別的語音文字填入輸入框
-                    textInput.value = data.input_text;
-                    
-                    addMessage(data.input_text, 'user-message');
-                }
-                addMessage(data.response_text, 'system-message');
-                if (data.audio_url) {
-                    playResponseAudio(data.audio_url);
-                }
-            }
+            showVoiceResult(await response.json());
         } catch (error) {
             // 隱藏加載中狀態
             hideLoading(loadingId);
@@ -186,42 +403,135 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
-    // 播放回應音頻
-    function playResponseAudio(audioUrl) {
-        responseAudio.src = audioUrl + '?t=' + new Date().getTime(); // 防止緩存
-        responseAudio.play();
+    // 播放回應音頻 (依序播放所有語音片段)
+    function playResponseAudio(audioSegments) {
+        resetAudioQueue();
+        (audioSegments || []).forEach(enqueueAudio);
+    }
+    
+    // 將語音片段加入播放佇列
+    function enqueueAudio(audioUrl) {
+        audioQueue.push(audioUrl);
+        if (!isPlayingAudio) {
+            playNextAudio();
+        }
+    }
+    
+    // 播放佇列中的下一段語音
+    function playNextAudio() {
+        if (audioQueue.length === 0) {
+            isPlayingAudio = false;
+            return;
+        }
+        isPlayingAudio = true;
+        responseAudio.src = audioQueue.shift();
+        responseAudio.play().catch(error => {
+            // 載入失敗會觸發 error 事件並自動跳到下一段；被瀏覽器阻擋自動播放時則停止佇列
+            console.error('播放語音出錯:', error);
+            if (error.name === 'NotAllowedError') {
+                isPlayingAudio = false;
+            }
+        });
     }
     
+    // 清空播放佇列並停止目前的語音
+    function resetAudioQueue() {
+        audioQueue = [];
+        isPlayingAudio = false;
+        responseAudio.pause();
+    }
+    
+    responseAudio.addEventListener('ended', playNextAudio);
+    responseAudio.addEventListener('error', playNextAudio);
+    
     // 切換錄音狀態
     async function toggleRecording() {
         if (isRecording) {
-            mediaRecorder.stop();
-            isRecording = false;
+            stopRecording();
         } else {
             if (!mediaRecorder && !(await initializeRecording())) {
                 return;
             }
             
-            audioChunks = [];
-            mediaRecorder.start();
+            if (useStreamingAsr) {
+                try {
+                    await startStreamingRecording();
+                } catch (error) {
+                    console.error('無法開始串流錄音:', error);
+                    addMessage('無法開始錄音，請稍後再試。', 'system-message error-message');
+                    return;
+                }
+            } else {
+                audioChunks = [];
+                mediaRecorder.start();
+            }
             isRecording = true;
             voiceButton.classList.add('recording');
             micIcon.style.display = 'none';
             recordingStatus.style.display = 'inline';
             
             // 添加自動停止錄音（最長10秒）
+            const recording = useStreamingAsr ? pcmStream : mediaRecorder;
             setTimeout(() => {
-                if (isRecording) {
-                    mediaRecorder.stop();
-                    isRecording = false;
+                if (isRecording && (useStreamingAsr ? pcmStream === recording : true)) {
+                    stopRecording();
                 }
             }, 10000);
         }
     }
     
+    function stopRecording() {
+        if (useStreamingAsr) {
+            finishStreamingRecording(true);
+        } else {
+            mediaRecorder.stop();
+            isRecording = false;
+        }
+    }
+    
+    // 載入更早的聊天歷史，插入在目前最早的記錄之前並保持捲動位置
+    async function loadEarlierHistory() {
+        const loadButton = document.getElementById('load-history');
+        if (!loadButton) return;
+        loadButton.disabled = true;
+        
+        try {
+            const response = await fetch(`/chat_history?before=${encodeURIComponent(loadButton.dataset.before)}`);
+            const data = await response.json();
+            
+            const previousHeight = chatContainer.scrollHeight;
+            const fragment = document.createDocumentFragment();
+            data.turns.forEach(turn => {
+                [[turn.user, 'user-message'], [turn.system, 'system-message']].forEach(([text, className]) => {
+                    const message = document.createElement('div');
+                    message.className = `message ${className}`;
+                    message.textContent = text;
+                    fragment.appendChild(message);
+                });
+            });
+            loadButton.after(fragment);
+            chatContainer.scrollTop += chatContainer.scrollHeight - previousHeight;
+            
+            if (data.before) {
+                loadButton.dataset.before = data.before;
+                loadButton.disabled = false;
+            } else {
+                loadButton.remove();
+            }
+        } catch (error) {
+            console.error('載入聊天歷史出錯:', error);
+            loadButton.disabled = false;
+        }
+    }
+    
     // 事件監聽器
     sendButton.addEventListener('click', sendTextMessage);
     
+    const loadHistoryButton = document.getElementById('load-history');
+    if (loadHistoryButton) {
+        loadHistoryButton.addEventListener('click', loadEarlierHistory);
+    }
+    
     textInput.addEventListener('keypress', function(event) {
         if (event.key === 'Enter') {
             sendTextMessage();
@@ -230,6 +540,9 @@ document.addEventListener('DOMContentLoaded', function() {
     
     voiceButton.addEventListener('click', toggleRecording);
     
+    // 顯示最新的對話
+    chatContainer.scrollTop = chatContainer.scrollHeight;
+    
     // 初始化麥克風
     initializeRecording();
 });
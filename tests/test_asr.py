@@ -0,0 +1,62 @@
+"""
+BatchingRecognizer 的回歸測試：逐段識別的後端不合併，每段完成時立即返回結果
+執行: python -m pytest -q tests
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from asr import BatchingRecognizer, SpeechRecognizer
+
+
+class SlowRecognizer(SpeechRecognizer):
+    name = 'slow'
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def recognize(self, audio_data):
+        time.sleep(self.seconds)
+        return audio_data
+
+
+class BatchRecognizer(SpeechRecognizer):
+    name = 'batch'
+    batched_inference = True
+
+    def __init__(self):
+        self.batches = []
+        self.release = threading.Event()
+
+    def recognize_batch(self, audios):
+        self.release.wait(5)
+        self.batches.append(list(audios))
+        return list(audios)
+
+
+class BatchingRecognizerTest(unittest.TestCase):
+    def test_serial_backend_resolves_each_future_when_ready(self):
+        recognizer = BatchingRecognizer(SlowRecognizer(0.1), workers=1, max_batch=8, max_wait=0.05)
+        futures = [recognizer.submit(f"clip-{i}") for i in range(4)]
+        first = futures[0].result(timeout=5)
+        # 第一段完成時其他音頻還在排隊，不必等整批結束
+        self.assertEqual(first, "clip-0")
+        self.assertFalse(futures[-1].done())
+        self.assertEqual([future.result(timeout=5) for future in futures], [f"clip-{i}" for i in range(4)])
+        self.assertEqual(recognizer.stats()['avg_batch_size'], 1.0)
+
+    def test_batched_backend_is_batched(self):
+        backend = BatchRecognizer()
+        recognizer = BatchingRecognizer(backend, workers=1, max_batch=8, max_wait=0.05)
+        futures = [recognizer.submit(f"clip-{i}") for i in range(4)]
+        backend.release.set()
+        self.assertEqual([future.result(timeout=5) for future in futures], [f"clip-{i}" for i in range(4)])
+        self.assertEqual(backend.batches, [[f"clip-{i}" for i in range(4)]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+"""
+ResponseCache 的回歸測試
+- 相似查詢：Jaccard 相似度高於閾值才命中，剛好等於閾值時不命中
+- 超過 expiry 秒的記錄不再返回
+- 超過筆數或位元組上限時依 LRU 順序淘汰最久未使用的記錄
+執行: python -m pytest -q tests
+"""
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import ResponseCache
+
+WORDS = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta", "iota", "kappa"]
+
+
+def words(count):
+    return " ".join(WORDS[:count])
+
+
+class SimilarQueryTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache(expiry=3600, threshold=0.8)
+
+    def test_exact_match_after_normalization(self):
+        self.cache.put("What is Alpha?", "回答")
+        self.assertEqual(self.cache.get("what is alpha"), "回答")
+
+    def test_hit_above_threshold(self):
+        # 相似度 9/10 = 0.9
+        self.cache.put(words(10), "回答")
+        self.assertEqual(self.cache.get(words(9)), "回答")
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_miss_at_threshold(self):
+        # 相似度 4/5 = 0.8，需要高於閾值才視為相似
+        self.cache.put(words(5), "回答")
+        self.assertIsNone(self.cache.get(words(4)))
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_chinese_ngram_similarity(self):
+        self.cache.put("今天台北的天氣怎麼樣", "晴天")
+        self.assertEqual(self.cache.get("今天台北的天氣怎麼樣呀"), "晴天")
+        self.assertIsNone(self.cache.get("明天高雄會下雨嗎"))
+
+
+class ExpiryTest(unittest.TestCase):
+    def test_entry_expires_after_ttl(self):
+        cache = ResponseCache(expiry=60)
+        now = time.time()
+        with mock.patch('cache.time.time', return_value=now):
+            cache.put(words(10), "回答")
+        with mock.patch('cache.time.time', return_value=now + 59):
+            self.assertEqual(cache.get(words(9)), "回答")
+        with mock.patch('cache.time.time', return_value=now + 61):
+            # 相似查詢也不會命中過期的記錄
+            self.assertIsNone(cache.get(words(9)))
+            self.assertIsNone(cache.get(words(10)))
+            self.assertEqual(len(cache), 0)
+            self.assertEqual(cache.expirations, 1)
+
+    def test_rewrite_restarts_ttl(self):
+        cache = ResponseCache(expiry=60)
+        now = time.time()
+        with mock.patch('cache.time.time', return_value=now):
+            cache.put(words(5), "舊的回答")
+        with mock.patch('cache.time.time', return_value=now + 30):
+            cache.put(words(5), "新的回答")
+        with mock.patch('cache.time.time', return_value=now + 61):
+            self.assertEqual(cache.get(words(5)), "新的回答")
+
+
+class EvictionTest(unittest.TestCase):
+    def test_max_entries_evicts_least_recently_used(self):
+        cache = ResponseCache(expiry=3600, max_entries=2)
+        cache.put("first question", "一")
+        cache.put("second question", "二")
+        # 讀取後 first 成為最近使用的記錄
+        self.assertEqual(cache.get("first question"), "一")
+        cache.put("third question", "三")
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.get("second question"))
+        self.assertEqual(cache.get("first question"), "一")
+        self.assertEqual(cache.get("third question"), "三")
+
+    def test_max_bytes_evicts_least_recently_used(self):
+        probe = ResponseCache(expiry=3600)
+        probe.put("first question", "一")
+        entry_bytes = probe.stats()['bytes']
+        # 三筆大小相近的記錄中只放得下兩筆
+        cache = ResponseCache(expiry=3600, max_bytes=entry_bytes * 2 + 8)
+        cache.put("first question", "一")
+        cache.put("other question", "二")
+        self.assertEqual(cache.get("first question"), "一")
+        cache.put("third question", "三")
+        self.assertLessEqual(cache.stats()['bytes'], cache.max_bytes)
+        self.assertIsNone(cache.get("other question"))
+        self.assertEqual(cache.get("first question"), "一")
+        self.assertEqual(cache.get("third question"), "三")
+
+    def test_entry_larger_than_max_bytes_is_not_stored(self):
+        cache = ResponseCache(expiry=3600, max_bytes=64)
+        cache.put("short", "一")
+        cache.put("long question", "很長的回答" * 20)
+        self.assertIsNone(cache.get("long question"))
+        self.assertEqual(cache.get("short"), "一")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+"""
+SQLiteCacheStore 的回歸測試：同步游標只前進到已讀到的記錄，不會跳過之後寫入的記錄
+執行: python -m pytest -q tests
+"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache_store import SQLiteCacheStore
+
+
+class LoadSinceTest(unittest.TestCase):
+    def setUp(self):
+        path = os.path.join(tempfile.mkdtemp(prefix="mysiri_test_"), 'cache.db')
+        self.store = SQLiteCacheStore(path, expiry=3600)
+        self.addCleanup(self.store.close)
+
+    def test_cursor_is_last_row_read(self):
+        now = time.time()
+        self.store.save('a', '問題一', '回答一', now)
+        self.store.save('b', '問題二', '回答二', now)
+        self.store.flush()
+        rows, cursor = self.store.load_since(0)
+        self.assertEqual([row[0] for row in rows], ['a', 'b'])
+
+        self.store.save('c', '問題三', '回答三', now)
+        self.store.flush()
+        rows, next_cursor = self.store.load_since(cursor)
+        self.assertEqual([row[0] for row in rows], ['c'])
+        self.assertGreater(next_cursor, cursor)
+
+    def test_cursor_unchanged_without_rows(self):
+        rows, cursor = self.store.load_since(0)
+        self.assertEqual((rows, cursor), ([], 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
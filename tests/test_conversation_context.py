@@ -0,0 +1,70 @@
+"""
+多輪上下文的回歸測試
+- 摘要的遲滯 (穩定狀態下不應該每輪都摘要)
+- 只有追問帶入上下文，獨立的問題照常使用緩存
+執行: python -m pytest -q tests
+"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversation_context import ConversationContext, contents_text, depends_on_context
+from conversation_store import ConversationStore
+from rate_limit import estimate_tokens
+
+
+class CompactionHysteresisTest(unittest.TestCase):
+    def setUp(self):
+        path = os.path.join(tempfile.mkdtemp(prefix="mysiri_test_"), 'conversations.db')
+        self.store = ConversationStore(path)
+        self.summaries = 0
+
+    def summarize(self, previous_summary, turns, max_chars):
+        self.summaries += 1
+        return "摘要"
+
+    def converse(self, context, turns):
+        for turn in range(turns):
+            context.build('s')
+            # 等待背景的摘要完成，讓每一輪看到最新的摘要
+            while context.stats()['compacting']:
+                time.sleep(0.001)
+            self.store.append('s', f"問題 {turn} " + "字" * 40, "回答" * 40)
+
+    def test_compacts_every_few_turns(self):
+        context = ConversationContext(self.store, token_budget=600, max_turns=20,
+                                      summarize=self.summarize, compact_to=0.5)
+        self.converse(context, 60)
+        self.assertGreater(self.summaries, 0)
+        self.assertLess(self.summaries, 20)
+
+    def test_without_hysteresis_compacts_every_turn(self):
+        context = ConversationContext(self.store, token_budget=600, max_turns=20,
+                                      summarize=self.summarize, compact_to=1.0)
+        self.converse(context, 60)
+        self.assertGreater(self.summaries, 40)
+
+    def test_context_stays_within_budget(self):
+        context = ConversationContext(self.store, token_budget=600, max_turns=20,
+                                      summarize=self.summarize, compact_to=0.5)
+        self.converse(context, 30)
+        self.assertLessEqual(estimate_tokens(contents_text(context.build('s'))), 600)
+
+
+class DependsOnContextTest(unittest.TestCase):
+    def test_standalone_questions(self):
+        # 很短的問題不再一律視為追問
+        for query in ("明天天氣如何", "什麼是機器學習", "一公斤等於幾磅", "現在幾點", "What is the capital of France?"):
+            self.assertFalse(depends_on_context(query), query)
+
+    def test_follow_up_questions(self):
+        for query in ("那台中呢", "為什麼？", "再詳細一點", "它的價格是多少", "Why is that?"):
+            self.assertTrue(depends_on_context(query), query)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+"""
+熔斷器的回歸測試
+- 半開狀態只放行一個試探請求
+- 串流的試探請求因客戶端斷線而中斷時，必須釋放試探名額，否則主要模型會被永遠拒絕
+- 還在排隊就被取消的對沖請求也必須釋放試探名額
+執行: python -m pytest -q tests
+"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from model_router import CircuitBreaker, ModelRouter
+
+
+def half_open(breaker):
+    # 讓熔斷器處於冷卻結束、等待試探的狀態
+    breaker._open_until = time.monotonic() - 1
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_half_open_allows_single_probe(self):
+        breaker = CircuitBreaker(cooldown=60)
+        half_open(breaker)
+        self.assertEqual(breaker.state, 'half-open')
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+    def test_release_allows_next_probe(self):
+        breaker = CircuitBreaker(cooldown=60)
+        half_open(breaker)
+        self.assertTrue(breaker.allow())
+        breaker.release()
+        self.assertTrue(breaker.allow())
+
+    def test_probe_success_closes_and_failure_reopens(self):
+        breaker = CircuitBreaker(cooldown=60)
+        half_open(breaker)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+        half_open(breaker)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+
+
+class CancelledHedgeTest(unittest.TestCase):
+    def test_queued_hedge_releases_probe(self):
+        def primary(text):
+            # 只有一個工作執行緒：其他請求排在對沖的備用模型請求之前，主要模型回應後備用模型仍在排隊
+            router._executor.submit(time.sleep, 0.2)
+            time.sleep(0.1)
+            return "主要模型的回應"
+
+        def backup(text):
+            return "備用模型的回應"
+
+        router = ModelRouter([('primary', primary), ('backup', backup)], hedge_delay=0.02, max_workers=1)
+        half_open(router.breakers['backup'])
+        self.assertEqual(router.route("問題"), ('primary', "主要模型的回應"))
+        self.assertEqual(router.hedges, 1)
+        self.assertTrue(router.breakers['backup'].allow())
+
+
+class StreamProbeReleaseTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        work_dir = tempfile.mkdtemp(prefix="mysiri_test_")
+        os.environ['CONVERSATION_DB_PATH'] = os.path.join(work_dir, 'conversations.db')
+        os.environ['TTS_CACHE_DIR'] = os.path.join(work_dir, 'tts')
+        os.environ.pop('CACHE_WARM_LOG', None)
+        import app
+        app.create_app(prewarm=False)
+        cls.app = app
+
+    def test_disconnect_releases_probe(self):
+        app = self.app
+        breaker = app.model_router.breakers[app.PRIMARY_MODEL]
+        half_open(breaker)
+
+        def fake_stream(text, model_name=app.PRIMARY_MODEL, history=None):
+            for _ in range(100):
+                yield "片段"
+
+        original = app.stream_gemini_api
+        app.stream_gemini_api = fake_stream
+        try:
+            client = app.app.test_client()
+            response = client.post('/text_input_stream', json={'text': '斷線測試的問題'}, buffered=False)
+            stream = iter(response.response)
+            next(stream)
+            # 只讀取第一個事件就斷線 (關閉生成器時拋出 GeneratorExit)
+            response.close()
+        finally:
+            app.stream_gemini_api = original
+
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+
+
+if __name__ == '__main__':
+    unittest.main()
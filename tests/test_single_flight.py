@@ -0,0 +1,64 @@
+"""
+SingleFlight 的回歸測試：非同步模式下 leader 被取消 (例如用戶端斷線) 時，
+等待它的 follower 收到 ModelCallError (由備援策略的錯誤處理返回錯誤訊息)，而不是未預期的異常
+執行: python -m pytest -q tests
+"""
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model_router import ModelCallError
+from single_flight import SingleFlight
+
+
+class CancelledLeaderTest(unittest.TestCase):
+    def test_follower_gets_model_call_error(self):
+        async def scenario():
+            flights = SingleFlight()
+            started = asyncio.Event()
+
+            async def slow(query):
+                started.set()
+                await asyncio.sleep(10)
+                return "回答"
+
+            leader = asyncio.create_task(flights.ado("今天天氣如何", slow))
+            await started.wait()
+            follower = asyncio.create_task(flights.ado("今天天氣如何？", slow))
+            await asyncio.sleep(0)
+            leader.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await leader
+            with self.assertRaises(ModelCallError):
+                await asyncio.wait_for(follower, timeout=5)
+            self.assertEqual(flights.stats()['in_flight'], 0)
+            self.assertEqual(flights.stats()['coalesced'], 1)
+
+        asyncio.run(scenario())
+
+    def test_leader_error_is_shared(self):
+        async def scenario():
+            flights = SingleFlight()
+            release = asyncio.Event()
+
+            async def failing(query):
+                await release.wait()
+                raise ModelCallError("429")
+
+            leader = asyncio.create_task(flights.ado("明天會下雨嗎", failing))
+            await asyncio.sleep(0)
+            follower = asyncio.create_task(flights.ado("明天會下雨嗎", failing))
+            await asyncio.sleep(0)
+            release.set()
+            for task in (leader, follower):
+                with self.assertRaises(ModelCallError):
+                    await task
+
+        asyncio.run(scenario())
+
+
+if __name__ == '__main__':
+    unittest.main()
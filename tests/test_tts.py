@@ -0,0 +1,50 @@
+"""
+逐句語音合成的回歸測試：片段網址可能由其他 worker 進程返回，
+請求到達時該進程仍在合成 (磁碟上只有暫存檔)，應等待檔案完成而不是返回 404
+執行: python -m pytest -q tests
+"""
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tts import AudioCache, TTSPipeline
+
+
+class OtherWorkerSynthesisTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = AudioCache(tempfile.mkdtemp(prefix="mysiri_test_"), max_bytes=1024 * 1024)
+        # 本進程沒有合成任何句子，不需要 TTSWorker
+        self.pipeline = TTSPipeline(None, self.cache, poll_interval=0.01)
+        self.digest = AudioCache.key("其他進程合成的句子", {'volume': 1.0, 'rate': 1.0, 'pitch': 1.0})
+        # 其他進程的暫存檔 (檔名包含該進程的 ID)
+        self.partial = os.path.join(self.cache.directory, f"{self.digest}.99999.partial.mp3")
+        with open(self.partial, 'wb') as f:
+            f.write(b'partial')
+
+    def test_waits_for_other_worker(self):
+        def finish():
+            with open(self.partial, 'wb') as f:
+                f.write(b'audio')
+            os.replace(self.partial, self.cache.path(self.digest))
+
+        timer = threading.Timer(0.1, finish)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertEqual(self.pipeline.wait_audio(self.digest, timeout=5), self.cache.path(self.digest))
+
+    def test_times_out_while_partial(self):
+        with self.assertRaises(FutureTimeoutError):
+            self.pipeline.wait_audio(self.digest, timeout=0.05)
+
+    def test_missing_without_partial(self):
+        os.remove(self.partial)
+        self.assertIsNone(self.pipeline.wait_audio(self.digest, timeout=5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+"""
+串流錄音的回歸測試
+- 開始說話之前持續送來的靜音不會累積在記憶體中，去除靜音後的語音仍保留前面的緩衝
+- 超過長度上限的串流以已收到的部分結束錄音，過期的串流在查找時移除
+執行: python -m pytest -q tests
+"""
+import os
+import sys
+import time
+import unittest
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from voice_stream import AudioStreamManager, EnergyVAD
+
+FRAME_SAMPLES = 480  # 16 kHz 下 30 毫秒
+
+
+def frames(count, amplitude):
+    return array('h', [amplitude] * FRAME_SAMPLES * count).tobytes()
+
+
+class EnergyVADTest(unittest.TestCase):
+    def test_silence_before_speech_is_bounded(self):
+        vad = EnergyVAD(use_webrtc=False)
+        for _ in range(100):
+            vad.feed(frames(10, 0))
+        self.assertLessEqual(len(vad._frames), vad.padding_frames + vad.start_frames)
+
+        vad.feed(frames(20, 5000) + frames(30, 0))
+        self.assertTrue(vad.ended)
+        audio = vad.speech_audio()
+        # 語音前後各保留 padding_frames 幀的靜音
+        expected = frames(vad.padding_frames, 0) + frames(20, 5000) + frames(vad.padding_frames, 0)
+        self.assertEqual(audio, expected)
+
+
+class AudioStreamManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.manager = AudioStreamManager(lambda pcm, session_id: pcm, workers=1, stream_ttl=60,
+                                          max_stream_seconds=1, vad_options={'use_webrtc': False})
+
+    def test_stream_is_capped(self):
+        stream = self.manager.create()
+        self.assertFalse(self.manager.feed(stream, frames(20, 0)))
+        # 1 秒約 33 幀，之後的音頻不再接收
+        self.assertTrue(self.manager.feed(stream, frames(20, 0)))
+        self.assertLessEqual(stream.received_bytes, self.manager.max_stream_bytes)
+        self.assertIsNone(stream.future.result(timeout=5))
+
+    def test_expired_stream_is_removed_on_get(self):
+        stream = self.manager.create()
+        stream.created_at = time.time() - 120
+        self.assertIsNone(self.manager.get(stream.id))
+
+
+if __name__ == '__main__':
+    unittest.main()
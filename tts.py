@@ -0,0 +1,440 @@
+import glob
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from startup import LazyBackend, BackendUnavailableError
+from utils import PerProcess
+
+# 句子結束的標點：中文全形標點、英文標點 (句點後需接空白，避免切開小數)、換行
+_SENTENCE_END = re.compile(r'[。！？!?；;…]+[」』”’)）]*|\.(?=\s)|\n+')
+# 過長的句子再依逗號等較弱的停頓切分
+_CLAUSE_END = re.compile(r'[，,、：:]')
+# 不包含任何文字或數字的片段 (例如只剩標點) 不需要合成
+_SPEAKABLE = re.compile(r'\w')
+
+
+def _split_complete(text):
+    """
+    切出已結束的句子，返回 (句子列表, 尚未結束的剩餘文字)
+    """
+    sentences = []
+    start = 0
+    for match in _SENTENCE_END.finditer(text):
+        sentence = text[start:match.end()].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = match.end()
+    return sentences, text[start:]
+
+
+def _split_long(sentence, max_chars):
+    if len(sentence) <= max_chars:
+        return [sentence]
+    pieces = []
+    current = ''
+    start = 0
+    for match in _CLAUSE_END.finditer(sentence):
+        clause = sentence[start:match.end()]
+        start = match.end()
+        if current and len(current) + len(clause) > max_chars:
+            pieces.append(current)
+            current = ''
+        current += clause
+    current += sentence[start:]
+    if current:
+        pieces.append(current)
+    # 仍然過長的片段直接按長度切分
+    return [piece[i:i + max_chars] for piece in pieces for i in range(0, len(piece), max_chars)]
+
+
+def split_sentences(text, max_chars=120):
+    """
+    將回應切分為適合逐段合成語音的句子
+    支援中文標點 (。！？) 以及英文標點，過長的句子會再依逗號切分
+    """
+    sentences, rest = _split_complete(text)
+    if rest.strip():
+        sentences.append(rest.strip())
+    return [piece for sentence in sentences for piece in _split_long(sentence, max_chars)
+            if _SPEAKABLE.search(piece)]
+
+
+class TTSWorker(PerProcess):
+    """
+    長期運行的語音合成執行緒
+    pyttsx3 引擎包裝成 LazyBackend，只在語音合成執行緒中初始化一次，之後所有工作都透過佇列交給同一個引擎處理，
+    請求不再需要等待語音驅動載入，也不會在多執行緒下同時操作同一個引擎
+    執行緒在第一個工作 (或預熱) 時才啟動 (見 PerProcess)
+    get / ready / stats 與 LazyBackend 相同，可以交給 Prewarmer 在語音合成執行緒中預先初始化引擎
+    """
+    def __init__(self, base_rate=200):
+        PerProcess.__init__(self)
+        self.base_rate = base_rate
+        self.name = "語音合成引擎 pyttsx3"
+        # 只由語音合成執行緒呼叫 get()，引擎一定在使用它的執行緒中建立
+        self.engine = LazyBackend(self.name, self._create_engine)
+        self._queue = None
+        self._thread = None
+
+    def _start_process(self, forked):
+        # 引擎也不沿用父進程建立的實例
+        if forked:
+            self.engine.reset()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, args=(self._queue,), name="tts-worker", daemon=True)
+        self._thread.start()
+        return self._queue
+
+    def submit(self, text, path, settings):
+        """
+        加入一個合成工作，返回在檔案寫入完成時結束的 Future
+        settings 為該工作使用的語音設置 (volume / rate / pitch)
+        """
+        future = Future()
+        self._per_process().put((text, path, dict(settings), future))
+        return future
+
+    def queue_depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    @property
+    def ready(self):
+        return self.engine.ready
+
+    def get(self):
+        """
+        在語音合成執行緒中初始化引擎並等待完成 (預熱)，失敗時拋出 BackendUnavailableError
+        """
+        future = Future()
+        self._per_process().put((None, None, None, future))
+        return future.result()
+
+    def stats(self):
+        return self.engine.stats()
+
+    def _create_engine(self):
+        # 在語音合成執行緒中才匯入，不延遲服務啟動
+        import pyttsx3
+        return pyttsx3.init()
+
+    def _run(self, jobs):
+        while True:
+            text, path, settings, future = jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                # 初始化失敗時在 retry_interval 之後的工作再重試，驅動可能在之後才變得可用
+                engine = self.engine.get()
+            except BackendUnavailableError as e:
+                future.set_exception(e)
+                continue
+            if text is None:
+                # 預熱
+                future.set_result(engine)
+                continue
+            try:
+                engine.setProperty('volume', settings['volume'])
+                engine.setProperty('rate', settings['rate'] * self.base_rate)
+                # pyttsx3 目前不直接支持調整音調
+                engine.save_to_file(text, path)
+                engine.runAndWait()
+                future.set_result(path)
+            except Exception as e:
+                print(f"語音合成失敗: {e}")
+                future.set_exception(e)
+                # 引擎可能處於異常狀態，下一個工作重新初始化
+                try:
+                    engine.stop()
+                except Exception:
+                    pass
+                self.engine.reset()
+
+
+class AudioCache:
+    """
+    內容定址的語音檔案緩存
+    檔名為 (文字, 音量, 語速, 音調) 的雜湊值，相同的句子與設置只需合成一次；
+    保留策略：總磁碟用量超過上限，或檔案超過 max_age 秒未被使用時刪除最久未使用的檔案
+    多個 worker 進程可以共用同一個目錄：索引中沒有的檔案會再到磁碟上尋找 (可能是其他進程合成的)
+    """
+    def __init__(self, directory, max_bytes, audio_format='mp3', max_age=None, partial_max_age=600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.partial_max_age = partial_max_age
+        self.audio_format = audio_format
+        self._files = OrderedDict()  # 雜湊值 -> (檔案大小, 最後使用時間)，依最近使用順序排列
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # 載入上次運行留下的檔案，最舊的排在前面
+        os.makedirs(directory, exist_ok=True)
+        suffix = f".{audio_format}"
+        existing = []
+        partial_cutoff = time.time() - partial_max_age
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith(suffix) and '.partial' not in name:
+                existing.append((stat.st_mtime, name[:-len(suffix)], stat.st_size))
+            elif '.partial' in name and stat.st_mtime < partial_cutoff:
+                # 上次運行中斷時未完成的檔案；較新的可能是其他進程正在寫入的，不刪除
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        for mtime, digest, size in sorted(existing):
+            self._files[digest] = (size, mtime)
+            self._bytes += size
+        with self._lock:
+            self._evict(time.time())
+
+    @staticmethod
+    def key(text, settings):
+        payload = json.dumps(
+            [text, settings.get('volume'), settings.get('rate'), settings.get('pitch')],
+            ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def path(self, digest):
+        return os.path.join(self.directory, f"{digest}.{self.audio_format}")
+
+    def partial_path(self, digest):
+        # 檔名包含進程 ID，共用目錄的多個進程同時合成同一個句子時不會寫入同一個檔案
+        return os.path.join(self.directory, f"{digest}.{os.getpid()}.partial.{self.audio_format}")
+
+    def partial_exists(self, digest):
+        """
+        是否有進程 (可能是共用目錄的其他 worker) 正在寫入這個語音檔案
+        """
+        pattern = f"{digest}.*.partial.{self.audio_format}"
+        return bool(glob.glob(os.path.join(glob.escape(self.directory), pattern)))
+
+    def get(self, digest):
+        """
+        返回已緩存的檔案路徑，不存在時返回 None
+        """
+        now = time.time()
+        path = self.path(digest)
+        with self._lock:
+            self._evict(now)
+            record = self._files.get(digest)
+            if record is None:
+                # 其他進程合成的檔案不在本進程的索引中，存在時加入索引
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    return None
+                self._files[digest] = (size, now)
+                self._bytes += size
+                self._evict(now)
+                return path
+            # 檔案可能已被其他進程淘汰
+            if not os.path.exists(path):
+                del self._files[digest]
+                self._bytes -= record[0]
+                return None
+            self._files[digest] = (record[0], now)
+            self._files.move_to_end(digest)
+            return path
+
+    def add(self, digest):
+        """
+        記錄一個已寫入完成的檔案，必要時淘汰最久未使用的檔案
+        """
+        size = os.path.getsize(self.path(digest))
+        now = time.time()
+        with self._lock:
+            previous = self._files.pop(digest, None)
+            if previous is not None:
+                self._bytes -= previous[0]
+            self._files[digest] = (size, now)
+            self._bytes += size
+            self._evict(now)
+
+    def _evict(self, now):
+        # 呼叫端需持有 self._lock；最新加入的檔案不會被淘汰
+        while len(self._files) > 1:
+            oldest = next(iter(self._files))
+            size, last_used = self._files[oldest]
+            expired = self.max_age and now - last_used > self.max_age
+            if not expired and self._bytes <= self.max_bytes:
+                break
+            del self._files[oldest]
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(oldest))
+            except OSError:
+                pass
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'files': len(self._files),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class TTSJob:
+    """
+    一則回應的語音合成工作
+    文字可以分多次加入 (例如串流回應)，每完成一個句子就送出合成
+    """
+    def __init__(self, pipeline, settings):
+        self.pipeline = pipeline
+        self.settings = settings
+        self.segments = []  # 依播放順序排列的語音片段雜湊值
+        self._buffer = ''
+        self._lock = threading.Lock()
+
+    def add_text(self, text):
+        """
+        加入一段文字，返回新送出合成的片段索引
+        """
+        with self._lock:
+            self._buffer += text
+            sentences, self._buffer = _split_complete(self._buffer)
+            return self._submit(sentences)
+
+    def finish(self):
+        """
+        送出剩餘未結束的文字，返回新送出合成的片段索引
+        """
+        with self._lock:
+            rest, self._buffer = self._buffer, ''
+            return self._submit([rest])
+
+    def _submit(self, sentences):
+        indices = []
+        for sentence in sentences:
+            for piece in split_sentences(sentence, self.pipeline.max_chars):
+                indices.append(len(self.segments))
+                self.segments.append(self.pipeline.synthesize(piece, self.settings))
+        return indices
+
+    def segment_url(self, index):
+        return self.pipeline.audio_url(self.segments[index])
+
+    def segment_urls(self):
+        return [self.pipeline.audio_url(digest) for digest in self.segments]
+
+
+class TTSPipeline:
+    """
+    逐句語音合成管線
+    回應被切分為句子後交給 TTSWorker 合成，前端依序取得並播放各段音頻，
+    因此第一段語音的等待時間只取決於第一句的長度，而不是整個回應的長度。
+    每個句子的音頻以內容雜湊值命名並存入 AudioCache，重複的句子不需要再次合成
+    """
+    def __init__(self, worker, audio_cache, max_chars=120, url_prefix='/tts', poll_interval=0.05):
+        self.worker = worker
+        self.audio_cache = audio_cache
+        self.max_chars = max_chars
+        self.url_prefix = url_prefix
+        self.poll_interval = poll_interval
+        self._inflight = {}  # 雜湊值 -> 合成完成時結束的 Future
+        self._lock = threading.Lock()
+
+    def create_job(self, settings):
+        return TTSJob(self, dict(settings))
+
+    def speak(self, text, settings):
+        """
+        為完整的回應文字建立合成工作
+        """
+        job = self.create_job(settings)
+        job.add_text(text)
+        job.finish()
+        return job
+
+    def audio_url(self, digest):
+        return f"{self.url_prefix}/{digest}.{self.audio_cache.audio_format}"
+
+    def synthesize(self, text, settings):
+        """
+        取得一段文字的語音，已緩存或正在合成時不會重複合成，返回內容雜湊值
+        """
+        digest = self.audio_cache.key(text, settings)
+        with self._lock:
+            if digest in self._inflight or self.audio_cache.get(digest):
+                self.audio_cache.record(hit=True)
+                return digest
+            self.audio_cache.record(hit=False)
+            done = Future()
+            self._inflight[digest] = done
+        partial_path = self.audio_cache.partial_path(digest)
+        worker_future = self.worker.submit(text, partial_path, settings)
+        worker_future.add_done_callback(lambda future: self._on_synthesized(digest, partial_path, future, done))
+        return digest
+
+    def _on_synthesized(self, digest, partial_path, worker_future, done):
+        # 先寫入暫存檔，完成後再改名，避免提供未寫完的檔案
+        path = None
+        try:
+            if worker_future.exception() is None and os.path.exists(partial_path):
+                os.replace(partial_path, self.audio_cache.path(digest))
+                self.audio_cache.add(digest)
+                path = self.audio_cache.path(digest)
+            elif os.path.exists(partial_path):
+                # 合成失敗時刪除暫存檔，其他進程不會一直等待這個檔案
+                os.remove(partial_path)
+        except OSError as e:
+            print(f"保存語音檔案失敗: {e}")
+        finally:
+            done.set_result(path)
+            with self._lock:
+                self._inflight.pop(digest, None)
+
+    def wait_audio(self, digest, timeout=None):
+        """
+        等待語音合成完成，返回檔案路徑；不存在或合成失敗時返回 None
+        逾時時拋出 concurrent.futures.TimeoutError
+        片段的網址可能由其他 worker 進程返回，該進程仍在合成時磁碟上只有暫存檔，輪詢直到檔案寫入完成
+        """
+        future = self.pending(digest)
+        if future is not None:
+            return future.result(timeout=timeout)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            path = self.audio_cache.get(digest)
+            if path is not None:
+                return path
+            if not self.audio_cache.partial_exists(digest):
+                # 暫存檔可能剛好在兩次檢查之間改名為完成的檔案
+                return self.audio_cache.get(digest)
+            if deadline is not None and time.monotonic() >= deadline:
+                raise FutureTimeoutError()
+            time.sleep(self.poll_interval)
+
+    def pending(self, digest):
+        """
+        返回正在合成的語音在完成時結束的 Future (結果為檔案路徑)，未在合成中時返回 None
+        """
+        with self._lock:
+            return self._inflight.get(digest)
@@ -1,36 +1,131 @@
 import hashlib
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+
+# 相似查詢的 Jaccard 相似度閾值
+SIMILARITY_THRESHOLD = 0.8
+
+# 中日韓文字切分為字元 n-gram 時使用的 n
+NGRAM_SIZE = 2
+
+# 中日韓文字 (含日文假名與韓文) 的 Unicode 範圍
+_CJK_RANGES = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+_CJK_RUN = re.compile(f'[{_CJK_RANGES}]+')
+# 中日韓文字的連續片段，其餘非空白字元視為一般單字
+_TOKEN_PATTERN = re.compile(f'[{_CJK_RANGES}]+|[^\\s{_CJK_RANGES}]+')
 
 def generate_cache_key(text):
     """
     為查詢文本生成一個緩存鍵
+    使用正規化後的文本，讓只差在標點、全半形或大小寫的查詢共用同一個鍵
+    """
+    return hashlib.md5(normalize_query(text).encode('utf-8')).hexdigest()
+
+def normalize_query(text):
+    """
+    正規化查詢文本：
+    - NFKC 將全形字元轉為半形 (例如 "ＡＢＣ１２３" -> "abc123"，"？" -> "?")
+    - 轉換為小寫
+    - 將標點和符號替換為空格，並移除額外空格
     """
-    return hashlib.md5(text.encode('utf-8')).hexdigest()
+    text = unicodedata.normalize('NFKC', text).lower()
+    text = ''.join(' ' if unicodedata.category(ch)[0] in 'PS' else ch for ch in text)
+    return ' '.join(text.split())
+
+def tokenize_query(text, n=NGRAM_SIZE):
+    """
+    將 (已正規化的) 查詢切分為 token 集合
+    中日韓文字沒有空格分詞，因此切分為字元 n-gram；其他文字仍以單字為 token
+    """
+    tokens = set()
+    for run in _TOKEN_PATTERN.findall(text):
+        if _CJK_RUN.match(run) and len(run) > n:
+            tokens.update(run[i:i + n] for i in range(len(run) - n + 1))
+        else:
+            tokens.add(run)
+    return frozenset(tokens)
+
+def jaccard_similarity(set1, set2):
+    """
+    計算兩個 token 集合的 Jaccard 相似度
+    """
+    union = len(set1 | set2)
+    if union == 0:
+        return 0.0
+    return len(set1 & set2) / union
 
 def is_similar_query(query1, query2):
     """
     檢查兩個查詢是否相似
-    簡單實現：比較兩個字符串的相似度
-    使用 Levenshtein 距離的簡化版
+    先正規化文本，再比較 token 集合 (中文為字元 n-gram) 的 Jaccard 相似度
     """
-    # 移除額外空格並轉換為小寫以進行更好的比較
-    q1 = ' '.join(query1.lower().split())
-    q2 = ' '.join(query2.lower().split())
-    
+    q1 = normalize_query(query1)
+    q2 = normalize_query(query2)
+
     # 如果兩個查詢完全相同，則肯定相似
     if q1 == q2:
         return True
-    
+
     # 計算 Jaccard 相似度
-    set1 = set(q1.split())
-    set2 = set(q2.split())
-    
-    intersection = len(set1.intersection(set2))
-    union = len(set1.union(set2))
-    
-    if union == 0:
-        return False
-    
-    similarity = intersection / union
-    
+    similarity = jaccard_similarity(tokenize_query(q1), tokenize_query(q2))
+
     # 如果相似度高於閾值，認為查詢相似
-    return similarity > 0.8
+    return similarity > SIMILARITY_THRESHOLD
+
+def percentile(sorted_values, fraction):
+    """
+    已排序數值的分位數 (最近排名法)，沒有數值時返回 0.0
+    """
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+class PerProcess:
+    """
+    每個進程各自延遲建立的資源 (背景執行緒、佇列、SQLite 連線)
+    資源在第一次使用時才建立；父進程的執行緒不會被複製到 fork 出的子進程 (例如 gunicorn --preload)，
+    SQLite 連線也不能跨進程共用，因此進程 ID 改變時會重新建立自己的資源
+    子類別在 __init__ 中呼叫 PerProcess.__init__，並實作 _start_process(forked)，
+    forked 表示資源曾在其他進程建立過 (需要丟棄沿用自父進程的狀態)
+    """
+    def __init__(self):
+        self._pid = None
+        self._process_lock = threading.RLock()
+        self._process_resource = None
+
+    def _per_process(self):
+        """
+        返回本進程的資源，第一次使用或 fork 之後先呼叫 _start_process 建立
+        """
+        with self._process_lock:
+            if self._pid != os.getpid():
+                self._process_resource = self._start_process(self._pid is not None)
+                self._pid = os.getpid()
+            return self._process_resource
+
+    def _started_here(self):
+        """
+        本進程是否已經建立資源 (flush / close 不需要為此建立資源)
+        """
+        return self._pid == os.getpid()
+
+    def _forget_process(self):
+        """
+        丟棄本進程的資源，下次使用時重新建立
+        """
+        with self._process_lock:
+            self._pid = None
+            self._process_resource = None
+
+def connect_sqlite(path):
+    """
+    開啟可由多個執行緒共用的 SQLite 連線 (呼叫端自行加鎖)
+    WAL 模式下 NORMAL 已能保證一致性，且提交時不需每次 fsync
+    """
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
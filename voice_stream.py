@@ -0,0 +1,212 @@
+import math
+import threading
+import time
+import uuid
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import webrtcvad
+    WEBRTC_VAD_AVAILABLE = True
+except ImportError:
+    WEBRTC_VAD_AVAILABLE = False
+
+# 串流錄音的格式：16 kHz、單聲道、16 位元 PCM
+STREAM_SAMPLE_RATE = 16000
+STREAM_SAMPLE_WIDTH = 2
+
+
+class EnergyVAD:
+    """
+    語音活動偵測 (VAD)
+    將音頻切成固定長度的幀，判斷每一幀是否為語音：
+    - 安裝了 webrtcvad 時使用 WebRTC 的 VAD
+    - 否則使用能量判斷：幀的 RMS 高於背景噪音估計值的數倍即視為語音
+    連續出現語音後視為開始說話，說話後連續靜音超過 silence_ms 即為說話結束 (端點)
+    開始說話之前只保留最近的 padding_ms (加上判斷開始說話所需的幀)，持續送來的靜音不會累積在記憶體中
+    """
+    def __init__(self, sample_rate=STREAM_SAMPLE_RATE, frame_ms=30, start_ms=90, silence_ms=700,
+                 padding_ms=300, max_speech_ms=15000, energy_ratio=3.0, min_energy=300, use_webrtc=WEBRTC_VAD_AVAILABLE,
+                 webrtc_mode=2):
+        self.sample_rate = sample_rate
+        self.frame_bytes = sample_rate * frame_ms // 1000 * STREAM_SAMPLE_WIDTH
+        self.frame_ms = frame_ms
+        self.start_frames = max(1, start_ms // frame_ms)
+        self.silence_frames = max(1, silence_ms // frame_ms)
+        self.padding_frames = padding_ms // frame_ms
+        self.max_speech_frames = max_speech_ms // frame_ms
+        self.energy_ratio = energy_ratio
+        self.min_energy = min_energy
+        self._webrtc = webrtcvad.Vad(webrtc_mode) if use_webrtc else None
+
+        self._pending = b''
+        self._frames = deque()      # 保留的完整幀
+        self._offset = 0            # self._frames[0] 的幀索引
+        self._noise_floor = None    # 背景噪音能量的估計值
+        self._voiced_run = 0
+        self._silence_run = 0
+        self.speech_start = None    # 開始說話的幀索引
+        self.speech_end = None      # 最後一個語音幀的索引
+        self.ended = False
+
+    @property
+    def speech_started(self):
+        return self.speech_start is not None
+
+    def _is_speech(self, frame):
+        if self._webrtc is not None:
+            return self._webrtc.is_speech(frame, self.sample_rate)
+        samples = array('h', frame)
+        energy = math.sqrt(sum(sample * sample for sample in samples) / len(samples))
+        threshold = max(self.min_energy, (self._noise_floor or 0) * self.energy_ratio)
+        voiced = energy > threshold
+        if not voiced:
+            # 以指數移動平均追蹤背景噪音
+            self._noise_floor = energy if self._noise_floor is None else 0.95 * self._noise_floor + 0.05 * energy
+        return voiced
+
+    def feed(self, pcm):
+        """
+        加入一段 PCM 音頻，偵測到說話結束時返回 True
+        """
+        if self.ended:
+            return True
+        self._pending += pcm
+        while len(self._pending) >= self.frame_bytes and not self.ended:
+            frame = self._pending[:self.frame_bytes]
+            self._pending = self._pending[self.frame_bytes:]
+            self._process_frame(frame)
+        if self.ended:
+            # 端點之後的音頻不會被使用
+            self._pending = b''
+        return self.ended
+
+    def _process_frame(self, frame):
+        index = self._offset + len(self._frames)
+        self._frames.append(frame)
+        voiced = self._is_speech(frame)
+
+        if not self.speech_started:
+            self._voiced_run = self._voiced_run + 1 if voiced else 0
+            if self._voiced_run >= self.start_frames:
+                self.speech_start = index - self._voiced_run + 1
+                self.speech_end = index
+            else:
+                # 開始說話時需要的只有之前 padding_frames 幀的緩衝與目前連續的語音幀
+                while len(self._frames) > self.padding_frames + self.start_frames:
+                    self._frames.popleft()
+                    self._offset += 1
+            return
+
+        if voiced:
+            self.speech_end = index
+            self._silence_run = 0
+        else:
+            self._silence_run += 1
+        if self._silence_run >= self.silence_frames or index - self.speech_start >= self.max_speech_frames:
+            self.ended = True
+
+    def finish(self):
+        """
+        錄音已停止，不再等待靜音
+        """
+        self.ended = True
+
+    def speech_audio(self):
+        """
+        返回去除前後靜音 (保留少量緩衝) 的語音 PCM，未偵測到語音時返回 None
+        """
+        if not self.speech_started:
+            return None
+        start = max(self._offset, self.speech_start - self.padding_frames) - self._offset
+        end = min(self._offset + len(self._frames), self.speech_end + 1 + self.padding_frames) - self._offset
+        return b''.join(list(self._frames)[start:end])
+
+
+class AudioStream:
+    """
+    一次串流錄音：累積瀏覽器送來的 PCM 幀並在偵測到說話結束時開始識別
+    """
+    def __init__(self, stream_id, vad, session_id=None):
+        self.id = stream_id
+        self.vad = vad
+        # 所屬對話的 session ID，識別完成後產生回應時需要它的上下文
+        self.session_id = session_id
+        self.created_at = time.time()
+        self.received_bytes = 0
+        self.future = None
+        self._lock = threading.Lock()
+
+
+class AudioStreamManager:
+    """
+    管理進行中的串流錄音
+    說話結束 (VAD 端點) 時立即將去除靜音的音頻交給 on_speech(pcm, session_id) 在背景處理，
+    不需要等待瀏覽器停止錄音或上傳完整檔案
+    每個串流最多接收 max_stream_seconds 秒、max_stream_bytes 位元組 (預設為該秒數的 PCM 大小)，
+    超過時視為錄音結束；超過 stream_ttl 秒的串流在查找時移除
+    """
+    def __init__(self, on_speech, workers=4, stream_ttl=120, max_stream_seconds=60, max_stream_bytes=None,
+                 vad_options=None):
+        self.on_speech = on_speech
+        self.stream_ttl = stream_ttl
+        self.max_stream_seconds = max_stream_seconds
+        self.max_stream_bytes = max_stream_bytes or int(max_stream_seconds * STREAM_SAMPLE_RATE * STREAM_SAMPLE_WIDTH)
+        self.vad_options = vad_options or {}
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="voice-stream")
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def create(self, session_id=None):
+        self._cleanup_expired()
+        stream = AudioStream(uuid.uuid4().hex, EnergyVAD(**self.vad_options), session_id)
+        with self._lock:
+            self._streams[stream.id] = stream
+        return stream
+
+    def get(self, stream_id):
+        self._cleanup_expired()
+        with self._lock:
+            return self._streams.get(stream_id)
+
+    def pop(self, stream_id):
+        with self._lock:
+            return self._streams.pop(stream_id, None)
+
+    def feed(self, stream, pcm):
+        """
+        加入一段 PCM 音頻，返回是否已偵測到說話結束
+        """
+        with stream._lock:
+            too_long = (stream.received_bytes + len(pcm) > self.max_stream_bytes
+                        or time.time() - stream.created_at > self.max_stream_seconds)
+            if too_long:
+                # 持續送來音頻 (例如一直是靜音) 的串流不再累積，以已收到的部分結束錄音
+                stream.vad.finish()
+                ended = True
+            else:
+                stream.received_bytes += len(pcm)
+                ended = stream.vad.feed(pcm)
+            if ended:
+                self._start_recognition(stream)
+        return ended
+
+    def finish(self, stream):
+        """
+        瀏覽器停止錄音時呼叫，若尚未觸發端點則立即開始識別
+        """
+        with stream._lock:
+            stream.vad.finish()
+            self._start_recognition(stream)
+
+    def _start_recognition(self, stream):
+        # 呼叫端需持有 stream._lock
+        if stream.future is None:
+            stream.future = self._executor.submit(self.on_speech, stream.vad.speech_audio(), stream.session_id)
+
+    def _cleanup_expired(self):
+        now = time.time()
+        with self._lock:
+            for stream_id in [s.id for s in self._streams.values() if now - s.created_at > self.stream_ttl]:
+                del self._streams[stream_id]